@@ -33,11 +33,20 @@ def _argstring(*args):
 
 
 class fs_cache(object):
+    """ Cache function results (pd.DataFrame or pd.Series) in CSV files
+
+    :param update: optional callable (cached_df, *args) -> result.
+        When the cache file exists but is expired, it is called instead of
+        the decorated function to bring stale data up to date, e.g. by only
+        fetching records added since. cached_df is the expired cache content
+        as a pd.DataFrame (i.e. index is loaded as a regular column)
+    """
 
     def __init__(self, app_name, idx=1, cache_type='',
-                 expires=DEFAULT_EXPIRY, ds_path=DATASET_PATH):
+                 expires=DEFAULT_EXPIRY, ds_path=DATASET_PATH, update=None):
         self.expires = expires
         self.idx = idx
+        self.update = update
         if not app_name:
             self.cache_path = ds_path
         else:
@@ -63,7 +72,11 @@ class fs_cache(object):
                 return pd.read_csv(cache_fpath,
                                    encoding="utf8", squeeze=True)
 
-            res = func(*args)
+            if self.update is not None and os.path.isfile(cache_fpath):
+                stale = pd.read_csv(cache_fpath, encoding="utf8")
+                res = self.update(stale, *args)
+            else:
+                res = func(*args)
             if isinstance(res, pd.DataFrame):
                 df = res
                 if len(df.columns) == 1 and self.idx == 1:
@@ -90,8 +103,9 @@ class fs_cache(object):
 
 def typed_fs_cache(app_name, expires=DEFAULT_EXPIRY):
     # type: (str, int) -> callable
-    def _cache(cache_type, idx=1):
-        return fs_cache(app_name, idx, cache_type=cache_type, expires=expires)
+    def _cache(cache_type, idx=1, update=None):
+        return fs_cache(app_name, idx, cache_type=cache_type, expires=expires,
+                        update=update)
 
     return _cache
 
@@ -0,0 +1,80 @@
+
+from __future__ import print_function, unicode_literals
+
+import logging
+
+from django.core.management.base import BaseCommand
+
+import scraper
+from scraper import replay
+
+
+class Command(BaseCommand):
+    requires_system_checks = False
+    help = "Measure GitHub scraper throughput against a local replay " \
+           "server, or record real GitHub responses to replay later."
+
+    def add_arguments(self, parser):
+        parser.add_argument('repos', nargs='*', type=str,
+                            help='Repositories to use, owner/name. Default '
+                                 'is a few synthetic ones')
+        parser.add_argument('--record', type=str,
+                            help='Run scenarios against GitHub, appending '
+                                 'responses to this file')
+        parser.add_argument('--replay', type=str,
+                            help='Replay responses from this file instead '
+                                 'of synthetic ones')
+        parser.add_argument('-s', '--scenario', action='append',
+                            choices=list(replay.SCENARIOS),
+                            help='Scenario to run, default all')
+        parser.add_argument('--issues', default=10, type=int,
+                            help='Number of issues per repo to get '
+                                 'timelines of')
+        parser.add_argument('-w', '--workers', default=1, type=int,
+                            help='Number of repos processed at once')
+        parser.add_argument('-t', '--tokens', default=4, type=int,
+                            help='Number of emulated tokens')
+        parser.add_argument('-c', '--concurrency', default=4, type=int,
+                            help='Concurrent requests per token')
+        parser.add_argument('--latency', default=0.05, type=float,
+                            help='Emulated response time, seconds')
+        parser.add_argument('--fault-rate', default=0.0, type=float,
+                            help='Share of responses failing with 403/502')
+        parser.add_argument('--rate-limit', default=5000, type=int,
+                            help='Emulated number of requests per token '
+                                 'per reset interval')
+        parser.add_argument('--reset-interval', default=3600, type=int,
+                            help='Emulated rate limit reset interval, '
+                                 'seconds')
+
+    def handle(self, *args, **options):
+        # -v 3: DEBUG, 2: INFO, 1: WARNING (default), 0: ERROR
+        loglevel = 40 - 10 * options['verbosity']
+        logging.basicConfig(level=loglevel)
+
+        repos = options['repos'] or \
+            ['bench/repo%d' % i for i in range(options['workers'])]
+        scenarios = options['scenario'] or list(replay.SCENARIOS)
+
+        if options['record']:
+            api = scraper.GitHubAPI()
+            with replay.record(api, options['record']):
+                for scenario in scenarios:
+                    replay.run(api, repos, scenario, options['issues'],
+                               options['workers'])
+            return
+
+        if options['replay']:
+            responses = replay.load(options['replay'])
+        else:
+            responses = replay.synthetic(repos)
+
+        with replay.ReplayServer(
+                responses, latency=options['latency'],
+                fault_rate=options['fault_rate'],
+                rate_limit=options['rate_limit'],
+                reset_interval=options['reset_interval']) as server:
+            api = replay.replay_api(server, options['tokens'],
+                                    options['concurrency'])
+            print(replay.benchmark(api, server, repos, scenarios,
+                                   options['issues'], options['workers']))
@@ -35,11 +35,13 @@ class Command(BaseCommand):
 
         def collect_scraper(package, url):
             logger.info(package)
-            try:
-                scraper.commits(url)
-            except scraper.RepoDoesNotExist:
-                logger.info("    %s: repo doesn't exist" % package)
-                return
-            scraper.issues(url)
+            # leave the reserved share of quota to ad-hoc lookups
+            with scraper.priority('bulk'):
+                try:
+                    scraper.commits(url)
+                except scraper.RepoDoesNotExist:
+                    logger.info("    %s: repo doesn't exist" % package)
+                    return
+                scraper.issues(url)
 
         mapreduce.map(collect_scraper, urls, num_workers=num_workers)
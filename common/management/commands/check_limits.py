@@ -2,25 +2,61 @@
 from __future__ import print_function, unicode_literals
 
 import datetime
+import json
+import os
+import time
 
+from django.conf import settings
 from django.core.management.base import BaseCommand
 import pandas as pd
 
 import scraper
+from scraper import metrics
 
 
 class Command(BaseCommand):
     requires_system_checks = False
     help = "Check limits on registered GitHub API keys"
 
-    def handle(self, *args, **options):
-        api = scraper.GitHubAPI()
+    def add_arguments(self, parser):
+        parser.add_argument('-w', '--watch', type=float, nargs='?', const=10,
+                            help='Refresh every WATCH seconds (10 if no '
+                                 'value given) until interrupted')
+        parser.add_argument('-m', '--metrics', type=str, default=getattr(
+                                settings, 'SCRAPER_GITHUB_METRICS_FILE', None),
+                            help='JSON metrics file exported by a running '
+                                 'crawl, to show its request stats')
+
+    @staticmethod
+    def crawl_stats(path):
+        # type: (str) -> dict
+        """ Read per-token request stats exported by a crawl, if any """
+        if not path or not path.endswith('.json') or not os.path.isfile(path):
+            return {}
+        with open(path) as fh:
+            data = json.load(fh)
+        stats = {}
+        for token in data['tokens']:
+            errors = sum(count for status, count in token['statuses'].items()
+                         if not status.startswith(('2', '3')))
+            stats[token['token']] = {
+                'requests': token['requests'],
+                'errors': errors,
+                'latency': token['latency_sum'] / max(token['requests'], 1),
+                'backoff': token['backoff_seconds'],
+            }
+        return stats
+
+    def table(self, api, crawl_stats):
         now = datetime.datetime.now()
 
-        df = pd.DataFrame(
-            columns=("core_limit", "core_remaining",
-                     "core_renews_in", "search_limit", "search_remaining",
-                     "search_renews_in", "key"))
+        columns = ["core_limit", "core_remaining",
+                   "core_renews_in", "search_limit", "search_remaining",
+                   "search_renews_in", "graphql_limit", "graphql_remaining",
+                   "graphql_renews_in", "key"]
+        if crawl_stats:
+            columns.extend(("requests", "errors", "latency", "backoff"))
+        df = pd.DataFrame(columns=columns)
         for token in api.tokens:
             # if limit is exhausted there is no way to get username
             user = token.user or "<unknown%d>" % len(df)
@@ -38,6 +74,16 @@ class Command(BaseCommand):
                 values[api_class + '_renews_in'] = renew
                 values[api_class + '_limit'] = token.limit[api_class]['limit']
                 values[api_class + '_remaining'] = token.limit[api_class]['remaining']
+            values.update(crawl_stats.get(metrics.token_label(token), {}))
             df.loc[user] = values
+        return df
 
-        print(df)
+    def handle(self, *args, **options):
+        # metrics file belongs to the crawl, don't overwrite it with ours
+        api = scraper.GitHubAPI(metrics_file=None)
+        while True:
+            print(self.table(api, self.crawl_stats(options['metrics'])))
+            if not options['watch']:
+                break
+            time.sleep(options['watch'])
+            print()
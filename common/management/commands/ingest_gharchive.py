@@ -0,0 +1,48 @@
+
+from __future__ import print_function, unicode_literals
+
+import logging
+import os
+
+from django.core.management.base import BaseCommand
+
+from common import utils as common
+import scraper
+from scraper import gharchive
+
+
+class Command(BaseCommand):
+    requires_system_checks = False
+    help = "Extract issues and timeline events of ecosystem packages from " \
+           "downloaded GH Archive files (http://data.gharchive.org/), " \
+           "without using GitHub API."
+
+    def add_arguments(self, parser):
+        parser.add_argument('ecosystem', type=str,
+                            help='Ecosystem to process, {pypi|npm}')
+        parser.add_argument('archives', nargs='+', type=str,
+                            help='GH Archive .json.gz files')
+        parser.add_argument('-o', '--output', default='.', type=str,
+                            help='Directory to write issues.csv and '
+                                 'timeline.csv to')
+        parser.add_argument('-w', '--workers', default=None, type=int,
+                            help='Number of processes, one per CPU by '
+                                 'default')
+
+    def handle(self, *args, **options):
+        # -v 3: DEBUG, 2: INFO, 1: WARNING (default), 0: ERROR
+        loglevel = 40 - 10 * options['verbosity']
+        logging.basicConfig(level=loglevel)
+
+        repos = []
+        for url in common.package_urls(options['ecosystem']):
+            provider, project_url = scraper.parse_url(url)
+            if provider == 'github.com':
+                repos.append(project_url)
+
+        issues, timeline = gharchive.ingest(
+            options['archives'], repos, options['workers'])
+        issues.to_csv(os.path.join(options['output'], 'issues.csv'),
+                      encoding='utf-8')
+        timeline.to_csv(os.path.join(options['output'], 'timeline.csv'),
+                        encoding='utf-8', index=False)
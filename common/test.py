@@ -1,8 +1,11 @@
 
 from __future__ import unicode_literals, print_function
 
-import unittest
+import os
 import random
+import shutil
+import tempfile
+import unittest
 
 import numpy as np
 import pandas as pd
@@ -10,6 +13,9 @@ import pandas as pd
 from common import decorators as d
 from common import mapreduce
 from common import threadpool
+from common import utils
+import scraper
+from scraper import cache
 
 
 def series(length):
@@ -58,6 +64,24 @@ class TestDecorators(unittest.TestCase):
 
         decorator.invalidate(cdataframe)
 
+    def test_fs_cache_update(self):
+        def frame(n):
+            return pd.DataFrame({'v': range(n)},
+                                index=pd.Index(range(n), name='k'))
+
+        def update(stale, n):
+            stale = stale.set_index('k')
+            stale['v'] += 1
+            return stale
+
+        # negative expiration time means cache is always expired
+        decorator = d.fs_cache('common', expires=-1, update=update)
+        cframe = decorator(frame)
+        self.assertEqual(list(cframe(3)['v']), [0, 1, 2])
+        self.assertEqual(list(cframe(3)['v']), [1, 2, 3])
+        self.assertEqual(list(cframe(3)['v']), [2, 3, 4])
+        decorator.invalidate(frame)
+
 
 class TestThreadpool(unittest.TestCase):
 
@@ -82,5 +106,42 @@ class TestThreadpool(unittest.TestCase):
         self.assertEqual(sum(response), sum(results))
 
 
+class TestUtils(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_package_urls_redirects(self):
+        class Ecosystem(object):
+            @staticmethod
+            def packages_info():
+                return pd.DataFrame(
+                    {'url': ['https://github.com/Old/Name.git',
+                             'github.com/a/b']},
+                    index=pd.Index(['moved', 'kept'], name='name'))
+
+        provider = scraper.PROVIDERS['github.com']
+        redirects = provider.redirects
+        provider.redirects = cache.RedirectMap(
+            os.path.join(self.tmpdir, 'redirects.sqlite'))
+        provider.redirects.put('old/name', 'repositories/1', 'New/Name')
+        provider.project_exists = lambda project_url: True  # no network
+        utils.ECOSYSTEMS['test'] = Ecosystem
+        fname = utils.fs_cache.get_cache_fname('package_urls', 'test')
+        try:
+            urls = utils.package_urls('test')
+            self.assertEqual(urls['moved'], 'github.com/new/name')
+            self.assertEqual(urls['kept'], 'github.com/a/b')
+        finally:
+            provider.redirects = redirects
+            del provider.project_exists
+            del utils.ECOSYSTEMS['test']
+            if os.path.isfile(fname):
+                os.remove(fname)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -104,9 +104,10 @@ def package_urls(ecosystem):
     urls = urls[urls.map(supported)]
 
     # this part normalizes URLs, e.g. by removing trailing .git from GitHub URLs
+    # renamed and transferred repositories seen by the scraper get new names
     def normalize(url):
         provider, project_url = scraper.get_provider(url)
-        return provider.canonical_url(project_url)
+        return provider.canonical_url(provider.canonical_name(project_url))
 
     urls = urls.map(normalize)
 
@@ -217,7 +218,7 @@ def user_info(ecosystem):
         provider_name, _ = scraper.parse_url(row["url"])
         provider, _ = scraper.get_provider(row["url"])
         try:
-            data = provider.user_info(username)
+            data = provider.user_info(username, fields)
         except scraper.RepoDoesNotExist:
             return {}
         res = {field: data.get(field) for field in fields}
@@ -232,6 +233,13 @@ def user_info(ecosystem):
     # it's going to be a pd.DataFrame(provider_name, login, url)
     usernames = get_repo_usernames(urls).reset_index()
 
+    # GraphQL API fetches a batch of GitHub profiles in a single request;
+    # get_user_info() below will find them in the profile cache, except
+    # for organizations (GraphQL doesn't count their followers) and
+    # accounts GraphQL doesn't resolve, e.g. bots
+    scraper.github.GitHubAPIv4().warm_profiles(
+        usernames.loc[usernames["provider_name"] == "github.com", "login"])
+
     # ensure uniqueness of (provider, login) pairs to avoid extra requests
     # GitHub seems to ban IP (will get HTTP 403) if use 8 workers
     ui = mapreduce.map(
@@ -617,8 +625,10 @@ def contributors(ecosystem, months=1):
 
         def gen():
             log = logging.getLogger("ghd.common._contributors")
+            urls = package_urls(ecosystem)
+            scraper.warm_contributor_stats(urls)
 
-            for package, repo in package_urls(ecosystem).items():
+            for package, repo in urls.items():
                 log.info(package)
                 try:
                     s = scraper.commit_user_stats(repo).reset_index()[
@@ -759,6 +769,10 @@ def monthly_data(ecosystem, feature):
         return full_handlers[feature](ecosystem).T.reindex(
             idx, fill_value=0).T.reindex(urls.index, fill_value=0)
     elif feature in project_handlers:
+        if feature in ('commits', 'contributors', 'q50', 'q70', 'q90',
+                       'gini'):  # handlers using commit_user_stats
+            scraper.warm_contributor_stats(urls)
+
         def gen():
             log = logging.getLogger(feature)
             for project_name, url in urls.items():
@@ -13,12 +13,14 @@ fab.env.hosts = settings.DEPLOY_HOSTS
 def test():
     with fab.settings(warn_only=True):
         fab.local("python -m unittest common.test")
+        fab.local("python -m unittest scraper.test")
         fab.local("python -m doctest common/email_utils.py")
         fab.local("python -m doctest common/utils.py")
         fab.local("python -m doctest common/mapreduce.py")
         fab.local("python -m doctest common/versions.py")
         fab.local("python -m doctest pypi/utils.py")
         fab.local("python -m doctest scraper/utils.py")
+        fab.local("python -m doctest scraper/cache.py")
 
 
 def clean():
@@ -12,12 +12,17 @@ api = scraper.GitHubAPI()
 
 fs_cache = d.fs_cache('shurui_commitFiles')
 
+# sha: changed files, fetched in bulk by api.commits_changedFiles
+changed_files = {}
 
 
 @fs_cache
 def get_commit_changedFile(repo, issue):
     print("get reference of pr %s from %s" % (repo, issue))
-    return pd.DataFrame(api.commit_changedFile(repo, issue))
+    files = changed_files.pop(issue, None)
+    if files is None:
+        files = api.commit_changedFile(repo, issue)
+    return pd.DataFrame(files)
 
 
 def RepresentsInt(s):
@@ -55,10 +60,16 @@ if __name__ == "__main__":
         # query = ("SELECT prc.sha FROM fork.PR_Commit_map prc RIGHT JOIN fork.Final f ON prc.projectID = f.repoID WHERE f.repoURL = %s AND prc.sha NOT in(SELECT fork.commit_files_GHAPI.sha  FROM fork.commit_files_GHAPI)")
         query = ("SELECT prc.sha FROM fork.PR_Commit_map prc   RIGHT JOIN fork.Final f ON prc.projectID = f.repoID   RIGHT JOIN fork.Pull_Request pr on prc.projectID = pr.projectID and prc.pull_request_id = pr.pull_request_ID WHERE f.repoURL =  %s and pr.closed = 'true' AND prc.sha NOT IN (SELECT fork.commit_files_GHAPI.sha FROM fork.commit_files_GHAPI) ")
         cursor.execute(query, [repo])
-
-        for (sha) in cursor:
-            print("%s : %s" % (repo, sha[0]))
-            get_commit_changedFile(repo, sha[0])
+        shas = [sha for (sha,) in cursor]
+        # prefetch files of commits missing from the cache
+        changed_files.update(api.commits_changedFiles(repo, [
+            sha for sha in shas if fs_cache.expired(
+                fs_cache.get_cache_fname('get_commit_changedFile', repo,
+                                         sha))]))
+
+        for sha in shas:
+            print("%s : %s" % (repo, sha))
+            get_commit_changedFile(repo, sha)
         cursor.close()
         cnx.close()
 
@@ -1,3 +1,3 @@
 
 from scraper.utils import *
-from scraper.github import GitHubAPI, RepoDoesNotExist
+from scraper.github import GitHubAPI, RepoDoesNotExist, priority
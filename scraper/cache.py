@@ -0,0 +1,482 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+import requests
+
+try:
+    from urllib import urlencode
+except ImportError:  # Python 3
+    from urllib.parse import urlencode
+
+from common import decorators
+
+CACHE_PATH = decorators.mkdir(decorators.DATASET_PATH, "scraper.cache")
+
+
+def default_path(fname):
+    # type: (str) -> str
+    return os.path.join(CACHE_PATH, fname)
+
+
+def request_key(url, params=None):
+    # type: (str, dict) -> str
+    """ Normalized representation of a request, used as a cache key
+    >>> request_key("repos/a/b/issues", {'state': 'all', 'page': 2})
+    'repos/a/b/issues?page=2&state=all'
+    >>> request_key("users/a")
+    'users/a'
+    """
+    if not params:
+        return url
+    return url + "?" + urlencode(sorted(params.items()))
+
+
+class SqliteStore(object):
+    """ Base class for persistent stores kept in a sqlite database.
+    A single connection is shared by all threads and guarded by a lock;
+    sqlite itself takes care of concurrent access from several processes.
+    Subclasses define `schema`, a CREATE TABLE statement.
+
+    The database is only opened on first use, so creating a store (e.g. by
+    GitHubAPI when `scraper` is imported) doesn't touch the disk. Stores
+    supporting purge() drop entries older than `max_age` seconds, if given,
+    once opened.
+    """
+    schema = None
+
+    def __init__(self, path, max_age=None):
+        self.path = path
+        self.max_age = max_age
+        # reentrant, so that _opened() can run queries
+        self._lock = threading.RLock()
+        self._conn = None
+
+    def _connection(self):
+        # type: () -> sqlite3.Connection
+        """ Open the database if not yet; must be called with the lock """
+        if self._conn is None:
+            # isolation_level=None means autocommit
+            self._conn = sqlite3.connect(
+                self.path, timeout=60, check_same_thread=False,
+                isolation_level=None)
+            self._conn.execute(self.schema)
+            self._opened()
+        return self._conn
+
+    def _opened(self):
+        """ Prepare a freshly opened database """
+        if self.max_age is not None:
+            self.purge(self.max_age)
+
+    def execute(self, query, *args):
+        with self._lock:
+            return self._connection().execute(query, args).fetchall()
+
+    def update(self, query, *args):
+        """ Execute a data modifying query, return number of affected rows
+        """
+        with self._lock:
+            return self._connection().execute(query, args).rowcount
+
+
+class ETagCache(SqliteStore):
+    """ Validators (ETag, Last-Modified) and bodies of GET responses.
+    GitHub answers conditional requests with 304 Not Modified, which doesn't
+    count against the rate limit, so refreshing unchanged data is free.
+
+    If `bodies` (a ResponseCache) is given, bodies are not stored here;
+    they are read from there, under the same request key, instead.
+    """
+    schema = """CREATE TABLE IF NOT EXISTS etags (
+        key TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, link TEXT,
+        body BLOB, updated REAL)"""
+
+    def __init__(self, path, bodies=None, max_age=None):
+        super(ETagCache, self).__init__(path, max_age)
+        self.bodies = bodies
+
+    def get(self, url, params):
+        # type: (str, dict) -> dict
+        rows = self.execute(
+            "SELECT etag, last_modified, link, body FROM etags WHERE key=?",
+            request_key(url, params))
+        if not rows:
+            return None
+        etag, last_modified, link, body = rows[0]
+        if body is not None:
+            body = zlib.decompress(bytes(body))
+        elif self.bodies is not None:
+            # expired responses are still good to revalidate
+            response = self.bodies.get(url, params)
+            if response is None:  # purged
+                return None
+            body = response.content
+        else:
+            return None
+        return {
+            'etag': etag,
+            'last_modified': last_modified,
+            'link': link,
+            'body': body
+        }
+
+    def put(self, url, params, response):
+        # type: (str, dict, requests.Response) -> None
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if not etag and not last_modified:
+            return
+        body = None
+        if self.bodies is None:
+            body = sqlite3.Binary(zlib.compress(response.content))
+        self.execute(
+            "INSERT OR REPLACE INTO etags VALUES (?, ?, ?, ?, ?, ?)",
+            request_key(url, params), etag, last_modified,
+            response.headers.get('Link'), body, time.time())
+
+    def purge(self, ttl):
+        # type: (float) -> None
+        """ Remove validators older than `ttl` seconds """
+        self.execute("DELETE FROM etags WHERE updated<=?", time.time() - ttl)
+
+    @staticmethod
+    def conditional_headers(entry):
+        # type: (dict) -> dict
+        headers = {}
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def revalidate(self, url, params, response, entry):
+        # type: (str, dict, requests.Response, dict) -> requests.Response
+        """ Turn 304 Not Modified response into the cached 200 OK.
+        The validator is as good as new then, so it is not purged before
+        it stops being used. """
+        self.execute("UPDATE etags SET updated=? WHERE key=?",
+                     time.time(), request_key(url, params))
+        response.status_code = 200
+        response._content = entry['body']
+        if entry['link'] and 'Link' not in response.headers:
+            response.headers['Link'] = entry['link']
+        return response
+
+
+class ProfileCache(SqliteStore):
+    """ User and organization profiles by login (case insensitive).
+    Accounts that don't exist are stored as empty dicts, so that they are
+    not requested over and over again either.
+
+    Partial profiles have only some of REST API fields, e.g. those made of
+    GraphQL API results; they are only good for callers needing no more.
+    """
+    schema = """CREATE TABLE IF NOT EXISTS profiles (
+        login TEXT PRIMARY KEY, profile TEXT, partial INTEGER, updated REAL)"""
+
+    def get(self, login, ttl, fields=None):
+        # type: (str, float, Iterable[str]) -> dict
+        """ Get a profile not older than `ttl` seconds, None if there is no
+        such profile. Partial profiles are only returned if they have all
+        of `fields`, never if `fields` is None """
+        rows = self.execute(
+            "SELECT profile, partial FROM profiles WHERE login=? AND updated>?",
+            login.lower(), time.time() - ttl)
+        if not rows:
+            return None
+        profile = json.loads(rows[0][0])
+        if rows[0][1] and (fields is None or
+                           not all(field in profile for field in fields)):
+            return None
+        return profile
+
+    def put(self, login, profile, partial=False):
+        # type: (str, dict, bool) -> None
+        self.execute("INSERT OR REPLACE INTO profiles VALUES (?, ?, ?, ?)",
+                     login.lower(), json.dumps(profile or {}), int(partial),
+                     time.time())
+
+    def missing(self, logins, ttl):
+        # type: (Iterable[str], float) -> list
+        """ Filter out logins having a profile not older than `ttl` """
+        fresh = {login for login, in self.execute(
+            "SELECT login FROM profiles WHERE updated>?", time.time() - ttl)}
+        return sorted({login for login in logins
+                       if login.lower() not in fresh})
+
+
+class ResponseCache(SqliteStore):
+    """ Raw bodies of successful GET responses, one per request (URL,
+    parameters and page). Parsers needing other fields or other projections
+    of already downloaded data don't have to go to the network again.
+
+    Pages of a list are only good together: later pages remember the fetch
+    time of the first page (`snapshot`), and are not served as fresh once
+    the first page is fetched again. Otherwise a list could be put together
+    from pages cached at different times, with items lost or repeated.
+    """
+    schema = """CREATE TABLE IF NOT EXISTS responses (
+        key TEXT PRIMARY KEY, link TEXT, body BLOB, updated REAL,
+        snapshot REAL)"""
+
+    @staticmethod
+    def _first_page(params):
+        # type: (dict) -> dict
+        """ Parameters of the first page of the same list, or None if
+        `params` don't request a later page """
+        if int((params or {}).get('page', 1)) <= 1:
+            return None
+        return dict(params, page=1)
+
+    def get(self, url, params, ttl=None):
+        # type: (str, dict, float) -> requests.Response
+        """ Get a response not older than `ttl` seconds and, for later pages
+        of a list, from the same snapshot as the cached first page.
+        If ttl is None, get a response of any age; or None """
+        rows = self.execute(
+            "SELECT link, body, updated, snapshot FROM responses WHERE key=?",
+            request_key(url, params))
+        if not rows:
+            return None
+        link, body, updated, snapshot = rows[0]
+        if ttl is not None:
+            first_page = self._first_page(params)
+            if first_page is not None:
+                first = self.execute(
+                    "SELECT updated FROM responses WHERE key=?",
+                    request_key(url, first_page))
+                updated = first and first[0][0]
+                if not first or snapshot != updated:
+                    return None
+            if updated <= time.time() - ttl:
+                return None
+        response = requests.Response()
+        response.status_code = 200
+        response._content = zlib.decompress(bytes(body))
+        if link:
+            response.headers['Link'] = link
+        return response
+
+    def put(self, url, params, response):
+        # type: (str, dict, requests.Response) -> None
+        now = time.time()
+        snapshot = now
+        first_page = self._first_page(params)
+        if first_page is not None:
+            first = self.execute("SELECT updated FROM responses WHERE key=?",
+                                 request_key(url, first_page))
+            snapshot = first[0][0] if first else None
+        self.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+            request_key(url, params), response.headers.get('Link'),
+            sqlite3.Binary(zlib.compress(response.content)), now, snapshot)
+
+    def purge(self, ttl):
+        # type: (float) -> None
+        """ Remove responses older than `ttl` seconds """
+        self.execute("DELETE FROM responses WHERE updated<=?",
+                     time.time() - ttl)
+
+
+class RateLimitLedger(SqliteStore):
+    """ Rate limits of tokens shared by all processes on the host.
+
+    Every process reserves a request in the ledger before making it and
+    records the limits reported by GitHub afterwards, so that concurrent
+    scripts using the same tokens don't drain the same quota all at once.
+    `remaining` is the quota reported by the latest response, `reserved`
+    is the number of requests in flight that it doesn't account for yet.
+    Tokens are identified by a hash, not stored as is.
+    """
+    schema = """CREATE TABLE IF NOT EXISTS ledger (
+        key TEXT, api_class TEXT, remaining INTEGER, reset_time INTEGER,
+        reserved INTEGER DEFAULT 0, backoff_until REAL DEFAULT 0,
+        updated REAL, PRIMARY KEY (key, api_class))"""
+
+    def _opened(self):
+        # a write per request is too much for the default rollback journal
+        self.execute("PRAGMA journal_mode=WAL")
+        self.execute("PRAGMA synchronous=NORMAL")
+
+    @staticmethod
+    def key(token):
+        # type: (GitHubAPIToken) -> str
+        return hashlib.sha1(token.token.encode('utf8')).hexdigest()
+
+    def _ensure(self, key, api_class):
+        self.execute("INSERT OR IGNORE INTO ledger (key, api_class, updated) "
+                     "VALUES (?, ?, ?)", key, api_class, time.time())
+
+    def reserve(self, token, api_class):
+        # type: (GitHubAPIToken, str) -> bool
+        """ Take one request from the token quota, if there is any left.
+        If not, token.limit and token.backoff_until are updated with what
+        other processes learned, so that the token is rescheduled.
+        """
+        key = self.key(token)
+        now = time.time()
+        self._ensure(key, api_class)
+        # unknown quota or expired reset time mean the quota is likely full
+        if self.update(
+                "UPDATE ledger SET "
+                "remaining = CASE WHEN reset_time <= ? THEN NULL "
+                "ELSE remaining END, "
+                "reserved = CASE WHEN reset_time <= ? THEN 1 "
+                "ELSE reserved + 1 END "
+                "WHERE key=? AND api_class=? AND backoff_until <= ? AND ("
+                "remaining IS NULL OR remaining > reserved "
+                "OR reset_time <= ?)",
+                now, now, key, api_class, now, now):
+            return True
+
+        remaining, reserved, reset_time, backoff_until = self.execute(
+            "SELECT remaining, reserved, reset_time, backoff_until "
+            "FROM ledger WHERE key=? AND api_class=?", key, api_class)[0]
+        if remaining is not None and remaining <= reserved:
+            token.limit[api_class] = dict(
+                token.limit[api_class], remaining=0, reset_time=reset_time)
+        token.backoff_until = max(token.backoff_until, backoff_until)
+        return False
+
+    def record(self, token, api_class):
+        # type: (GitHubAPIToken, str) -> None
+        """ Save limits reported by GitHub in response to a reserved request,
+        which is not counted as reserved anymore """
+        limit = token.limit[api_class]
+        key = self.key(token)
+        self._ensure(key, api_class)
+        self.execute(
+            "UPDATE ledger SET remaining = ?, "
+            "reserved = CASE WHEN reset_time = ? THEN MAX(reserved - 1, 0) "
+            "ELSE 0 END, reset_time = ?, updated = ? "
+            "WHERE key=? AND api_class=?",
+            limit['remaining'], limit['reset_time'], limit['reset_time'],
+            time.time(), key, api_class)
+
+    def release(self, token, api_class):
+        # type: (GitHubAPIToken, str) -> None
+        """ Cancel a reservation of a request that failed or didn't report
+        limits """
+        self.execute(
+            "UPDATE ledger SET reserved = MAX(reserved - 1, 0) "
+            "WHERE key=? AND api_class=?", self.key(token), api_class)
+
+    def backoff(self, token):
+        # type: (GitHubAPIToken) -> None
+        """ Share token quarantine (see GitHubAPIToken.backoff) """
+        self.execute(
+            "UPDATE ledger SET backoff_until = MAX(backoff_until, ?) "
+            "WHERE key=?", token.backoff_until, self.key(token))
+
+
+class CheckpointJournal(SqliteStore):
+    """ Progress of paginated crawls, so that interrupted ones can resume.
+
+    An entry is kept per crawl, e.g. per endpoint and repository, until the
+    crawl completes. `position` is the last page number or GraphQL cursor
+    consumed by the caller and `rows` is the number of items fetched up to
+    it. Crawls spilling items to a file (see GitHubAPI.iter_pages) also
+    keep the file size before the crawl (`start`) and after the last
+    consumed page (`end`), so that the pages can be read back from it.
+    """
+    schema = """CREATE TABLE IF NOT EXISTS checkpoints (
+        key TEXT PRIMARY KEY, position TEXT, rows INTEGER, spill TEXT,
+        start INTEGER, end INTEGER, updated REAL)"""
+
+    def get(self, key):
+        # type: (str) -> dict
+        rows = self.execute(
+            "SELECT position, rows, spill, start, end FROM checkpoints "
+            "WHERE key=?", key)
+        if not rows:
+            return None
+        return dict(zip(('position', 'rows', 'spill', 'start', 'end'),
+                        rows[0]))
+
+    def put(self, key, position, rows, spill=None, start=None, end=None):
+        # type: (str, object, int, str, int, int) -> None
+        self.execute(
+            "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?, ?)",
+            key, str(position), rows, spill, start, end, time.time())
+
+    def delete(self, key):
+        # type: (str) -> None
+        self.execute("DELETE FROM checkpoints WHERE key=?", key)
+
+
+class RedirectMap(SqliteStore):
+    """ Repositories known to be renamed or transferred.
+    GitHub redirects requests to the old name to repositories/<id> URLs.
+    Requests to these repositories can go there directly, saving a round
+    trip; the new name is stored once known.
+    """
+    schema = """CREATE TABLE IF NOT EXISTS redirects (
+        name TEXT PRIMARY KEY, target TEXT, full_name TEXT, updated REAL)"""
+
+    @staticmethod
+    def key(repo_name):
+        # type: (str) -> str
+        """
+        >>> RedirectMap.key('Owner/Repo.git')
+        'owner/repo'
+        """
+        key = repo_name.lower()
+        return key[:-4] if key.endswith('.git') else key
+
+    def get(self, repo_name):
+        # type: (str) -> (str, str)
+        """ Get (target, new name or None) of a moved repository, or None """
+        rows = self.execute(
+            "SELECT target, full_name FROM redirects WHERE name=?",
+            self.key(repo_name))
+        return tuple(rows[0]) if rows else None
+
+    def put(self, repo_name, target, full_name=None):
+        # type: (str, str, str) -> None
+        self.execute("INSERT OR REPLACE INTO redirects VALUES (?, ?, ?, ?)",
+                     self.key(repo_name), target, full_name, time.time())
+
+    def names(self):
+        # type: () -> dict
+        """ {old name: new name} of all moved repositories with known names
+        """
+        return dict(self.execute(
+            "SELECT name, full_name FROM redirects "
+            "WHERE full_name IS NOT NULL"))
+
+
+class NegativeCache(SqliteStore):
+    """ Requests answered with nothing: deleted or blocked repositories and
+    accounts (404, 410, 451) or empty repositories (409). Unlike other
+    responses, these are kept for a short time, since they are cheap to
+    store and the most likely to change. `result` is what GitHubAPI made
+    of the response, stored as JSON.
+    """
+    schema = """CREATE TABLE IF NOT EXISTS missing (
+        key TEXT PRIMARY KEY, status INTEGER, result TEXT, updated REAL)"""
+
+    def get(self, url, params, ttl):
+        # type: (str, dict, float) -> (int, object)
+        """ Get (HTTP status, result) not older than `ttl` seconds, or None
+        """
+        rows = self.execute(
+            "SELECT status, result FROM missing WHERE key=? AND updated>?",
+            request_key(url, params), time.time() - ttl)
+        return (rows[0][0], json.loads(rows[0][1])) if rows else None
+
+    def put(self, url, params, status, result):
+        # type: (str, dict, int, object) -> None
+        self.execute("INSERT OR REPLACE INTO missing VALUES (?, ?, ?, ?)",
+                     request_key(url, params), status, json.dumps(result),
+                     time.time())
+
+    def purge(self, ttl):
+        # type: (float) -> None
+        """ Remove entries older than `ttl` seconds """
+        self.execute("DELETE FROM missing WHERE updated<=?",
+                     time.time() - ttl)
@@ -0,0 +1,182 @@
+""" Offline source of issue events: GH Archive (https://www.gharchive.org/)
+hourly dumps, e.g. http://data.gharchive.org/2018-01-01-15.json.gz
+
+Archive files are downloaded once and read locally, so no API quota is
+spent. ingest() scans them in parallel processes, keeps events of the
+given repositories and builds:
+
+- issues, in the format of scraper.utils.issues, indexed by repo and number
+- timeline events, in the format of GitHubAPI.issue_pr_timeline with
+    extra repo_name and issue columns
+
+Archive events are translated into their timeline API counterparts, so
+that github.TIMELINE_SPEC applies to them as is. Note that the archive only
+has what happened in the hours it covers, and events of older archives
+(before 2015) lack the payload details used here.
+"""
+
+import functools
+import gzip
+import json
+import logging
+import multiprocessing
+
+import pandas as pd
+
+from scraper import github
+from scraper import utils
+
+logger = logging.getLogger('ghd.scraper')
+
+
+def _event(event, name, **fields):
+    # type: (dict, str) -> dict
+    """ Build a timeline event acted by the archive event actor """
+    fields.setdefault('created_at', event['created_at'])
+    return dict(fields, event=name, actor=event.get('actor'), commit_id=None)
+
+
+def _issues_event(event):
+    payload = event['payload']
+    action = payload.get('action')
+    if action in ('closed', 'reopened', 'labeled', 'unlabeled', 'assigned',
+                  'unassigned'):
+        yield payload['issue']['number'], _event(
+            event, action, label=payload.get('label'),
+            assignee=payload.get('assignee'))
+
+
+def _pull_request_event(event):
+    payload = event['payload']
+    action = payload.get('action')
+    pr = payload['pull_request']
+    if action == 'closed' and pr.get('merged'):
+        yield pr['number'], dict(_event(event, 'merged'),
+                                 commit_id=pr.get('merge_commit_sha'))
+    if action in ('closed', 'reopened', 'labeled', 'unlabeled', 'assigned',
+                  'unassigned'):
+        yield pr['number'], _event(event, action, label=payload.get('label'),
+                                   assignee=payload.get('assignee'))
+
+
+def _comment_event(event):
+    payload = event['payload']
+    comment = payload['comment']
+    if payload.get('action') == 'created':
+        yield payload['issue']['number'], _event(
+            event, 'commented', user=comment.get('user'),
+            author_association=comment.get('author_association'),
+            body=comment.get('body'), created_at=comment['created_at'])
+
+
+def _review_event(event):
+    payload = event['payload']
+    review = payload['review']
+    yield payload['pull_request']['number'], _event(
+        event, 'reviewed', user=review.get('user'), state=review.get('state'),
+        author_association=review.get('author_association'),
+        body=review.get('body'),
+        created_at=review.get('submitted_at') or event['created_at'])
+
+
+# archive event type: function(event) -> Iterable[(number, timeline event)]
+ARCHIVE_EVENTS = {
+    'IssuesEvent': _issues_event,
+    'PullRequestEvent': _pull_request_event,
+    'IssueCommentEvent': _comment_event,
+    'PullRequestReviewEvent': _review_event,
+}
+
+
+def read_archive(path):
+    # type: (str) -> Iterable[dict]
+    """ Iterate events of a .json.gz archive file.
+    Truncated files (e.g. interrupted downloads) yield what was read
+    """
+    with gzip.open(path, 'rb') as fh:
+        try:
+            for line in fh:
+                try:
+                    yield json.loads(line.decode('utf8'))
+                except ValueError:
+                    logger.warning("%s: skipping malformed event", path)
+        except (IOError, EOFError) as e:
+            logger.warning("%s: %s", path, e)
+
+
+def scan(path, repos=None):
+    # type: (str, dict) -> (dict, list)
+    """ Extract issues and timeline events of the given repositories from
+    an archive file
+    :param repos: {lowercase repo name: repo name} or None for all repos
+    :return: ({(repo, number): issue record}, [(repo, number, event)])
+    """
+    issues = {}
+    events = []
+    for event in read_archive(path):
+        handler = ARCHIVE_EVENTS.get(event.get('type'))
+        if handler is None or not isinstance(event.get('payload'), dict):
+            continue
+        repo = (event.get('repo') or {}).get('name') or ''
+        if repos is not None:
+            repo = repos.get(repo.lower())
+            if repo is None:
+                continue
+
+        issue = event['payload'].get('issue')
+        if isinstance(issue, dict) and 'pull_request' not in issue \
+                and 'updated_at' in issue:
+            key = (repo, issue['number'])
+            if key not in issues or \
+                    issues[key]['updated_at'] <= issue['updated_at']:
+                issues[key] = github.GitHubAPI._issue_record(issue)
+        try:
+            events.extend((repo, number, timeline_event)
+                          for number, timeline_event in handler(event))
+        except (KeyError, TypeError):  # older payload format
+            continue
+    return issues, events
+
+
+def ingest(paths, repos=None, num_workers=None):
+    # type: (Iterable[str], Iterable[str], int) -> tuple
+    """ Build issues and timeline frames out of archive files
+    :param paths: .json.gz archive files
+    :param repos: names of repos to keep, owner/name; None to keep all
+    :param num_workers: number of processes, by default one per CPU
+    :return: (issues, timeline) - issues are indexed by (repo, number) and
+        have the columns of scraper.utils.issues; timeline has repo_name
+        and issue columns followed by github.TIMELINE_COLUMNS, in order of
+        time
+    """
+    if repos is not None:
+        repos = {repo.lower(): repo for repo in repos}
+    paths = list(paths)
+
+    issues = {}
+    events = []
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        for path, (file_issues, file_events) in zip(paths, pool.imap(
+                functools.partial(scan, repos=repos), paths)):
+            logger.info("%s: %d issues, %d events", path, len(file_issues),
+                        len(file_events))
+            for key, record in file_issues.items():
+                if key not in issues or \
+                        issues[key]['updated_at'] <= record['updated_at']:
+                    issues[key] = record
+            events.extend(file_events)
+    finally:
+        pool.terminate()
+
+    issues_df = pd.DataFrame(
+        [dict(record, repo=repo) for (repo, _), record in issues.items()],
+        columns=['repo'] + utils.ISSUE_COLUMNS)
+    issues_df = issues_df.sort_values(['repo', 'number']).set_index(
+        ['repo', 'number'], drop=True)
+
+    events.sort(key=lambda e: (e[0], e[1], e[2]['created_at']))
+    timeline = github.extract_timeline(event for _, _, event in events)
+    timeline.insert(0, 'issue', [number for _, number, _ in events])
+    timeline.insert(0, 'repo_name', [repo for repo, _, _ in events])
+    return issues_df, timeline
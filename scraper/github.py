@@ -1,10 +1,27 @@
 import requests
+import pandas as pd
 import time
-from datetime import datetime
+import collections
+import contextlib
+import heapq
+import itertools
 import json
 import logging
+import os
+import re
+import threading
+from datetime import datetime, timedelta
 from typing import Iterable
-from random import randint
+import random
+
+try:
+    import Queue as queue
+except ImportError:  # Python 3
+    import queue
+
+from scraper import cache
+from scraper import metrics
+from scraper import scheduler
 
 try:
     import settings
@@ -12,9 +29,79 @@ except ImportError:
     settings = object()
 
 _tokens = getattr(settings, "SCRAPER_GITHUB_API_TOKENS", [])
+# max number of simultaneous requests per token; it is also the size of
+# connection pool kept alive by every token session
+_concurrency = getattr(settings, "SCRAPER_GITHUB_API_CONCURRENCY", 4)
+# spread every token's quota evenly over its reset window. This caps tokens
+# at their average quota rate, so it only helps crawls that would use up
+# the quota anyway; off by default
+_pacing = getattr(settings, "SCRAPER_GITHUB_API_PACING", False)
+# share of every token's quota reserved for higher priority classes,
+# e.g. {'bulk': 0.2} keeps the last 20% for interactive and normal requests
+_quota_reserve = getattr(settings, "SCRAPER_GITHUB_QUOTA_RESERVE",
+                         {'bulk': 0.2})
+# path to ETag store used for conditional requests; set to None to disable
+_etag_cache = getattr(settings, "SCRAPER_GITHUB_ETAG_CACHE",
+                      cache.default_path("etags.sqlite"))
+# raw bodies of GET responses, to rerun parsers offline; None to disable
+_response_cache = getattr(settings, "SCRAPER_GITHUB_RESPONSE_CACHE",
+                          cache.default_path("responses.sqlite"))
+# responses older than this many seconds are requested again
+_response_ttl = getattr(settings, "SCRAPER_GITHUB_RESPONSE_TTL",
+                        7 * 24 * 3600)
+# expired responses and ETags are kept for this many seconds since they
+# were last used, to revalidate them for free; older ones are purged.
+# It has to be well over the 3 month refresh cycle of fs_cache
+# (common.decorators.DEFAULT_EXPIRY), or validators are gone by then
+_response_max_age = getattr(settings, "SCRAPER_GITHUB_RESPONSE_MAX_AGE",
+                            365 * 24 * 3600)
+# progress of crawls interrupted midway, see GitHubAPI.iter_pages(checkpoint)
+_checkpoints = getattr(settings, "SCRAPER_GITHUB_CHECKPOINTS",
+                       cache.default_path("checkpoints.sqlite"))
+# renamed and transferred repositories; set to None to disable
+_redirects = getattr(settings, "SCRAPER_GITHUB_REDIRECTS",
+                     cache.default_path("redirects.sqlite"))
+# rate limits shared by all processes on the host; set to None to disable
+_ledger = getattr(settings, "SCRAPER_GITHUB_LEDGER",
+                  cache.default_path("ledger.sqlite"))
+# file to export per-token metrics to during crawls, JSON if it ends with
+# .json, Prometheus textfile format otherwise; None to disable
+_metrics_file = getattr(settings, "SCRAPER_GITHUB_METRICS_FILE", None)
+# requests answered with 404, 409, 410 or 451; set to None to disable
+_negative_cache = getattr(settings, "SCRAPER_GITHUB_NEGATIVE_CACHE",
+                          cache.default_path("missing.sqlite"))
+# such answers are trusted for this many seconds, and purged afterwards
+_negative_ttl = getattr(settings, "SCRAPER_GITHUB_NEGATIVE_TTL", 24 * 3600)
+# user profiles shared by all user lookups; set to None to disable
+_profile_cache = getattr(settings, "SCRAPER_GITHUB_PROFILE_CACHE",
+                         cache.default_path("profiles.sqlite"))
+# profiles older than this many seconds are requested again
+_profile_ttl = getattr(settings, "SCRAPER_GITHUB_PROFILE_TTL", 30 * 24 * 3600)
 
 logger = logging.getLogger('ghd.scraper')
 
+# responses worth retrying after a pause, see GitHubAPIToken.backoff()
+RETRY_STATUSES = (443, 500, 502, 503, 504)
+BACKOFF_BASE = 1  # seconds; the first retry waits up to 2*BACKOFF_BASE
+BACKOFF_CAP = 300
+# GitHub doesn't always say how long a secondary rate limit lasts;
+# the docs advise to wait at least a minute
+SECONDARY_LIMIT_WAIT = 60
+# Search API doesn't return results beyond this number, see search()
+SEARCH_LIMIT = 1000
+SEARCH_EPOCH = datetime(2007, 10, 1)  # nothing on GitHub is older
+# statistics endpoints answer 202 while the numbers are being computed;
+# such requests are retried after 2, 4, 8... seconds, see repos_stats()
+STATS_RETRY_DELAY = 2
+STATS_ATTEMPTS = 7
+# GraphQL queries failed as a whole (e.g. timed out or rate limited) are
+# retried with exponential backoff, see GitHubAPIv4._aliased()
+GRAPHQL_ATTEMPTS = 3
+
+
+# owner/name and the rest of repository API URLs
+_REPO_URL = re.compile(r'repos/([^/]+/[^/]+)(/.*)?$')
+
 
 class RepoDoesNotExist(requests.HTTPError):
     pass
@@ -24,6 +111,17 @@ class TokenNotReady(requests.HTTPError):
     pass
 
 
+class StatsNotReady(requests.HTTPError):
+    """ GitHub is still computing repository statistics (HTTP 202) """
+    pass
+
+
+class GraphQLError(requests.HTTPError):
+    """ GraphQL query or some of its nodes failed for a reason other than
+    missing data """
+    pass
+
+
 def parse_commit(commit):
     github_author = commit['author'] or {}
     commit_author = commit['commit'].get('author') or {}
@@ -40,17 +138,220 @@ def parse_commit(commit):
     }
 
 
+TIMELINE_COLUMNS = (
+    'event', 'author', 'email', 'author_type', 'author_association',
+    'commit_id', 'created_at', 'id', 'repo', 'type', 'state', 'assignees',
+    'label', 'body')
+# few distinct values, stored as pandas categoricals
+TIMELINE_CATEGORICAL = ('event', 'type')
+
+_ACTOR = {'author': 'actor.login', 'author_type': 'actor.type'}
+_USER = {'author': 'user.login', 'author_type': 'user.type',
+         'author_association': 'author_association'}
+
+# event: (type, {column: dotted path to the value in the event JSON})
+# type is either a string or a function of the event. Columns not mentioned
+# are empty strings; 'event' and 'created_at' are always extracted.
+# Events not listed here get only these two columns.
+TIMELINE_SPEC = {
+    'cross-referenced': (
+        lambda event: 'pull_request' if 'pull_request' in
+        event['source']['issue'] else 'issue',
+        dict(_ACTOR, id='source.issue.number',
+             repo='source.issue.repository.full_name',
+             state='source.issue.state', assignees='source.issue.assignees')),
+    'referenced': ('commit', dict(_ACTOR, commit_id='commit_id')),
+    'labeled': ('label', dict(_ACTOR, label='label.name')),
+    'committed': ('commit', {'author': 'author.name',
+                             'email': 'author.email', 'commit_id': 'sha'}),
+    'reviewed': ('review', dict(_USER, state='state')),
+    'commented': ('comment', dict(_USER, body='body')),
+    'assigned': ('comment', _ACTOR),
+    'closed': ('close', dict(_ACTOR, commit_id='commit_id')),
+    'subscribed': ('subscribed',
+                   dict(_ACTOR, commit_id='commit_id', id='commit_id')),
+    'merged': ('merged', dict(_ACTOR, commit_id='commit_id', id='commit_id')),
+}
+
+
+def _path_getter(path):
+    # type: (str) -> callable
+    """ Compile a dotted path into a function extracting the value.
+    Missing or null intermediate objects (e.g. a deleted actor) yield None
+    >>> _path_getter('actor.login')({'actor': {'login': 'user'}})
+    'user'
+    >>> _path_getter('actor.login')({'actor': None})
+    """
+    keys = path.split('.')
+
+    def get(obj):
+        for key in keys:
+            if obj is None:
+                return None
+            obj = obj.get(key)
+        return obj
+    return get
+
+
+def compile_extractor(spec, columns, categorical=()):
+    # type: (dict, tuple, tuple) -> callable
+    """ Compile a declarative event spec (see TIMELINE_SPEC) into a function
+    turning an iterable of events into a DataFrame.
+
+    Values are appended straight into per-column lists, so there is no
+    intermediate dict per event, and the DataFrame is built once.
+    """
+    def compile_rule(type_, fields):
+        fields = dict(fields, created_at='created_at', type=type_)
+        rule = []
+        for column in columns:
+            value = fields.get(column, '')
+            if column == 'event':
+                value = _path_getter('event')
+            elif column != 'type' and value:
+                value = _path_getter(value)
+            # unlike strings, functions have to be called for every event
+            rule.append((callable(value), value))
+        return rule
+
+    rules = {event: compile_rule(*args) for event, args in spec.items()}
+    default = compile_rule('', {})
+
+    def extract(events):
+        # type: (Iterable[dict]) -> pd.DataFrame
+        data = [[] for _ in columns]
+        for event in events:
+            rule = rules.get(event['event'], default)
+            for values, (dynamic, value) in zip(data, rule):
+                values.append(value(event) if dynamic else value)
+        return pd.DataFrame(collections.OrderedDict(
+            (column, pd.Categorical(values) if column in categorical
+             else values) for column, values in zip(columns, data)),
+            columns=columns)
+    return extract
+
+
+extract_timeline = compile_extractor(
+    TIMELINE_SPEC, TIMELINE_COLUMNS, TIMELINE_CATEGORICAL)
+
+
+def _last_page(link_header):
+    # type: (str) -> int
+    """ Get the last page number from a Link response header, if any
+    >>> _last_page('<https://api.github.com/repositories/1/commits?page=2>; '
+    ...            'rel="next", <https://api.github.com/repositories/1/'
+    ...            'commits?page=23>; rel="last"')
+    23
+    >>> _last_page('<https://api.github.com/?page=1>; rel="prev"')
+    """
+    m = re.search(r'[?&]page=(\d+)[^>]*>;\s*rel="last"', link_header)
+    return m and int(m.group(1))
+
+
+_context = threading.local()
+
+
+@contextlib.contextmanager
+def priority(name):
+    # type: (str) -> None
+    """ Make GitHub API requests of the current thread with the given
+    priority class, one of scheduler.PRIORITIES. Threads started by
+    GitHubAPI methods inherit it.
+
+        with priority('bulk'):
+            for commit in GitHubAPI().repo_commits(repo_name):
+                ...
+    """
+    if name not in scheduler.PRIORITIES:
+        raise ValueError("Unknown priority class: %s" % name)
+    previous = current_priority()
+    _context.priority = name
+    try:
+        yield
+    finally:
+        _context.priority = previous
+
+
+def current_priority():
+    # type: () -> str
+    return getattr(_context, 'priority', 'normal')
+
+
+def _concurrent_map(func, items, num_workers):
+    # type: (callable, Iterable, int) -> list
+    """ Ordered map over a pool of threads.
+    Unlike common.mapreduce.map, it stops on the first exception and
+    re-raises it rather than dropping the failed item.
+
+    >>> _concurrent_map(lambda x: x ** 2, range(5), 3)
+    [0, 1, 4, 9, 16]
+    """
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    pending = iter(range(len(items)))
+    lock = threading.Lock()
+    caller_priority = current_priority()
+
+    def worker():
+        with priority(caller_priority):
+            while not errors:
+                with lock:
+                    try:
+                        i = next(pending)
+                    except StopIteration:
+                        return
+                try:
+                    results[i] = func(items[i])
+                except Exception as e:
+                    errors.append(e)
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(max(min(num_workers, len(items)), 1))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+class _PendingCall(object):
+    """ Result of a request other threads are waiting for """
+    def __init__(self, priority='normal'):
+        self.priority = priority
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
 class GitHubAPIToken(object):
     api_url = "https://api.github.com/"
 
     token = None
     timeout = None
+    session = None  # keep-alive requests.Session, one per token
+    in_flight = 0  # number of active requests, maintained by GitHubAPI
+    stats = None  # metrics.TokenStats
+    etags = None  # cache.ETagCache shared by all tokens, if any
+    ledger = None  # cache.RateLimitLedger shared by all tokens, if any
     _user = None
     _headers = None
 
     limit = None  # see __init__ for more details
+    backoff_until = 0  # token is quarantined until this time
+    failures = 0  # consecutive failed requests, drives exponential backoff
 
-    def __init__(self, token=None, timeout=None):
+    def __init__(self, token=None, timeout=None, pool_size=_concurrency,
+                 etags=None, ledger=None):
         if token is not None:
             self.token = token
             self._headers = {
@@ -59,13 +360,20 @@ class GitHubAPIToken(object):
                 # "Accept": "application/vnd.github.mockingbird-preview"
             }
         self.limit = {}
-        for api_class in ('core', 'search'):
+        for api_class in ('core', 'search', 'graphql'):
             self.limit[api_class] = {
                 'limit': None,
                 'remaining': None,
                 'reset_time': None
             }
         self.timeout = timeout
+        self.etags = etags
+        self.ledger = ledger
+        self.stats = metrics.TokenStats()
+        # pooled connections save a TCP+TLS handshake on every request
+        self.session = requests.Session()
+        self.session.mount(self.api_url, requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size))
         super(GitHubAPIToken, self).__init__()
 
     @property
@@ -81,21 +389,27 @@ class GitHubAPIToken(object):
 
     def _check_limits(self):
         # regular limits will be updaated automatically upon request
-        # we only need to take care about search limit
+        # we only need to take care about search and GraphQL limits
         try:
-            s = self.request('rate_limit').json()['resources']['search']
+            resources = self.request('rate_limit').json()['resources']
         except TokenNotReady:
-            # self.request updated core limits already; search limits unknown
-            s = {'remaining': None, 'reset': None, 'limit': None}
+            # self.request updated core limits already; others are unknown
+            resources = {}
 
-        self.limit['search'] = {
-            'remaining': s['remaining'],
-            'reset_time': s['reset'],
-            'limit': s['limit']
-        }
+        for api_class in ('search', 'graphql'):
+            s = resources.get(api_class) or \
+                {'remaining': None, 'reset': None, 'limit': None}
+            self.limit[api_class] = {
+                'remaining': s['remaining'],
+                'reset_time': s['reset'],
+                'limit': s['limit']
+            }
 
     @staticmethod
     def api_class(url):
+        # GraphQL API has its own budget, measured in points
+        if url == 'graphql':
+            return 'graphql'
         return 'search' if url.startswith('search') else 'core'
 
     def ready(self, url):
@@ -110,35 +424,103 @@ class GitHubAPIToken(object):
     def when(self, url):
         key = self.api_class(url)
         if self.limit[key]['remaining'] != 0:
-            return 0
-        return self.limit[key]['reset_time']
+            return self.backoff_until
+        return max(self.limit[key]['reset_time'] or 0, self.backoff_until)
+
+    def backoff(self, response):
+        # type: (requests.Response) -> float
+        """ Quarantine the token after a failed request.
+
+        The pause is the one requested by server via Retry-After, or
+        at least a minute for secondary rate limits. Otherwise, it is
+        exponential in the number of consecutive failures with full jitter,
+        so that tokens failed at the same time don't retry at the same time.
+        :return: float, number of seconds the token is put aside for
+        """
+        self.failures += 1
+        retry_after = response.headers.get('Retry-After', '')
+        if retry_after.isdigit():
+            delay = int(retry_after)
+        else:
+            delay = random.uniform(0, min(
+                BACKOFF_CAP, BACKOFF_BASE * 2 ** self.failures))
+            if response.status_code in (403, 429) \
+                    and 'secondary rate limit' in response.text:
+                delay = max(delay, SECONDARY_LIMIT_WAIT)
+        self.backoff_until = max(self.backoff_until, time.time() + delay)
+        self.stats.backoff(delay)
+        if self.ledger is not None:
+            self.ledger.backoff(self)
+        return delay
 
     def request(self, url, method='get', data=None, **params):
         # TODO: use coroutines, perhaps Tornado (as PY2/3 compatible)
 
         if not self.ready(url):
             raise TokenNotReady
+        api_class = self.api_class(url)
+        # other processes might have used up the quota or put the token
+        # aside; if so, reserve() updates its limits and the scheduler waits
+        reserved = self.ledger is not None
+        if reserved and not self.ledger.reserve(self, api_class):
+            raise TokenNotReady
+        try:
+            r = self._send(url, method, data, **params)
+            if 'X-RateLimit-Remaining' in r.headers:
+                remaining = int(r.headers['X-RateLimit-Remaining'])
+                self.limit[api_class] = {
+                    'remaining': remaining,
+                    'reset_time': int(r.headers['X-RateLimit-Reset']),
+                    'limit': int(r.headers['X-RateLimit-Limit'])
+                }
+                if reserved:
+                    self.ledger.record(self, api_class)
+                    reserved = False
+
+                if r.status_code == 403 and remaining == 0:
+                    raise TokenNotReady
+        finally:
+            # failed requests and responses without limits don't say
+            # anything about the quota, give the reservation back
+            if reserved:
+                self.ledger.release(self, api_class)
+
+        if r.status_code in (403, 429) + RETRY_STATUSES \
+                and "Repository access blocked" not in r.text:
+            self.backoff(r)
+        else:
+            self.failures = 0
+        return r
+
+    def _send(self, url, method='get', data=None, **params):
+        # type: (str, str, str) -> requests.Response
+        """ Make the HTTP request, conditional if there is a cached ETag """
         # Exact API version can be specified by Accept header:
         # "Accept": "application/vnd.github.v3+json"}
 
-        # might throw a timeout
-        r = requests.request(
-            method, self.api_url + url, params=params, data=data,
-            headers=self._headers, timeout=self.timeout)
-
-        if 'X-RateLimit-Remaining' in r.headers:
-            remaining = int(r.headers['X-RateLimit-Remaining'])
-            self.limit[self.api_class(url)] = {
-                'remaining': remaining,
-                'reset_time': int(r.headers['X-RateLimit-Reset']),
-                'limit': int(r.headers['X-RateLimit-Limit'])
-            }
-
-            if r.status_code == 403 and remaining == 0:
-                raise TokenNotReady
-            if r.status_code == 443:
-                print('443 error')
-                raise TokenNotReady
+        headers = self._headers
+        cached = None
+        if self.etags is not None and method == 'get':
+            cached = self.etags.get(url, params)
+            if cached:
+                headers = dict(headers or {},
+                               **self.etags.conditional_headers(cached))
+
+        start = time.time()
+        try:  # might throw a timeout
+            r = self.session.request(
+                method, self.api_url + url, params=params, data=data,
+                headers=headers, timeout=self.timeout)
+        except requests.RequestException as e:
+            self.stats.observe(type(e).__name__, time.time() - start)
+            raise
+        self.stats.observe(r.status_code, time.time() - start)
+
+        if cached and r.status_code == 304:
+            self.etags.revalidate(url, params, r, cached)
+        elif self.etags is not None and method == 'get' \
+                and r.status_code == 200:
+            self.etags.put(url, params, r)
         return r
 
 
@@ -146,164 +528,764 @@ class GitHubAPI(object):
     """ This is a convenience class to pool GitHub API keys and update their
     limits after every request. Actual work is done by outside classes, such
     as _IssueIterator and _CommitIterator
+
+    The instance is shared by all threads (e.g. mapreduce.map workers).
+    Every token serves up to `concurrency` requests at a time over its own
+    keep-alive session; callers block in _acquire() until the scheduler
+    (see scraper.scheduler.TokenScheduler) hands them a token.
     """
     _instance = None  # instance of API() for Singleton pattern implementation
     tokens = None
+    concurrency = None
+    scheduler = None
+    profiles = None  # cache.ProfileCache, if enabled
+    profile_ttl = None
+    # whether _fetch_profiles() gets only some of REST API profile fields
+    partial_profiles = False
+    responses = None  # cache.ResponseCache, if enabled
+    response_ttl = None
+    exporter = None  # metrics.Exporter, if enabled
+    ledger = None  # cache.RateLimitLedger, if enabled
+    checkpoints = None  # cache.CheckpointJournal, if enabled
+    redirects = None  # cache.RedirectMap, if enabled
+    negative = None  # cache.NegativeCache, if enabled
+    negative_ttl = None
 
     def __new__(cls, *args, **kwargs):  # Singleton
         if not isinstance(cls._instance, cls):
-            cls._instance = super(GitHubAPI, cls).__new__(cls, *args, **kwargs)
+            cls._instance = super(GitHubAPI, cls).__new__(cls)
         return cls._instance
 
-    def __init__(self, tokens=_tokens, timeout=30):
+    def __init__(self, tokens=_tokens, timeout=30, concurrency=_concurrency,
+                 etag_cache=_etag_cache, pacing=_pacing,
+                 profile_cache=_profile_cache, profile_ttl=_profile_ttl,
+                 response_cache=_response_cache, response_ttl=_response_ttl,
+                 response_max_age=_response_max_age,
+                 metrics_file=_metrics_file, ledger=_ledger,
+                 quota_reserve=_quota_reserve, checkpoints=_checkpoints,
+                 redirects=_redirects, negative_cache=_negative_cache,
+                 negative_ttl=_negative_ttl):
         if not tokens:
             raise EnvironmentError(
                 "No GitHub API tokens found in settings.py. Please add some.")
-        self.tokens = [GitHubAPIToken(t, timeout=timeout) for t in tokens]
+        self.concurrency = max(concurrency, 1)
+        # stores are opened on first use and purged then
+        self.responses = response_cache and \
+            cache.ResponseCache(response_cache, max_age=response_max_age)
+        self.response_ttl = response_ttl
+        # with both caches, bodies are only kept in the response cache
+        etags = etag_cache and cache.ETagCache(
+            etag_cache, bodies=self.responses or None,
+            max_age=response_max_age)
+        self.ledger = ledger and cache.RateLimitLedger(ledger)
+        self.tokens = [GitHubAPIToken(t, timeout=timeout,
+                                      pool_size=self.concurrency, etags=etags,
+                                      ledger=self.ledger)
+                       for t in tokens]
+        self.scheduler = scheduler.TokenScheduler(
+            self.tokens, self.concurrency, pacing=pacing,
+            reserve=quota_reserve)
+        self._pending = {}  # request key: _PendingCall, see _request()
+        self._pending_lock = threading.Lock()
+        self.profiles = profile_cache and cache.ProfileCache(profile_cache)
+        self.profile_ttl = profile_ttl
+        self.checkpoints = checkpoints and \
+            cache.CheckpointJournal(checkpoints)
+        self.redirects = redirects and cache.RedirectMap(redirects)
+        self.negative = negative_cache and \
+            cache.NegativeCache(negative_cache, max_age=negative_ttl)
+        self.negative_ttl = negative_ttl
+        if self.exporter is not None:  # the singleton is reinitialized
+            self.exporter.stop()
+            self.exporter = None
+        if metrics_file:
+            self.exporter = metrics.Exporter(self, metrics_file)
+            self.exporter.start()
+
+    def _acquire(self, url):
+        # type: (str) -> GitHubAPIToken
+        """ Block until some token is ready for `url` and has a free slot.
+        The priority class of the request is set by priority() """
+        return self.scheduler.acquire(GitHubAPIToken.api_class(url),
+                                      current_priority())
+
+    def _release(self, token):
+        # type: (GitHubAPIToken) -> None
+        self.scheduler.release(token)
+
+    def _request(self, url, method='get', data=None, **params):
+        # type: (str, str, str) -> (object, requests.Response)
+        """ Make a single request, switching tokens on failures.
+
+        Identical GET requests made concurrently by several threads are
+        coalesced into one, and all of them get the same result objects;
+        so, callers must not modify them.
+        :return: tuple (parsed response, raw response). The raw response is
+            None for missing/empty resources; the parsed response is either
+            {} or "notExist" in this case.
+        """
+        if method != 'get':
+            return self._fetch(url, method, data, **params)
+
+        key = cache.request_key(url, params)
+        request_priority = current_priority()
+        with self._pending_lock:
+            call = self._pending.get(key)
+            leader = call is None
+            if leader:
+                call = self._pending[key] = _PendingCall(request_priority)
+        if not leader:
+            if scheduler.PRIORITIES.index(call.priority) > \
+                    scheduler.PRIORITIES.index(request_priority):
+                # don't wait in a queue of a lower priority class
+                return self._fetch(url, method, data, **params)
+            return call.wait()
 
-    def request(self, url, method='get', paginate=False, data=None, **params):
-        # type: (str, str, bool, str) -> dict
-        """ Generic, API version agnostic request method """
-        timeout_counter = 0
-        if paginate:
-            paginated_res = []
-            params['page'] = 1
-            params['per_page'] = 100
+        try:
+            call.result = self._fetch(url, method, data, **params)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._pending_lock:
+                del self._pending[key]
+            call.done.set()
+        return call.result
+
+    def _fetch(self, url, method='get', data=None, **params):
+        # type: (str, str, str) -> (object, requests.Response)
+        """ Do the actual work of _request() """
+        # responses are cached under the URL requested, like ETags
+        target = self._redirect(url)
+        cacheable = self.responses is not None and method == 'get'
+        if cacheable:
+            r = self.responses.get(target, params, self.response_ttl)
+            if r is not None:
+                return r.json(), r
+        missing = self._known_missing(url, method, params)
+        if missing is not None:
+            return missing, None
 
+        timeout_counter = 0
         while True:
-            for token in self.tokens:
-                # for token in sorted(self.tokens, key=lambda t: t.when(url)):
-                if not token.ready(url):
-                    continue
+            token = self._acquire(url)
+            try:
+                r = token.request(target, method=method, data=data, **params)
+            except requests.ConnectionError:
+                logger.info("%s: connection error, retrying", url)
+                continue
+            except TokenNotReady:
+                continue
+            except requests.exceptions.Timeout:
+                timeout_counter += 1
+                if timeout_counter > len(self.tokens):
+                    raise
+                continue  # i.e. try again
+            finally:
+                self._release(token)
+
+            if "Repository access blocked" in r.text:
+                self._remember_missing(url, method, params, r, "notExist")
+                return "notExist", None
+            if r.status_code in (404, 451):
+                logger.debug("%s: HTTP %d", url, r.status_code)
+                self._remember_missing(url, method, params, r, {})
+                return {}, None
+                # API v3 only
+                # raise RepoDoesNotExist(
+                #     "GH API returned status %s" % r.status_code)
+            elif r.status_code == 409:
+                logger.debug("%s: HTTP 409", url)
+                # repository is empty https://developer.github.com/v3/git/
+                self._remember_missing(url, method, params, r, {})
+                return {}, None
+            elif r.status_code == 410:
+                logger.debug("%s: HTTP 410", url)
+                # repository is empty https://developer.github.com/v3/git/
+                self._remember_missing(url, method, params, r, {})
+                return {}, None
+            elif r.status_code == 202:
+                # repository statistics are not ready yet, nothing to cache
+                raise StatsNotReady("%s: HTTP 202" % url, response=r)
+            elif r.status_code in (403, 429) + RETRY_STATUSES:
+                # the token is quarantined already (see token.backoff),
+                # so the retry goes to another one if any is ready
+                logger.info("%s: HTTP %d, token is put aside for %.1f sec",
+                            url, r.status_code,
+                            max(token.backoff_until - time.time(), 0))
+                continue
+            r.raise_for_status()
+            if r.history and r.history[0].status_code == 301:
+                self._record_redirect(url, r)
+            if cacheable:
+                self.responses.put(target, params, r)
+            return r.json(), r
+
+    def _known_missing(self, url, method, params):
+        # type: (str, str, dict) -> object
+        """ Result of a recent request to the same missing resource, or to
+        anything in a missing repository; None if there was no such request
+        """
+        if self.negative is None or method != 'get':
+            return None
+        entry = self.negative.get(url, params, self.negative_ttl)
+        match = entry is None and _REPO_URL.match(url)
+        if match and match.group(2):
+            entry = self.negative.get(
+                'repos/' + match.group(1), None, self.negative_ttl)
+        return entry and entry[1]
+
+    def _remember_missing(self, url, method, params, r, result):
+        # type: (str, str, dict, requests.Response, object) -> None
+        if self.negative is not None and method == 'get':
+            self.negative.put(url, params, r.status_code, result)
+
+    def _redirect(self, url):
+        # type: (str) -> str
+        """ Rewrite a request to a moved repository to its new location """
+        match = self.redirects is not None and _REPO_URL.match(url)
+        entry = match and self.redirects.get(match.group(1))
+        if not entry:
+            return url
+        return entry[0] + (match.group(2) or '')
+
+    def _record_redirect(self, url, r):
+        # type: (str, requests.Response) -> None
+        """ Remember where a repository has moved, if `url` is about one """
+        match = self.redirects is not None and _REPO_URL.match(
+            url.split('?', 1)[0])
+        target = match and re.search(r'(repositories/\d+)(/.*)?$',
+                                     r.url.split('?', 1)[0])
+        # the rest of the path has to be the same, otherwise it is the object
+        # that has moved, e.g. an issue transferred to another repository
+        if not target or target.group(2) != match.group(2):
+            return
+        full_name = None
+        if not match.group(2):  # the repository itself
+            full_name = r.json().get('full_name')
+        logger.info("%s: moved to %s", match.group(1),
+                    full_name or target.group(1))
+        self.redirects.put(match.group(1), target.group(1), full_name)
+
+    def canonical_name(self, repo_name):
+        # type: (str) -> str
+        """ Current name of a repository that might have been renamed or
+        transferred, as far as redirects seen so far tell """
+        entry = self.redirects and self.redirects.get(repo_name)
+        if not entry:
+            return repo_name
+        target, full_name = entry
+        if full_name is None:
+            res = self.request(target)
+            full_name = isinstance(res, dict) and res.get('full_name')
+            if not full_name:  # deleted since
+                return repo_name
+            self.redirects.put(repo_name, target, full_name)
+        return full_name
 
-                try:
-                    r = token.request(url, method=method, data=data, **params)
-                except requests.ConnectionError:
-                    print('except requests.ConnectionError')
-                    continue
-                except TokenNotReady:
-                    continue
-                except requests.exceptions.Timeout:
-                    timeout_counter += 1
-                    if timeout_counter > len(self.tokens):
-                        raise
-                    continue  # i.e. try again
-
-                if "Repository access blocked" in r.text:
-                    return "notExist"
-                if r.status_code in (404, 451):
-                    print("404, 451 retry..")
-                    return {}
-                    # API v3 only
-                    # raise RepoDoesNotExist(
-                    #     "GH API returned status %s" % r.status_code)
-                elif r.status_code == 409:
-                    print("409 retry..")
-                    # repository is empty https://developer.github.com/v3/git/
-                    return {}
-                elif r.status_code == 410:
-                    print("410 retry..")
-                    # repository is empty https://developer.github.com/v3/git/
-                    return {}
-                elif r.status_code == 403:
-                    # repository is empty https://developer.github.com/v3/git/
-                    print("403 retry..")
-                    time.sleep(randint(1, 29))
-                    continue
-                elif r.status_code == 443:
-                    # repository is empty https://developer.github.com/v3/git/
-                    print("443 retry..")
-                    time.sleep(randint(1, 29))
-                    continue
-                elif r.status_code == 502:
-                    # repository is empty https://developer.github.com/v3/git/
-                    print("443 retry..")
-                    time.sleep(randint(1, 29))
-                    continue
-                r.raise_for_status()
-                res = r.json()
-                if paginate:
-                    paginated_res.extend(res)
-                    has_next = 'rel="next"' in r.headers.get("Link", "")
-                    if not res or not has_next:
-                        return paginated_res
-                    else:
-                        params["page"] += 1
-                        continue
-                else:
-                    return res
+    @staticmethod
+    def project_exists(repo_name):
+        return bool(requests.head("https://github.com/" + repo_name))
+
+    @staticmethod
+    def canonical_url(project_url):
+        # type: (str) -> str
+        """ Normalize URL
+        - remove trailing .git  (IMPORTANT)
+        - lowercase (API is insensitive to case, but will allow to deduplicate)
+        - prepend "github.com"
+
+        :param project_url: str, user_name/repo_name
+        :return: github.com/user_name/repo_name with both names normalized
+
+        >>> GitHubAPI.canonical_url("pandas-DEV/pandas")
+        'github.com/pandas-dev/pandas'
+        >>> GitHubAPI.canonical_url("http://github.com/django/django.git")
+        'github.com/django/django'
+        >>> GitHubAPI.canonical_url("https://github.com/A/B/")
+        'github.com/a/b/'
+        """
+        url = project_url.lower()
+        for chunk in ("httpp://", "https://", "github.com"):
+            if url.startswith(chunk):
+                url = url[len(chunk):]
+        if url.endswith("/"):
+            url = url[:-1]
+        while url.endswith(".git"):
+            url = url[:-4]
+        return "github.com/" + url
+
+    def request(self, url, method='get', paginate=False, data=None,
+                parallel=False, **params):
+        # type: (str, str, bool, str, bool) -> dict
+        """ Generic, API version agnostic request method
+
+        :param paginate: bool, collect all pages of a list response
+        :param parallel: bool, only used with paginate. Once the first page
+            reports the last page number (Link: rel="last"), fetch the rest
+            of pages concurrently using all available tokens.
+        """
+        if not paginate:
+            return self._request(url, method=method, data=data, **params)[0]
+
+        params['page'] = 1
+        params['per_page'] = 100
+        res, r = self._request(url, method=method, data=data, **params)
+        if r is None:
+            return res
+        paginated_res = list(res)
+        for page in self._next_pages(res, r, url, method, data, parallel,
+                                     **params):
+            paginated_res.extend(page)
+        return paginated_res
+
+    def iter_pages(self, url, method='get', data=None, parallel=False,
+                   spill=None, checkpoint=False, **params):
+        # type: (str, str, str, bool, str, bool) -> Iterable[list]
+        """ Streaming version of request(paginate=True)
+        Yields pages (lists of items) in order as soon as they are available,
+        so callers don't have to hold the whole history in memory.
+        Missing or empty resources produce no pages.
+
+        :param spill: optional file path. Every item is appended there as a
+            JSON line before its page is yielded, so the data fetched so far
+            survives a crash of the consumer.
+        :param checkpoint: bool, requires spill. Journal every page taken
+            by the consumer (see cache.CheckpointJournal). If the crawl is
+            interrupted, the next call with the same arguments reads these
+            pages back from the spill file instead of requesting them
+            again, and continues from the page that follows.
+        """
+        if checkpoint and spill is None:
+            raise ValueError("Checkpoints require a spill file")
+        journal = self.checkpoints if checkpoint else None
+        key = cache.request_key(url, params)
+        entry = journal and journal.get(key)
+        if entry is not None and (entry['spill'] != spill or not (
+                os.path.isfile(spill) and
+                os.path.getsize(spill) >= entry['end'])):
+            entry = None  # spill file has changed, start over
+
+        params['page'] = 1
+        params['per_page'] = 100
+        rows = 0
+        if entry is not None:
+            logger.info("%s: resuming after page %s, %d items fetched",
+                        url, entry['position'], entry['rows'])
+            params['page'] = int(entry['position']) + 1
+            rows = entry['rows']
+            start = entry['start']
+            for page in self._replay_spill(spill, start, entry['end']):
+                yield page
+        elif spill is not None:
+            start = os.path.getsize(spill) if os.path.isfile(spill) else 0
+
+        res, r = self._request(url, method=method, data=data, **params)
+        if r is None:
+            if journal is not None:
+                journal.delete(key)
+            return
+        pages = itertools.chain([res], self._next_pages(
+            res, r, url, method, data, parallel, **params))
+        if spill is None:
+            for page in pages:
+                yield page
+            return
+
+        with open(spill, 'a') as fh:
+            for page_num, page in enumerate(pages, params['page']):
+                for item in page:
+                    fh.write(json.dumps(item) + "\n")
+                fh.flush()
+                yield page
+                rows += len(page)
+                if journal is not None:
+                    journal.put(key, page_num, rows, spill, start,
+                                os.path.getsize(spill))
+        if journal is not None:
+            journal.delete(key)
 
-            next_res = min(token.when(url) for token in self.tokens)
-            sleep = int(next_res - time.time()) + 1
-            if sleep > 0:
-                logger.info(
-                    "%s: out of keys, resuming in %d minutes, %d seconds",
-                    datetime.now().strftime("%H:%M"), *divmod(sleep, 60))
-                time.sleep(sleep)
-                logger.info(".. resumed")
+    @staticmethod
+    def _replay_spill(spill, start, end):
+        # type: (str, int, int) -> Iterable[list]
+        """ Read pages back from a spill file and drop whatever follows
+        them, i.e. items of a page that was not taken by the consumer """
+        with open(spill, 'rb+') as fh:
+            fh.truncate(end)
+            fh.seek(start)
+            page = []
+            for line in fh:
+                page.append(json.loads(line.decode('utf8')))
+                if len(page) == 100:
+                    yield page
+                    page = []
+            if page:
+                yield page
+
+    def _next_pages(self, res, r, url, method='get', data=None,
+                    parallel=False, **params):
+        """ Generate pages following the one in `res` (raw response `r`) """
+        last_page = parallel and _last_page(r.headers.get("Link", ""))
+        if last_page:
+            num_workers = len(self.tokens) * self.concurrency
+            window = 2 * num_workers  # pages kept in memory at once
+
+            def fetch(page):
+                return self._request(url, method=method, data=data,
+                                     **dict(params, page=page))[0]
+
+            for start in range(params['page'] + 1, last_page + 1, window):
+                pages = range(start, min(start + window, last_page + 1))
+                for page_res in _concurrent_map(fetch, pages, num_workers):
+                    # pages might disappear, e.g. if repo is deleted;
+                    # stop there, as the sequential mode does
+                    if not isinstance(page_res, list):
+                        return
+                    yield page_res
+            return
+
+        while res and 'rel="next"' in r.headers.get("Link", ""):
+            params["page"] += 1
+            res, r = self._request(url, method=method, data=data, **params)
+            if r is None:
+                break
+            yield res
+
+    def _search_page(self, kind, query, page):
+        # type: (str, str, int) -> (int, list)
+        """ Get (total number of results, items) of a search results page """
+        res = self.request('search/' + kind, q=query, page=page, per_page=100)
+        if not isinstance(res, dict) or 'items' not in res:
+            return 0, []
+        if res.get('incomplete_results'):
+            logger.warning("%s: search timed out, results are incomplete",
+                           query)
+        return res['total_count'], res['items']
+
+    def search(self, kind, query, start=None, end=None, num_workers=None):
+        # type: (str, str, datetime, datetime, int) -> Iterable[dict]
+        """ Stream all results of a search query, despite the Search API
+        cap of 1000 results per query.
+
+        The query is sliced by `created:` date ranges, and every slice with
+        more than SEARCH_LIMIT results is split in halves until it fits.
+        Slices and their pages are fetched concurrently; the scheduler keeps
+        requests within tokens' search quota (30 per minute each).
+        Results are deduplicated but come in no particular order.
+
+        :param kind: what to search for, e.g. 'repositories' or 'issues'
+        :param query: search query without created: qualifier,
+            e.g. '"fork of" in:description'
+        :param start: datetime (UTC), SEARCH_EPOCH by default
+        :param end: datetime (UTC), now by default
+        :param num_workers: number of requests made at once, by default
+            one per token
+        """
+        start = (start or SEARCH_EPOCH).replace(microsecond=0)
+        end = (end or datetime.utcnow()).replace(microsecond=0)
+        num_workers = num_workers or len(self.tokens)
+        tasks = queue.Queue()  # (start, end, page); None to stop a worker
+        results = queue.Queue()  # lists of items, exceptions, or None
+        outstanding = [1]  # number of queued or running tasks
+        lock = threading.Lock()
+        stopped = threading.Event()
+        caller_priority = current_priority()
+
+        def run(start, end, page):
+            q = "%s created:%s..%s" % (
+                query, start.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                end.strftime("%Y-%m-%dT%H:%M:%SZ"))
+            total, items = self._search_page(kind, q, page)
+            results.put(items)
+            if page > 1:
+                return []
+            if total <= SEARCH_LIMIT or end - start < timedelta(seconds=2):
+                if total > SEARCH_LIMIT:
+                    logger.warning("%s: %d results, only %d are available",
+                                   q, total, SEARCH_LIMIT)
+                last_page = (min(total, SEARCH_LIMIT) - 1) // 100 + 1
+                return [(start, end, p) for p in range(2, last_page + 1)]
+            middle = start + timedelta(
+                seconds=int((end - start).total_seconds()) // 2)
+            return [(start, middle, 1),
+                    (middle + timedelta(seconds=1), end, 1)]
+
+        def worker():
+            with priority(caller_priority):
+                while True:
+                    task = tasks.get()
+                    if task is None:
+                        return
+                    new_tasks = []
+                    if not stopped.is_set():
+                        try:
+                            new_tasks = run(*task)
+                        except Exception as e:
+                            results.put(e)
+                    with lock:
+                        outstanding[0] += len(new_tasks) - 1
+                        finished = not outstanding[0]
+                    for new_task in new_tasks:
+                        tasks.put(new_task)
+                    if finished:
+                        results.put(None)
+
+        threads = [threading.Thread(target=worker)
+                   for _ in range(max(num_workers, 1))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        tasks.put((start, end, 1))
+
+        seen = set()
+        try:
+            while True:
+                items = results.get()
+                if items is None:
+                    break
+                if isinstance(items, Exception):
+                    raise items
+                for item in items:
+                    key = item.get('id') or item.get('url')
+                    if key not in seen:
+                        seen.add(key)
+                        yield item
+        finally:
+            # also stops workers if the caller doesn't need more results
+            stopped.set()
+            for _ in threads:
+                tasks.put(None)
 
     def isFork(self, repo_name, page=None):
         url = "repos/%s" % repo_name
-        data = self.request(url)
+        with priority('interactive'):
+            data = self.request(url)
         if len(data) ==0 or data=='notExist':
             return 'notExist'
         else:
             return data['fork']
 
 
-    def repo_issues(self, repo_name, page=None):
-        # type: (str, int) -> Iterable[dict]
-        url = "repos/%s/issues" % repo_name
+    @staticmethod
+    def _issue_record(issue):
+        # type: (dict) -> dict
+        return {
+            'author': issue['user']['login'],
+            'closed': issue['state'] != "open",
+            'created_at': issue['created_at'],
+            'updated_at': issue['updated_at'],
+            'closed_at': issue['closed_at'],
+            'number': issue['number'],
+            'title': issue['title']
+        }
+
+    @staticmethod
+    def _pull_record(pr):
+        # type: (dict) -> dict
+        """ Parse either a pull request or its stub from the issues list.
+        Stubs have no head and base; merged_at is only reported in
+        pull_request.merged_at, and not by older GitHub versions. """
+        body = pr.get('body', {})
+        head = pr.get('head', {})
+        head_repo = head.get('repo') or {}
+        base = pr.get('base', {})
+        base_repo = base.get('repo') or {}
+        merged_at = pr['merged_at'] if 'merged_at' in pr \
+            else (pr.get('pull_request') or {}).get('merged_at')
+
+        return {
+            'id': int(pr['number']),  # no idea what is in the id field
+            'title': pr['title'],
+            'body': body,
+            'labels': 'labels' in pr and [l['name'] for l in pr['labels']],
+            'created_at': pr['created_at'],
+            'updated_at': pr['updated_at'],
+            'closed_at': pr['closed_at'],
+            'merged_at': merged_at,
+            'author': pr['user']['login'],
+            'head': head_repo.get('full_name'),
+            'head_branch': head.get('label'),
+            'base': base_repo.get('full_name'),
+            'base_branch': base.get('label'),
+        }
 
+    def repo_issues_pulls(self, repo_name, spill=None, since=None,
+                          details=None, checkpoint=False):
+        # type: (str, str, str, callable, bool) -> Iterable[tuple]
+        """ Issues and pull requests in a single pass over the issues list,
+        which includes pull requests as well.
+
+        :param spill: optional file path to append raw items to,
+            see iter_pages()
+        :param checkpoint: resume an interrupted crawl, see iter_pages()
+        :param since: ISO timestamp, only get items updated since
+        :param details: optional function taking a pull request record
+            (see _pull_record) made from the stub and returning whether
+            full pull request is needed, e.g. to get head and base. Such
+            pull requests are requested concurrently, one page at a time.
+        :return: generator of ('issue', issue record) or
+            ('pull', pull request record)
+        """
+        url = "repos/%s/issues" % repo_name
+        params = {'state': 'all'}
+        if since:
+            params['since'] = since
+
+        def fetch(record):
+            pr = self.request("repos/%s/pulls/%d" % (repo_name, record['id']))
+            return self._pull_record(pr) if pr and pr != "notExist" \
+                else record
+
+        for page in self.iter_pages(url, parallel=True, spill=spill,
+                                    checkpoint=checkpoint, **params):
+            records = [('pull', self._pull_record(item))
+                       if 'pull_request' in item
+                       else ('issue', self._issue_record(item))
+                       for item in page]
+            if details is not None:
+                incomplete = [i for i, (kind, record) in enumerate(records)
+                              if kind == 'pull' and details(record)]
+                for i, record in zip(incomplete, _concurrent_map(
+                        fetch, [records[i][1] for i in incomplete],
+                        self.concurrency * len(self.tokens))):
+                    records[i] = ('pull', record)
+            for kind_record in records:
+                yield kind_record
+
+    def repo_issues(self, repo_name, page=None, spill=None, since=None,
+                    checkpoint=False):
+        # type: (str, int, str, str, bool) -> Iterable[dict]
+        """
+        :param since: ISO timestamp, only get issues updated since
+        :param checkpoint: resume an interrupted crawl, see iter_pages()
+        """
         if page is None:
-            data = self.request(url, paginate=True, state='all')
-        else:
-            data = self.request(url, page=page, per_page=100, state='all')
+            for kind, issue in self.repo_issues_pulls(
+                    repo_name, spill=spill, since=since,
+                    checkpoint=checkpoint):
+                if kind == 'issue':
+                    yield issue
+            return
 
-        for issue in data:
+        url = "repos/%s/issues" % repo_name
+        params = {'state': 'all'}
+        if since:
+            params['since'] = since
+        for issue in self.request(url, page=page, per_page=100, **params):
             if 'pull_request' not in issue:
-                yield {
-                    'author': issue['user']['login'],
-                    'closed': issue['state'] != "open",
-                    'created_at': issue['created_at'],
-                    'updated_at': issue['updated_at'],
-                    'closed_at': issue['closed_at'],
-                    'number': issue['number'],
-                    'title': issue['title']
-                }
-
-    def repo_commits(self, repo_name):
-
+                yield self._issue_record(issue)
+
+    def repo_commits(self, repo_name, spill=None, since=None, stop_at=None,
+                     pulls=True, pull_details=None, checkpoint=False,
+                     pulls_since=None):
+        # type: (str, str, str, set, bool, callable, bool, str) -> Iterable
+        """ Commits followed by pull requests of the repository
+        :param spill: optional file path to append raw commits to,
+            see iter_pages()
+        :param checkpoint: resume an interrupted crawl of commits,
+            see iter_pages()
+        :param since: ISO timestamp, only get commits made since
+        :param stop_at: set of SHAs already known, along with all their
+            ancestors. Known commits are skipped, and the crawl stops once
+            all parents of new commits are known. Stopping at the first
+            known commit instead would miss branches merged since, as
+            their commits might be older than it.
+        :param pulls: bool, whether to list pull requests as well.
+            They are taken from the issues list, which is shared with
+            repo_issues() through the response cache, so crawling both
+            doesn't cost extra pages for pull requests.
+        :param pulls_since: ISO timestamp, only get pull requests updated
+            since
+        :param pull_details: function choosing pull requests to request
+            in full, see repo_issues_pulls(). Pull request records have the
+            same keys either way, but head, head_branch, base and
+            base_branch are None unless the pull request is requested in
+            full. E.g. pull_details=lambda pr: True gets them for all pull
+            requests, at the cost of a request each.
+        """
         url = "repos/%s/commits" % repo_name
+        params = {'since': since} if since else {}
+        stop_at = stop_at or ()
+
+        # it only takes a few pages to reach a known commit,
+        # so fetching pages in advance is a waste of quota
+        pages = self.iter_pages(url, parallel=not stop_at, spill=spill,
+                                checkpoint=checkpoint, **params)
+        missing = set()  # unknown parents of new commits not listed yet
+        for commit in itertools.chain.from_iterable(pages):
+            missing.discard(commit['sha'])
+            if commit['sha'] not in stop_at:
+                missing.update(p['sha'] for p in commit['parents']
+                               if p['sha'] not in stop_at)
+                # might be None for commits authored outside of github
+                yield parse_commit(commit)
+            if stop_at and not missing:
+                pages.close()
+                # the crawl is complete, the next one must not resume it
+                if checkpoint and self.checkpoints is not None:
+                    self.checkpoints.delete(cache.request_key(url, params))
+                break
 
-        for commit in self.request(url, paginate=True):
-            # might be None for commits authored outside of github
-            yield parse_commit(commit)
-
-        url = "repos/%s/pulls" % repo_name
+        if not pulls:
+            return
+
+        for kind, pr in self.repo_issues_pulls(
+                repo_name, since=pulls_since, details=pull_details):
+            if kind == 'pull':
+                yield pr
+
+    def repos_stats(self, repo_names, stat='contributors'):
+        # type: (Iterable[str], str) -> Iterable[tuple]
+        """ Get precomputed statistics of many repositories, e.g.
+        stats/contributors (weekly commits of top 100 authors) or
+        stats/commit_activity (weekly commits over the last year).
+
+        GitHub computes statistics on the first request and answers 202
+        meanwhile. Such repositories are put into a deferred queue and
+        retried with exponential delays, while the rest are processed.
+
+        :param stat: statistics endpoint, {'contributors'|'commit_activity'|
+            'code_frequency'|'participation'|'punch_card'}
+        :return: generator of (repo_name, statistics) in no particular
+            order; statistics are None if still not computed after
+            STATS_ATTEMPTS requests, {} if the repository doesn't exist
+        """
+        num_workers = self.concurrency * len(self.tokens)
+        pending = iter(repo_names)
+        deferred = []  # heap of (retry time, attempt, repo_name)
+        seq = itertools.count()
 
-        for pr in self.request(url, paginate=True, state='all'):
-            body = pr.get('body', {})
-            head = pr.get('head', {})
-            head_repo = head.get('repo') or {}
-            base = pr.get('base', {})
-            base_repo = base.get('repo') or {}
+        def fetch(repo_name):
+            try:
+                return self.request("repos/%s/stats/%s" % (repo_name, stat))
+            except StatsNotReady:
+                return None
 
-            yield {
-                'id': int(pr['number']),  # no idea what is in the id field
-                'title': pr['title'],
-                'body': body,
-                'labels': 'labels' in pr and [l['name'] for l in pr['labels']],
-                'created_at': pr['created_at'],
-                'updated_at': pr['updated_at'],
-                'closed_at': pr['closed_at'],
-                'merged_at': pr['merged_at'],
-                'author': pr['user']['login'],
-                'head': head_repo.get('full_name'),
-                'head_branch': head.get('label'),
-                'base': base_repo.get('full_name'),
-                'base_branch': base.get('label'),
-            }
+        while True:
+            batch = [(0, repo_name) for repo_name in
+                     itertools.islice(pending, num_workers)]
+            while deferred and deferred[0][0] <= time.time() \
+                    and len(batch) < 2 * num_workers:
+                _, _, attempt, repo_name = heapq.heappop(deferred)
+                batch.append((attempt, repo_name))
+            if not batch:
+                if not deferred:
+                    return
+                time.sleep(max(deferred[0][0] - time.time(), 0))
+                continue
+
+            for (attempt, repo_name), res in zip(batch, _concurrent_map(
+                    lambda item: fetch(item[1]), batch, num_workers)):
+                if res is not None:
+                    yield repo_name, res
+                elif attempt + 1 >= STATS_ATTEMPTS:
+                    logger.info("%s: %s stats are not ready, giving up",
+                                repo_name, stat)
+                    yield repo_name, None
+                else:
+                    heapq.heappush(deferred, (
+                        time.time() + STATS_RETRY_DELAY * 2 ** attempt,
+                        next(seq), attempt + 1, repo_name))
 
     def pull_request_commits(self, repo, pr_id):
         # type: (str, int) -> Iterable[dict]
@@ -331,210 +1313,18 @@ class GitHubAPI(object):
                 'updated_at': comment['updated_at'],
             }
 
-    def issue_pr_timeline(self, repo, issue_id):
+    def issue_pr_timeline(self, repo, issue_id, spill=None, checkpoint=False):
         """ Return timeline on an issue or a pull request
         :param repo: str 'owner/repo'url
         :param issue_id: int, either an issue or a Pull Request id
+        :param spill: optional file path to append raw events to
+        :param checkpoint: resume an interrupted crawl, see iter_pages()
+        :return: pd.DataFrame, one row per event, see TIMELINE_SPEC
         """
         url = "repos/%s/issues/%s/timeline" % (repo, issue_id)
-        events = self.request(url, paginate=True, state='all')
-        for event in events:
-            # print('repo: ' + repo + ' issue: ' + str(issue_id) + ' event: ' + event['event'])
-            if event['event'] == 'cross-referenced':
-                author = event['actor'] or {}
-                yield {
-                    'event': event['event'],
-                    'author': author.get('login'),
-                    'email': '',
-                    'author_type': author.get('type'),
-                    'author_association': '',
-                    'commit_id': "",
-                    'created_at': event.get('created_at'),
-                    'id': event['source']['issue']['number'],
-                    'repo': event['source']['issue']['repository']['full_name'],
-                    'type': 'pull_request' if 'pull_request' in event['source']['issue'].keys() else 'issue',
-                    'state': event['source']['issue']['state'],
-                    'assignees': event['source']['issue']['assignees'],
-                    'label': "",
-                    'body': ''
-                }
-            elif event['event'] == 'referenced':
-                author = event['actor'] or {}
-                yield {
-                    'event': event['event'],
-                    'author': author.get('login'),
-                    'email': '',
-                    'author_type': author.get('type'),
-                    'author_association': '',
-                    'commit_id': event['commit_id'],
-                    'created_at': event['created_at'],
-                    'id': '',
-                    'repo': '',
-                    'type': 'commit',
-                    'state': '',
-                    'assignees': '',
-                    'label': '',
-                    'body': ''
-                }
-            elif event['event'] == 'labeled':
-                author = event['actor'] or {}
-                yield {
-                    'event': event['event'],
-                    'author': author.get('login'),
-                    'email': '',
-                    'author_type': author.get('type'),
-                    'author_association': '',
-                    'commit_id': '',
-                    'created_at': event.get('created_at'),
-                    'id': '',
-                    'repo': '',
-                    'type': "label",
-                    'state': '',
-                    'assignees': '',
-                    'label': event['label']['name'],
-                    'body': ''
-                }
-            elif event['event'] == 'committed':
-                yield {
-                    'event': event['event'],
-                    'author': event['author']['name'],
-                    'email': event['author']['email'],
-                    'author_type': '',
-                    'author_association': '',
-                    'commit_id': event['sha'],
-                    'created_at': event.get('created_at'),
-                    'id': '',
-                    'repo': '',
-                    'type': "commit",
-                    'state': '',
-                    'assignees': '',
-                    'label': '',
-                    'body': ''
-                }
-            elif event['event'] == 'reviewed':
-                author = event['user'] or {}
-                yield {
-                    'event': event['event'],
-                    'author': author.get('login'),
-                    'email': '',
-                    'author_type': author.get('type'),
-                    'author_association': event['author_association'],
-                    'commit_id': '',
-                    'created_at': event.get('created_at'),
-                    'id': '',
-                    'repo': '',
-                    'type': "review",
-                    'state': event['state'],
-                    'assignees': '',
-                    'label': '',
-                    'body': ''
-                }
-            elif event['event'] == 'commented':
-                yield {
-                    'event': event['event'],
-                    'author': event['user']['login'],
-                    'email': '',
-                    'author_type': event['user']['type'],
-                    'author_association': event['author_association'],
-                    'commit_id': '',
-                    'created_at': event.get('created_at'),
-                    'id': '',
-                    'repo': '',
-                    'type': "comment",
-                    'state': '',
-                    'assignees': '',
-                    'label': '',
-                    'body': event['body']
-                }
-            elif event['event'] == 'assigned':
-                author = event['actor'] or {}
-                yield {
-                    'event': event['event'],
-                    'author': author.get('login'),
-                    'email': '',
-                    'author_type': author.get('type'),
-                    'author_association': '',
-                    'commit_id': '',
-                    'created_at': event.get('created_at'),
-                    'id': '',
-                    'repo': '',
-                    'type': "comment",
-                    'state': '',
-                    'assignees': '',
-                    'label': '',
-                    'body': ''
-                }
-            elif event['event'] == 'closed':
-                author = event['actor'] or {}
-                yield {
-                    'event': event['event'],
-                    'author': author.get('login'),
-                    'email': '',
-                    'author_type': author.get('type'),
-                    'author_association': '',
-                    'commit_id': event['commit_id'],
-                    'created_at': event.get('created_at'),
-                    'id': '',
-                    'repo': '',
-                    'type': "close",
-                    'state': '',
-                    'assignees': '',
-                    'label': '',
-                    'body': ''
-                }
-            elif event['event'] == 'subscribed':
-                author = event['actor'] or {}
-                yield {
-                    'event': event['event'],
-                    'author': author.get('login'),
-                    'email': '',
-                    'author_type': author.get('type'),
-                    'author_association': '',
-                    'commit_id': event['commit_id'],
-                    'created_at': event.get('created_at'),
-                    'id': event['commit_id'],
-                    'repo': '',
-                    'type': "subscribed",
-                    'state': '',
-                    'assignees': '',
-                    'label': '',
-                    'body': ''
-                }
-            elif event['event'] == 'merged':
-                author = event['actor'] or {}
-                yield {
-                    'event': event['event'],
-                    'author': author.get('login'),
-                    'email': '',
-                    'author_type': author.get('type'),
-                    'author_association': '',
-                    'commit_id': event['commit_id'],
-                    'created_at': event.get('created_at'),
-                    'id': event['commit_id'],
-                    'repo': '',
-                    'type': "merged",
-                    'state': '',
-                    'assignees': '',
-                    'label': '',
-                    'body': ''
-                }
-            else:
-                yield {
-                    'event': event['event'],
-                    'author': '',
-                    'email': '',
-                    'author_type': '',
-                    'author_association': '',
-                    'commit_id': '',
-                    'created_at': event.get('created_at'),
-                    'id': '',
-                    'repo': '',
-                    'type': "",
-                    'state': '',
-                    'assignees': '',
-                    'label': '',
-                    'body': ''
-                }
+        return extract_timeline(itertools.chain.from_iterable(
+            self.iter_pages(url, parallel=True, spill=spill,
+                            checkpoint=checkpoint, state='all')))
 
     def pr_changedFiles(self, repo, pr_id):
         """ Return changed file list on an issue or a pull request
@@ -565,7 +1355,8 @@ class GitHubAPI(object):
 
         url = "repos/%s/commits/%s" % (repo, sha)
         commitInfo = self.request(url)
-        files = commitInfo['files']
+        # empty or "notExist" if the commit or the repository is gone
+        files = isinstance(commitInfo, dict) and commitInfo.get('files') or []
         for file in files:
             yield {
                 'filename': file['filename'],
@@ -575,22 +1366,95 @@ class GitHubAPI(object):
                 'changes': file['changes']
             }
 
+    def _bulk(self, func, repo, keys):
+        # type: (callable, str, Iterable) -> dict
+        """ {key: list(func(repo, key))}, concurrently for all keys """
+        keys = list(keys)
+        return dict(zip(keys, _concurrent_map(
+            lambda key: list(func(repo, key)), keys,
+            self.concurrency * len(self.tokens))))
+
+    def prs_changedFiles(self, repo, pr_ids):
+        # type: (str, Iterable[int]) -> dict
+        """ Changed files of many pull requests of the same repository
+        :return: {pr_id: list of dicts, see pr_changedFiles()}
+        """
+        return self._bulk(self.pr_changedFiles, repo, pr_ids)
+
+    def commits_changedFiles(self, repo, shas):
+        # type: (str, Iterable[str]) -> dict
+        """ Changed files of many commits of the same repository.
+        There is no batch endpoint for per-commit files (compare/ only
+        reports the total diff of a range), so commits are requested
+        concurrently using all tokens.
+        :return: {sha: list of dicts, see commit_changedFile()}
+        """
+        return self._bulk(self.commit_changedFile, repo, shas)
+
     def repoLastPushDate(self, repoUrl):
         url = "repos/%s" % (repoUrl)
-        repoInfo = self.request(url)
+        with priority('interactive'):
+            repoInfo = self.request(url)
         if (len(repoInfo) == 0):
             print(repoUrl + " deleted")
             return ''
         else:
             return repoInfo['pushed_at']
 
+    def user_info(self, login, fields=None):
+        # type: (str, Iterable[str]) -> dict
+        """ Get user or organization profile, {} if it doesn't exist.
+        Profiles are shared through the profile cache, if enabled.
+        Docs: https://developer.github.com/v3/users/#response
+
+        :param fields: optional profile keys the caller needs. Profiles
+            cached by GitHubAPIv4.warm_profiles() have only some of them;
+            such profiles are used if they have all of `fields`, and
+            requested again otherwise.
+        """
+        if self.profiles is not None:
+            profile = self.profiles.get(login, self.profile_ttl, fields)
+            if profile is not None:
+                return profile
+        profile = self._fetch_profile(login)
+        if self.profiles is not None:
+            self.profiles.put(login, profile)
+        return profile
+
+    def _fetch_profile(self, login):
+        # type: (str) -> dict
+        profile = self.request("users/" + login)
+        # {} if the account doesn't exist, "notExist" if it is blocked
+        return profile if isinstance(profile, dict) else {}
+
+    def _fetch_profiles(self, logins):
+        # type: (list) -> dict
+        """ Get {login: profile or {}}, bypassing the profile cache.
+        Logins that could not be resolved may be left out """
+        return dict(zip(logins, _concurrent_map(
+            self._fetch_profile, logins,
+            self.concurrency * len(self.tokens))))
+
+    def warm_profiles(self, logins):
+        # type: (Iterable[str]) -> int
+        """ Fetch profiles of all `logins` missing from the profile cache,
+        to speed up subsequent user_info() calls.
+        :return: int, number of fetched profiles
+        """
+        if self.profiles is None:
+            return 0
+        logins = self.profiles.missing(logins, self.profile_ttl)
+        profiles = self._fetch_profiles(logins)
+        for login, profile in profiles.items():
+            self.profiles.put(login, profile, self.partial_profiles)
+        return len(profiles)
+
     def userEmail(self, loginID):
-        """ Return changed file list on an issue or a pull request
-        :param repo: str 'owner/repo'url
-        :param sha,
+        """ Return email address of a user, if any
+        :param loginID: str, user login
         """
-        url = "users/%s" % (loginID)
-        userInfo = self.request(url)
+        with priority('interactive'):
+            userInfo = self.user_info(loginID, fields=('email',))
         if (len(userInfo) == 0):
             print(loginID + " deleted")
             return ''
@@ -599,8 +1463,9 @@ class GitHubAPI(object):
             return email
 
     def userInfo(self, loginID):
-        url = "users/%s" % (loginID)
-        userInfo = self.request(url)
+        with priority('interactive'):
+            userInfo = self.user_info(
+                loginID, fields=('email', 'name', 'type'))
         if (len(userInfo) == 0):
             print(loginID + " deleted")
             return 'userNotExist,userNotExist,userNotExist'
@@ -629,11 +1494,6 @@ def review_comments(self, repo, pr_id):
         }
 
 
-def user_info(self, user):
-    # Docs: https://developer.github.com/v3/users/#response
-    return self.request("users/" + user)
-
-
 def org_members(self, org):
     # TODO: support pagination
     return self.request("orgs/%s/members" % org)
@@ -644,40 +1504,6 @@ def user_orgs(self, user):
     return self.request("users/%s/orgs" % user)
 
 
-@staticmethod
-def project_exists(repo_name):
-    return bool(requests.head("https://github.com/" + repo_name))
-
-
-@staticmethod
-def canonical_url(project_url):
-    # type: (str) -> str
-    """ Normalize URL
-    - remove trailing .git  (IMPORTANT)
-    - lowercase (API is insensitive to case, but will allow to deduplicate)
-    - prepend "github.com"
-
-    :param project_url: str, user_name/repo_name
-    :return: github.com/user_name/repo_name with both names normalized
-
-    >>> GitHubAPI.canonical_url("pandas-DEV/pandas")
-    'github.com/pandas-dev/pandas'
-    >>> GitHubAPI.canonical_url("http://github.com/django/django.git")
-    'github.com/django/django'
-    >>> GitHubAPI.canonical_url("https://github.com/A/B/")
-    'github.com/a/b/'
-    """
-    url = project_url.lower()
-    for chunk in ("httpp://", "https://", "github.com"):
-        if url.startswith(chunk):
-            url = url[len(chunk):]
-    if url.endswith("/"):
-        url = url[:-1]
-    while url.endswith(".git"):
-        url = url[:-4]
-    return "github.com/" + url
-
-
 @staticmethod
 def activity(repo_name):
     # type: (str) -> dict
@@ -703,81 +1529,413 @@ def activity(repo_name):
 
 
 class GitHubAPIv4(GitHubAPI):
+    """ GraphQL methods on top of GitHubAPI.
+
+    It is the same pool of tokens as the GitHubAPI singleton: both share
+    tokens, scheduler, stores and metrics exporter, so that concurrency
+    caps, quotas and exported metrics cover requests made through either.
+    Arguments, if any, reinitialize the GitHubAPI singleton.
+    """
+    # max number of aliased nodes in a single query
+    batch_size = 50
+    # cost of the last query in GraphQL API points
+    graphql_cost = None
+
+    def __init__(self, *args, **kwargs):
+        rest = GitHubAPI._instance
+        if args or kwargs or not isinstance(rest, GitHubAPI):
+            rest = GitHubAPI(*args, **kwargs)
+        # not a copy: reinitializing either instance updates both
+        self.__dict__ = rest.__dict__
+
     def v4(self, query, **params):
         # type: (str) -> dict
         payload = json.dumps({"query": query, "variables": params})
         return self.request("graphql", 'post', data=payload)
 
-    def repo_issues(self, repo_name, cursor=None):
-        # type: (str, str) -> Iterable[dict]
-        owner, repo = repo_name.split("/")
-        query = """query ($owner: String!, $repo: String!, $cursor: String) {
-        repository(name: $repo, owner: $owner) {
-          hasIssuesEnabled
-            issues (first: 100, after: $cursor,
-              orderBy: {field:CREATED_AT, direction: ASC}) {
-                nodes {author {login}, closed, createdAt,
-                       updatedAt, number, title}
-                pageInfo {endCursor, hasNextPage}
-        }}}"""
-
-        while True:
-            data = self.v4(query, owner=owner, repo=repo, cursor=cursor
-                           )['data']['repository']
-            if not data:  # repository is empty, deleted or moved
-                break
-
-            for issue in data["issues"]:
-                yield {
-                    'author': issue['author']['login'],
-                    'closed': issue['closed'],
-                    'created_at': issue['createdAt'],
-                    'updated_at': issue['updatedAt'],
-                    'closed_at': None,
-                    'number': issue['number'],
-                    'title': issue['title']
-                }
+    def _aliased(self, template, var_types, values, chunksize=None):
+        # type: (str, dict, list, int) -> Iterable[tuple]
+        """ Run the same query for many values, using one request per chunk
+
+        :param template: GraphQL selection with variables suffixed by
+            %(i)d, e.g. 'repositoryOwner(login: $login%(i)d) {login}'
+        :param var_types: {variable name: GraphQL type}, e.g.
+            {'login': 'String!'}
+        :param values: list of dicts {variable name: value}
+        :param chunksize: max number of aliases per query
+        :return: generator of (value, node data or None if not found)
+        :raises GraphQLError: if a query keeps failing as a whole, or some
+            of its nodes failed for a reason other than being not found
+        """
+        chunksize = chunksize or self.batch_size
+        for start in range(0, len(values), chunksize):
+            chunk = values[start:start + chunksize]
+            declarations = []
+            selections = []
+            params = {}
+            for i, value in enumerate(chunk):
+                for name, var_type in var_types.items():
+                    declarations.append("$%s%d: %s" % (name, i, var_type))
+                    params["%s%d" % (name, i)] = value[name]
+                selections.append("n%d: %s" % (i, template % {'i': i}))
+
+            query = "query (%s) {\n%s\n%s\n}" % (
+                ", ".join(declarations), "\n".join(selections),
+                "rateLimit {cost, remaining, resetAt}")
+            for attempt in range(GRAPHQL_ATTEMPTS):
+                res = self.v4(query, **params)
+                if not isinstance(res, dict):
+                    res = {}
+                if res.get('data'):
+                    break
+                logger.warning("GraphQL batch query failed: %s",
+                               res.get('errors'))
+                if attempt + 1 < GRAPHQL_ATTEMPTS:
+                    time.sleep(BACKOFF_BASE * 2 ** attempt)
+            else:
+                raise GraphQLError("GraphQL batch query failed: %s" %
+                                   res.get('errors'))
+            data = res['data']
+            if data.get('rateLimit'):
+                self.graphql_cost = data['rateLimit']['cost']
+
+            # missing nodes are null and usually reported in 'errors' as
+            # NOT_FOUND; other errors mean that the node could not be fetched
+            failed = {}  # alias: error
+            for error in res.get('errors') or ():
+                alias = (error.get('path') or [None])[0]
+                if error.get('type') != 'NOT_FOUND' \
+                        and data.get(alias, False) is None:
+                    failed.setdefault(alias, error)
+            if failed:
+                raise GraphQLError("GraphQL query failed for %d nodes: %s" % (
+                    len(failed), list(failed.values())[0].get('message')))
+            for i, value in enumerate(chunk):
+                yield value, data.get("n%d" % i)
+
+    def repos_info(self, repo_names, chunksize=None):
+        # type: (Iterable[str], int) -> dict
+        """ Get basic info on many repositories at once
+        :param repo_names: iterable of 'owner/repo'
+        :return: {repo_name: dict or None if repository doesn't exist}.
+            Dicts use the same keys as REST API: full_name, fork,
+            pushed_at, created_at
+        """
+        template = """repository(owner: $owner%(i)d, name: $name%(i)d) {
+            nameWithOwner, isFork, pushedAt, createdAt}"""
+        values = [dict(zip(('owner', 'name'), name.split("/", 1)))
+                  for name in set(repo_names)]
+        res = {}
+        for value, repo in self._aliased(
+                template, {'owner': 'String!', 'name': 'String!'},
+                values, chunksize):
+            res[value['owner'] + "/" + value['name']] = repo and {
+                'full_name': repo['nameWithOwner'],
+                'fork': repo['isFork'],
+                'pushed_at': repo['pushedAt'],
+                'created_at': repo['createdAt'],
+            }
+        return res
+
+    def users_info(self, logins, chunksize=None):
+        # type: (Iterable[str], int) -> dict
+        """ Get profiles of many users or organizations at once
+        :param logins: iterable of user or organization logins
+        :return: {login: dict or None if account doesn't exist}.
+            Dicts use the same keys as REST API users/<login>: login,
+            type, name, email, created_at, public_repos, followers, following
+        """
+        template = """repositoryOwner(login: $login%(i)d) {
+            __typename, login
+            ... on User {name, email, createdAt,
+                repositories(privacy: PUBLIC) {totalCount}
+                followers {totalCount}, following {totalCount}}
+            ... on Organization {name, email, createdAt,
+                repositories(privacy: PUBLIC) {totalCount}}}"""
+        res = {}
+        for value, user in self._aliased(
+                template, {'login': 'String!'},
+                [{'login': login} for login in set(logins)], chunksize):
+            res[value['login']] = user and {
+                'login': user['login'],
+                'type': user['__typename'],
+                'name': user.get('name'),
+                # GraphQL returns empty string for non-public emails
+                'email': user.get('email') or None,
+                'created_at': user.get('createdAt'),
+                'public_repos': (user.get('repositories') or {}
+                                 ).get('totalCount'),
+                'followers': (user.get('followers') or {}).get('totalCount'),
+                'following': (user.get('following') or {}).get('totalCount'),
+            }
+        return res
+
+    # profiles made by users_info() lack most of REST API fields
+    partial_profiles = True
+
+    def _fetch_profiles(self, logins):
+        # type: (list) -> dict
+        # one GraphQL query per batch_size logins instead of a request each.
+        # Accounts that are not a RepositoryOwner (e.g. bots) are null just
+        # like missing ones, so nulls are left to REST API to tell apart
+        profiles = {}
+        for login, profile in self.users_info(logins).items():
+            if profile is None:
+                continue
+            if profile['type'] == 'Organization':
+                # not reported by GraphQL; REST API has them
+                del profile['followers'], profile['following']
+            profiles[login] = profile
+        return profiles
+
+    # GraphQL changeType: REST status
+    FILE_STATUSES = {'ADDED': 'added', 'DELETED': 'removed',
+                     'MODIFIED': 'modified', 'RENAMED': 'renamed',
+                     'COPIED': 'copied', 'CHANGED': 'changed'}
+
+    def prs_changedFiles(self, repo, pr_ids, chunksize=None):
+        # type: (str, Iterable[int], int) -> dict
+        """ Changed files of many pull requests, one query per chunk.
+        Pull requests with over 100 files, which GraphQL would have to
+        paginate one by one, are fetched via REST instead.
+        :return: {pr_id: list of dicts, see pr_changedFiles()}
+        """
+        owner, name = repo.split("/", 1)
+        template = """repository(owner: $owner%(i)d, name: $name%(i)d) {
+            pullRequest(number: $number%(i)d) {headRefOid
+                files(first: 100) {
+                    nodes {path, additions, deletions, changeType}
+                    pageInfo {hasNextPage}}}}"""
+        res = {}
+        truncated = []
+        for value, node in self._aliased(
+                template, {'owner': 'String!', 'name': 'String!',
+                           'number': 'Int!'},
+                [{'owner': owner, 'name': name, 'number': int(pr_id)}
+                 for pr_id in pr_ids], chunksize):
+            pr_id = value['number']
+            pr = (node or {}).get('pullRequest')
+            if not pr:
+                res[pr_id] = []
+            elif not pr['files'] or pr['files']['pageInfo']['hasNextPage']:
+                truncated.append(pr_id)
+            else:
+                sha = pr['headRefOid']
+                res[pr_id] = [{
+                    'filename': file['path'],
+                    'status': self.FILE_STATUSES.get(
+                        file['changeType'], file['changeType'].lower()),
+                    'additions': file['additions'],
+                    'deletions': file['deletions'],
+                    'changes': file['additions'] + file['deletions'],
+                    'blob_url': "https://github.com/%s/blob/%s/%s" % (
+                        repo, sha, file['path']),
+                    'raw_url': "https://github.com/%s/raw/%s/%s" % (
+                        repo, sha, file['path']),
+                    'contents_url': "https://api.github.com/repos/%s/"
+                                    "contents/%s?ref=%s" % (
+                                        repo, file['path'], sha)
+                } for file in pr['files']['nodes']]
+        res.update(super(GitHubAPIv4, self).prs_changedFiles(repo, truncated))
+        return res
+
+    # GraphQL selections used by crawl(); $cursor%(i)d is the page cursor
+    CRAWL_QUERIES = {
+        'issues': """issues(first: 100, after: $cursor%(i)d,
+                orderBy: {field: CREATED_AT, direction: ASC}) {
+            nodes {author {login}, closed, closedAt, createdAt, updatedAt,
+                   number, title}
+            pageInfo {endCursor, hasNextPage}}""",
+        'commits': """defaultBranchRef {target {... on Commit {
+            history(first: 100, after: $cursor%(i)d) {
+                nodes {oid, message, authoredDate, committedDate,
+                       author {name, email, user {login}}
+                       parents(first: 100) {nodes {oid}}}
+                pageInfo {endCursor, hasNextPage}}}}}""",
+    }
 
-            cursor = data["issues"]["pageInfo"]["endCursor"]
+    @staticmethod
+    def _crawl_connection(what, repo):
+        # type: (str, dict) -> dict
+        """ Get paginated connection from a crawl() repository node """
+        if what == 'issues':
+            return repo['issues']
+        # empty repositories don't have default branch
+        return ((repo.get('defaultBranchRef') or {}).get('target') or {}
+                ).get('history')
 
-            if not data["issues"]["pageInfo"]["hasNextPage"]:
-                break
+    @staticmethod
+    def _crawl_record(what, node):
+        # type: (str, dict) -> dict
+        """ Convert a crawl() node to the same format as REST API methods """
+        author = node['author'] or {}
+        if what == 'issues':
+            return {
+                'author': author.get('login'),
+                'closed': node['closed'],
+                'created_at': node['createdAt'],
+                'updated_at': node['updatedAt'],
+                'closed_at': node['closedAt'],
+                'number': node['number'],
+                'title': node['title']
+            }
+        return {
+            'sha': node['oid'],
+            'author': (author.get('user') or {}).get('login'),
+            'author_name': author.get('name'),
+            'author_email': author.get('email'),
+            'authored_date': node['authoredDate'],
+            'message': node['message'].replace("\n", ","),
+            'committed_date': node['committedDate'],
+            'parents': "\n".join(p['oid'] for p in node['parents']['nodes']),
+            'verified': None
+        }
 
-    def repo_commits(self, repo_name, cursor=None):
-        # type: (str, str) -> Iterable[dict]
-        """As of June 2017 GraphQL API does not allow to get commit parents
-        Until this issue is fixed this method is only left for a reference
-        Please use commits() instead"""
-        owner, repo = repo_name.split("/")
-        query = """query ($owner: String!, $repo: String!, $cursor: String) {
-        repository(name: $repo, owner: $owner) {
-          ref(qualifiedName: "master") {
-            target { ... on Commit {
-              history (first: 100, after: $cursor) {
-                nodes {sha:oid, author {name, email, user{login}}
-                       message, committedDate}
-                pageInfo {endCursor, hasNextPage}
-        }}}}}}"""
+    def _wait_for_budget(self):
+        """ Sleep until some token can afford the next query.
+        GraphQL API limits points rather than requests; the cost of the
+        last query is used as an estimate of the next one.
+        """
+        cost = self.graphql_cost or 1
+        limits = [token.limit['graphql'] for token in self.tokens]
+        if any(limit['remaining'] is None or limit['remaining'] >= cost
+               or (limit['reset_time'] or 0) <= time.time()
+               for limit in limits):
+            return
+        sleep = min(limit['reset_time'] for limit in limits) - time.time() + 1
+        logger.info("GraphQL budget exhausted (next query costs %d points), "
+                    "resuming in %d minutes, %d seconds",
+                    cost, *divmod(int(sleep), 60))
+        time.sleep(sleep)
+
+    def crawl(self, repo_names, what='issues', repos_per_query=10,
+              cursors=None, spill=None, checkpoint=False):
+        # type: (Iterable[str], str, int, dict, dict, bool) -> Iterable[tuple]
+        """ Crawl issues or commits of many repositories at once.
+        Up to `repos_per_query` repositories are paginated simultaneously,
+        each under its own alias and cursor; once one is exhausted, the next
+        takes its place. Queries are scheduled against GraphQL point budget
+        reported by `rateLimit` in every response.
+
+        :param repo_names: iterable of 'owner/repo'
+        :param what: {'issues'|'commits'}. Commits are taken from the
+            default branch history and include parents.
+        :param cursors: optional {repo_name: cursor} to resume from
+        :param spill: optional {repo_name: file path}. Records are appended
+            there as JSON lines before they are produced, like in
+            GitHubAPI.iter_pages()
+        :param checkpoint: bool, requires a spill file for every repository.
+            Journal the cursor of every page taken by the consumer (see
+            cache.CheckpointJournal) until the repository is exhausted.
+            Crawls of repositories interrupted midway resume from the
+            journaled cursor, unless `cursors` has one; records of earlier
+            pages are read back from the spill file.
+        :return: generator of (repo_name, record) tuples. Records have the
+            same format as GitHubAPI.repo_issues() / repo_commits()
+        """
+        template = "repository(owner: $owner%(i)d, name: $name%(i)d) {" + \
+                   self.CRAWL_QUERIES[what] + "}"
+        var_types = {'owner': 'String!', 'name': 'String!',
+                     'cursor': 'String'}
+        pending = iter(repo_names)
+        cursors = cursors or {}
+        spill = spill or {}
+        active = {}  # repo_name: cursor
+        journal = self.checkpoints if checkpoint else None
+        # repo_name: number of records and spill file size before the crawl,
+        # for the journal
+        rows = {}
+        starts = {}
+
+        def journal_key(repo_name):
+            return "graphql:%s:%s" % (what, repo_name)
 
         while True:
-            data = self.v4(query, owner=owner, repo=repo, cursor=cursor
-                           )['data']['repository']
-            if not data:
+            while len(active) < repos_per_query:
+                repo_name = next(pending, None)
+                if repo_name is None:
+                    break
+                active[repo_name] = cursors.get(repo_name)
+                rows[repo_name] = 0
+                if not checkpoint:
+                    continue
+                path = spill.get(repo_name)
+                if path is None:
+                    raise ValueError("Checkpoints require a spill file")
+                entry = journal and journal.get(journal_key(repo_name))
+                if entry is not None and (entry['spill'] != path or not (
+                        os.path.isfile(path) and
+                        os.path.getsize(path) >= entry['end'])):
+                    entry = None  # spill file has changed, start over
+                if entry is not None and active[repo_name] is None:
+                    logger.info("%s: resuming %s crawl, %d records fetched",
+                                repo_name, what, entry['rows'])
+                    active[repo_name] = entry['position']
+                    rows[repo_name] = entry['rows']
+                    starts[repo_name] = entry['start']
+                    for page in self._replay_spill(
+                            path, entry['start'], entry['end']):
+                        for record in page:
+                            yield repo_name, record
+                else:
+                    starts[repo_name] = \
+                        os.path.getsize(path) if os.path.isfile(path) else 0
+            if not active:
                 break
 
-            for commit in data["ref"]["target"]["history"]["nodes"]:
-                yield {
-                    'sha': commit['sha'],
-                    'author': commit['author']['user']['login'],
-                    'author_name': commit['author']['name'],
-                    'author_email': commit['author']['email'],
-                    'authored_date': None,
-                    'message': commit['message'],
-                    'committed_date': commit['committedDate'],
-                    'parents': None,
-                    'verified': None
-                }
-
-            cursor = data["ref"]["target"]["history"]["pageInfo"]["endCursor"]
-            if not data["ref"]["target"]["history"]["pageInfo"]["hasNextPage"]:
-                break
+            values = []
+            for repo_name, cursor in active.items():
+                owner, name = repo_name.split("/", 1)
+                values.append({'owner': owner, 'name': name,
+                               'cursor': cursor, 'repo': repo_name})
+
+            self._wait_for_budget()
+            for value, repo in self._aliased(
+                    template, var_types, values, chunksize=len(values)):
+                repo_name = value['repo']
+                # repository is deleted, moved or empty
+                connection = repo and self._crawl_connection(what, repo)
+                if not connection:
+                    del active[repo_name]
+                    if journal is not None:
+                        journal.delete(journal_key(repo_name))
+                    continue
+                records = [self._crawl_record(what, node)
+                           for node in connection['nodes']]
+                path = spill.get(repo_name)
+                if path is not None:
+                    with open(path, 'a') as fh:
+                        for record in records:
+                            fh.write(json.dumps(record) + "\n")
+                for record in records:
+                    yield repo_name, record
+                rows[repo_name] += len(records)
+                if connection['pageInfo']['hasNextPage']:
+                    active[repo_name] = connection['pageInfo']['endCursor']
+                    if journal is not None:
+                        journal.put(journal_key(repo_name), active[repo_name],
+                                    rows[repo_name], path, starts[repo_name],
+                                    os.path.getsize(path))
+                else:
+                    del active[repo_name]
+                    if journal is not None:
+                        journal.delete(journal_key(repo_name))
+
+    def repo_issues(self, repo_name, cursor=None, spill=None,
+                    checkpoint=False):
+        # type: (str, str, str, bool) -> Iterable[dict]
+        for _, issue in self.crawl([repo_name], 'issues',
+                                   checkpoint=checkpoint,
+                                   cursors={repo_name: cursor},
+                                   spill={repo_name: spill}):
+            yield issue
+
+    def repo_commits(self, repo_name, cursor=None, spill=None,
+                     checkpoint=False):
+        # type: (str, str, str, bool) -> Iterable[dict]
+        """ Commits of the default branch, see crawl() """
+        for _, commit in self.crawl([repo_name], 'commits',
+                                    checkpoint=checkpoint,
+                                    cursors={repo_name: cursor},
+                                    spill={repo_name: spill}):
+            yield commit
@@ -0,0 +1,188 @@
+""" Per-token telemetry of GitHub API usage.
+
+Every GitHubAPIToken keeps a TokenStats instance; snapshot() collects them
+along with rate limits, and write() exports the result either as JSON or
+in Prometheus textfile format (for node_exporter's textfile collector).
+During crawls, an Exporter thread rewrites the file periodically.
+"""
+
+import collections
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+# upper bounds of request latency histogram buckets, seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+logger = logging.getLogger('ghd.scraper')
+
+
+class TokenStats(object):
+    """ Thread-safe counters of a single token """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.statuses = collections.Counter()  # HTTP status or error name
+        # non-cumulative, the last one is for latencies above all buckets
+        self.latency_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.backoff_seconds = 0.0
+
+    def observe(self, status, latency):
+        # type: (object, float) -> None
+        """ Record a request; status is an int or an error name """
+        bucket = len(LATENCY_BUCKETS)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                bucket = i
+                break
+        with self._lock:
+            self.statuses[str(status)] += 1
+            self.latency_counts[bucket] += 1
+            self.latency_sum += latency
+
+    def backoff(self, seconds):
+        # type: (float) -> None
+        with self._lock:
+            self.backoff_seconds += seconds
+
+    def snapshot(self):
+        # type: () -> dict
+        with self._lock:
+            return {
+                'requests': sum(self.statuses.values()),
+                'statuses': dict(self.statuses),
+                'latency_counts': list(self.latency_counts),
+                'latency_sum': self.latency_sum,
+                'backoff_seconds': self.backoff_seconds,
+            }
+
+
+def token_label(token):
+    # type: (GitHubAPIToken) -> str
+    """ Identify a token without disclosing it """
+    return "..." + (token.token or "")[-4:]
+
+
+def snapshot(api):
+    # type: (GitHubAPI) -> dict
+    """ Collect stats and rate limits of all tokens of a GitHubAPI instance
+    """
+    now = time.time()
+    tokens = []
+    for token in api.tokens:
+        stats = token.stats.snapshot()
+        stats['token'] = token_label(token)
+        stats['limits'] = {
+            api_class: dict(limit, reset_in=limit['reset_time'] and
+                            max(limit['reset_time'] - now, 0))
+            for api_class, limit in token.limit.items()}
+        tokens.append(stats)
+    return {
+        'time': now,
+        'tokens': tokens,
+        'wait_seconds': dict(api.scheduler.wait_seconds),
+    }
+
+
+def to_prometheus(data):
+    # type: (dict) -> str
+    """ Render snapshot() output in Prometheus text format """
+    lines = []
+
+    def metric(name, kind, doc, samples):
+        lines.append("# HELP ghd_github_%s %s" % (name, doc))
+        lines.append("# TYPE ghd_github_%s %s" % (name, kind))
+        for suffix, labels, value in samples:
+            lines.append("ghd_github_%s%s{%s} %s" % (
+                name, suffix, ",".join('%s="%s"' % label for label in labels),
+                value))
+
+    tokens = data['tokens']
+    metric('requests_total', 'counter', "Requests by response status",
+           [('', (('token', t['token']), ('status', status)), count)
+            for t in tokens
+            for status, count in sorted(t['statuses'].items())])
+
+    samples = []
+    for t in tokens:
+        label = ('token', t['token'])
+        cumulative = 0
+        bounds = [str(b) for b in LATENCY_BUCKETS] + ['+Inf']
+        for bound, count in zip(bounds, t['latency_counts']):
+            cumulative += count
+            samples.append(('_bucket', (label, ('le', bound)), cumulative))
+        samples.append(('_sum', (label,), t['latency_sum']))
+        samples.append(('_count', (label,), cumulative))
+    metric('request_seconds', 'histogram', "Request latency", samples)
+
+    metric('backoff_seconds_total', 'counter',
+           "Time the token was put aside after errors",
+           [('', (('token', t['token']),), t['backoff_seconds'])
+            for t in tokens])
+    for field, name, doc in (
+            ('remaining', 'rate_limit_remaining', "Remaining quota"),
+            ('reset_in', 'rate_limit_reset_seconds', "Time to quota reset")):
+        metric(name, 'gauge', doc, [
+            ('', (('token', t['token']), ('api_class', api_class)),
+             limit[field])
+            for t in tokens for api_class, limit in sorted(
+                t['limits'].items()) if limit[field] is not None])
+    metric('wait_seconds_total', 'counter',
+           "Time requests waited for a token",
+           [('', (('api_class', api_class),), seconds)
+            for api_class, seconds in sorted(data['wait_seconds'].items())])
+    return "\n".join(lines) + "\n"
+
+
+def write(api, path):
+    # type: (GitHubAPI, str) -> None
+    """ Export stats to a .json file or, otherwise, a Prometheus textfile.
+    The file is replaced atomically, so readers never see a partial one.
+    Every write goes through its own temporary file, so that an exporter
+    being replaced (see GitHubAPI.__init__) can't break the next one's.
+    """
+    data = snapshot(api)
+    if path.endswith('.json'):
+        content = json.dumps(data, indent=2)
+    else:
+        content = to_prometheus(data)
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=os.path.basename(path) + '.',
+        dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(content)
+        # mkstemp creates files only readable by the owner
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+class Exporter(threading.Thread):
+    """ Background thread calling write() every `interval` seconds """
+
+    def __init__(self, api, path, interval=15):
+        super(Exporter, self).__init__()
+        self.daemon = True
+        self.api = api
+        self.path = path
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                write(self.api, self.path)
+            except Exception:
+                # e.g. disk is full; keep exporting, it might recover
+                logger.exception("Failed to export metrics to %s",
+                                 self.path)
+
+    def stop(self):
+        self._stopped.set()
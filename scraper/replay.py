@@ -0,0 +1,347 @@
+""" Offline stand-in for GitHub API, to measure scraper performance
+without spending real quota.
+
+- record() captures real responses of a GitHubAPI instance
+- ReplayServer serves recorded (or synthetic()) responses locally,
+    emulating rate limits, 403/5xx faults and network latency
+- benchmark() runs typical scraping tasks against the server and reports
+    request rate, API calls per repository and wall time
+
+A typical run:
+
+    with ReplayServer(synthetic(['a/b']), latency=0.05) as server:
+        print(benchmark(replay_api(server), server, ['a/b']))
+"""
+
+from __future__ import print_function
+
+import collections
+import contextlib
+import json
+import random
+import threading
+import time
+
+import pandas as pd
+import requests
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlsplit, parse_qsl
+except ImportError:  # Python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit, parse_qsl
+
+from scraper import cache
+from scraper import github
+
+# response headers kept in recordings; others are not used by the scraper
+RECORDED_HEADERS = ('Link', 'ETag', 'Last-Modified', 'Retry-After',
+                    'X-RateLimit-Limit', 'X-RateLimit-Remaining',
+                    'X-RateLimit-Reset')
+
+# scenario name: function(api, repo_name, issue numbers)
+SCENARIOS = collections.OrderedDict([
+    ('repo_commits',
+     lambda api, repo, issues: sum(1 for _ in api.repo_commits(repo))),
+    ('repo_issues',
+     lambda api, repo, issues: sum(1 for _ in api.repo_issues(repo))),
+    ('issue_pr_timeline',
+     lambda api, repo, issues: sum(
+         len(api.issue_pr_timeline(repo, issue)) for issue in issues)),
+])
+
+
+class _RecordingSession(object):
+    """ Wrapper of requests.Session appending GET responses to a file """
+    def __init__(self, session, api_url, fh, lock):
+        self.session = session
+        self.api_url = api_url
+        self.fh = fh
+        self.lock = lock
+
+    def request(self, method, url, params=None, **kwargs):
+        r = self.session.request(method, url, params=params, **kwargs)
+        if method.lower() == 'get' and r.status_code != 304:
+            record = {
+                'key': cache.request_key(url[len(self.api_url):], params),
+                'status': r.status_code,
+                'headers': {header: r.headers[header]
+                            for header in RECORDED_HEADERS
+                            if header in r.headers},
+                'body': r.text
+            }
+            with self.lock:
+                self.fh.write(json.dumps(record) + "\n")
+        return r
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+
+@contextlib.contextmanager
+def record(api, path):
+    # type: (github.GitHubAPI, str) -> None
+    """ Append all GET responses received by `api` to a JSON lines file.
+    Caches are bypassed meanwhile, so that every response is complete.
+    So are other stores answering requests without the network (known
+    missing resources, checkpoints) or rewriting them (redirects), so that
+    every request is recorded as made.
+    """
+    stores = {name: getattr(api, name) for name in (
+        'responses', 'profiles', 'negative', 'redirects', 'checkpoints')}
+    etags = [token.etags for token in api.tokens]
+    sessions = [token.session for token in api.tokens]
+    lock = threading.Lock()
+    with open(path, 'a') as fh:
+        for name in stores:
+            setattr(api, name, None)
+        for token in api.tokens:
+            token.etags = None
+            token.session = _RecordingSession(
+                token.session, token.api_url, fh, lock)
+        try:
+            yield
+        finally:
+            for name, store in stores.items():
+                setattr(api, name, store)
+            for token, token_etags, session in zip(
+                    api.tokens, etags, sessions):
+                token.etags = token_etags
+                token.session = session
+
+
+def load(path):
+    # type: (str) -> dict
+    """ Read a recording made by record()
+    :return: {request key: (status, headers, body)}; later records of the
+        same request take precedence
+    """
+    responses = {}
+    with open(path) as fh:
+        for line in fh:
+            r = json.loads(line)
+            responses[r['key']] = (r['status'], r['headers'], r['body'])
+    return responses
+
+
+def _paginate(url, params, items, per_page=100):
+    # type: (str, dict, list, int) -> Iterable[tuple]
+    """ Generate recording entries of a paginated list """
+    last = max((len(items) - 1) // per_page + 1, 1)
+    for page in range(1, last + 1):
+        headers = {}
+        if page < last:
+            headers['Link'] = \
+                '<%s?page=%d>; rel="next", <%s?page=%d>; rel="last"' % (
+                    url, page + 1, url, last)
+        key = cache.request_key(url, dict(params, page=page, per_page=100))
+        yield key, (200, headers, json.dumps(
+            items[(page - 1) * per_page:page * per_page]))
+
+
+def synthetic(repos, commits=1000, issues=300, events=20):
+    # type: (list, int, int, int) -> dict
+    """ Generate responses for repos having the given number of commits,
+    issues (every third of them is a pull request) and timeline events
+    per issue, in the format of load()
+    """
+    user = {'login': 'user', 'type': 'User'}
+    responses = {}
+    for repo in repos:
+        commit_list = [{
+            'sha': '%040x' % i, 'author': user, 'parents': [],
+            'commit': {
+                'author': {'name': 'User', 'email': 'user@example.com',
+                           'date': '2018-01-01T00:00:00Z'},
+                'committer': {'date': '2018-01-01T00:00:00Z'},
+                'message': 'commit %d' % i}
+        } for i in range(commits)]
+        issue_list = [{
+            'number': i, 'title': 'issue %d' % i, 'user': user,
+            'state': 'closed', 'created_at': '2018-01-01T00:00:00Z',
+            'updated_at': '2018-01-02T00:00:00Z',
+            'closed_at': '2018-01-02T00:00:00Z'
+        } for i in range(1, issues + 1)]
+        for issue in issue_list[::3]:
+            issue['pull_request'] = {'merged_at': None}
+        event_list = [{
+            'event': 'commented', 'created_at': '2018-01-01T00:00:00Z',
+            'user': user, 'author_association': 'NONE', 'body': 'comment'
+        }] * events
+
+        lists = [("repos/%s/commits" % repo, {}, commit_list),
+                 ("repos/%s/issues" % repo, {'state': 'all'}, issue_list)]
+        lists.extend(("repos/%s/issues/%d/timeline" % (repo, i),
+                      {'state': 'all'}, event_list)
+                     for i in range(1, issues + 1))
+        for url, params, items in lists:
+            responses.update(_paginate(url, params, items))
+    return responses
+
+
+class _ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    def do_GET(self):
+        status, headers, body = self.server.respond(
+            self.path, self.headers.get('Authorization'))
+        body = body.encode('utf8')
+        self.send_response(status)
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass  # no logging to stderr
+
+
+class ReplayServer(ThreadingMixIn, HTTPServer):
+    """ Local HTTP server answering GET requests with recorded responses.
+
+    Every token (Authorization header) gets `rate_limit` requests per
+    `reset_interval` seconds, reported in X-RateLimit-* headers, and 403
+    once exhausted. A `fault_rate` share of requests fails with either
+    a secondary rate limit 403 (Retry-After: 1) or 502. Every response is
+    delayed by `latency` seconds. Unknown requests get 404.
+
+    Stats (number of responses by status) are kept in .stats
+    """
+    daemon_threads = True
+
+    def __init__(self, responses, latency=0, fault_rate=0, rate_limit=5000,
+                 reset_interval=3600, seed=0, port=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), _ReplayHandler)
+        self.responses = responses
+        self.latency = latency
+        self.fault_rate = fault_rate
+        self.rate_limit = rate_limit
+        self.reset_interval = reset_interval
+        self.stats = collections.Counter()
+        self._quota = {}  # token: [remaining, reset time]
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/" % self.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def respond(self, path, token):
+        # type: (str, str) -> (int, dict, str)
+        if self.latency:
+            time.sleep(self.latency)
+        now = int(time.time())
+        with self._lock:
+            quota = self._quota.get(token)
+            if quota is None or quota[1] <= now:
+                quota = self._quota[token] = \
+                    [self.rate_limit, now + self.reset_interval]
+            exhausted = quota[0] == 0
+            quota[0] = max(quota[0] - 1, 0)
+            fault = not exhausted and self._random.random() < self.fault_rate
+            fault_status = self._random.choice((403, 502))
+            headers = {'X-RateLimit-Limit': str(self.rate_limit),
+                       'X-RateLimit-Remaining': str(quota[0]),
+                       'X-RateLimit-Reset': str(quota[1])}
+
+        parts = urlsplit(path)
+        key = cache.request_key(
+            parts.path.lstrip('/'), dict(parse_qsl(parts.query)))
+        if exhausted:
+            status, body = 403, {'message': 'API rate limit exceeded'}
+        elif fault and fault_status == 403:
+            headers['Retry-After'] = '1'
+            status, body = 403, {
+                'message': 'You have exceeded a secondary rate limit'}
+        elif fault:
+            status, body = 502, {'message': 'Server Error'}
+        elif key in self.responses:
+            status, recorded, body = self.responses[key]
+            headers.update((header, value)
+                           for header, value in recorded.items()
+                           if not header.startswith('X-RateLimit'))
+            body = json.loads(body)
+        else:
+            status, body = 404, {'message': 'Not Found'}
+        with self._lock:
+            self.stats[status] += 1
+        return status, headers, json.dumps(body)
+
+
+def replay_api(server, tokens=4, concurrency=github._concurrency,
+               pacing=False):
+    # type: (ReplayServer, int, int, bool) -> github.GitHubAPI
+    """ Get a GitHubAPI instance talking to the replay server.
+    Note that GitHubAPI is a singleton, so this instance replaces the
+    one shared by the rest of the process. Persistent caches are disabled.
+    """
+    api = github.GitHubAPI(
+        ['replay%d' % i for i in range(tokens)], concurrency=concurrency,
+        pacing=pacing, etag_cache=None, profile_cache=None,
+        response_cache=None, ledger=None, checkpoints=None,
+        redirects=None, negative_cache=None)
+    for token in api.tokens:
+        token.api_url = server.url
+        token.session.mount(server.url, requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=api.concurrency))
+    return api
+
+
+def run(api, repos, scenario, issues=10, workers=1):
+    # type: (github.GitHubAPI, list, str, int, int) -> int
+    """ Run a scenario on all repositories, return the number of records """
+    func = SCENARIOS[scenario]
+    return sum(github._concurrent_map(
+        lambda repo: func(api, repo, range(1, issues + 1)), repos, workers))
+
+
+def benchmark(api, server, repos, scenarios=None, issues=10, workers=1):
+    # type: (github.GitHubAPI, ReplayServer, list, list, int, int) -> ...
+    """ Run scenarios against the replay server
+    :param issues: number of issues per repository to get timelines of
+    :param workers: number of repositories processed at once
+    :return: pd.DataFrame indexed by scenario name, with columns:
+        records, requests, faults (403/5xx responses), wall_time (seconds),
+        requests_per_second, calls_per_repo
+    """
+    df = pd.DataFrame(columns=('records', 'requests', 'faults', 'wall_time',
+                               'requests_per_second', 'calls_per_repo'))
+    for scenario in scenarios or SCENARIOS:
+        before = server.stats.copy()
+        start = time.time()
+        records = run(api, repos, scenario, issues, workers)
+        wall_time = time.time() - start
+        stats = server.stats - before
+        requests_made = sum(stats.values())
+        df.loc[scenario] = {
+            'records': records,
+            'requests': requests_made,
+            'faults': sum(count for status, count in stats.items()
+                          if status in (403, 429) + github.RETRY_STATUSES),
+            'wall_time': wall_time,
+            'requests_per_second': requests_made / max(wall_time, 1e-6),
+            'calls_per_repo': requests_made / float(len(repos))
+        }
+    return df
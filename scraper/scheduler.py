@@ -0,0 +1,216 @@
+import collections
+import heapq
+import itertools
+import logging
+import threading
+import time
+from datetime import datetime
+
+logger = logging.getLogger('ghd.scraper')
+
+API_CLASSES = ('core', 'search', 'graphql')
+# request priority classes, the highest first
+PRIORITIES = ('interactive', 'normal', 'bulk')
+
+
+class TokenScheduler(object):
+    """ Hand out GitHub API tokens to concurrent requests.
+
+    Every API class (core, search, graphql) has its own pool of two heaps:
+    - ready: tokens usable right away, the most remaining quota first,
+        then the earliest reset time
+    - waiting: exhausted or paced tokens, ordered by the time they
+        become ready again
+
+    Heap entries are never updated in place. Instead, every change of token
+    state bumps its version and pushes a new entry; outdated ones are
+    discarded when popped.
+
+    With pacing enabled, a token rests (time to reset) / (remaining quota)
+    seconds after each request, which spreads its quota evenly over the
+    reset window instead of draining it in a burst and then sleeping.
+    This also caps the token at its average quota rate, so pacing is off
+    by default; it only pays off for crawls that would use up the quota
+    anyway.
+
+    Every request has a priority class (see PRIORITIES). Callers of a lower
+    class wait while there are higher class callers waiting for the same
+    API class. Besides, `reserve` keeps a share of every token's quota for
+    higher classes: e.g. with {'bulk': 0.2}, bulk requests don't touch
+    the last 20% of a token's quota until it resets.
+    """
+    tokens = None
+    concurrency = None
+    pacing = None
+    reserve = None  # priority: share of quota it can't use
+    wait_seconds = None  # api_class: total time callers waited for a token
+
+    def __init__(self, tokens, concurrency, pacing=False, reserve=None):
+        self.tokens = tokens
+        self.concurrency = concurrency
+        self.pacing = pacing
+        self.reserve = dict(reserve or {})
+        unknown = set(self.reserve) - set(PRIORITIES)
+        if unknown:
+            raise ValueError("Unknown priority classes: %s" % ", ".join(
+                sorted(unknown)))
+        self.wait_seconds = collections.Counter()
+        self._waiters = collections.Counter()  # (api_class, priority): int
+        self._cv = threading.Condition()
+        self._seq = itertools.count()  # tie breaker, tokens aren't comparable
+        self._pools = {api_class: {'ready': [], 'waiting': []}
+                       for api_class in API_CLASSES}
+        self._versions = {}  # (token idx, api_class): int
+        self._next_slot = {}  # (token idx, api_class): earliest time to use
+        with self._cv:
+            for idx in range(len(tokens)):
+                for api_class in API_CLASSES:
+                    self._schedule(idx, api_class)
+
+    @staticmethod
+    def _priority(token, api_class):
+        limit = token.limit[api_class]
+        remaining = limit['remaining']
+        if remaining is None:  # unknown yet, likely a fresh token
+            remaining = float('inf')
+        return -remaining, limit['reset_time'] or 0
+
+    def _ready_at(self, idx, api_class):
+        # token.when() accepts urls; API class names map to themselves
+        return max(self.tokens[idx].when(api_class) or 0,
+                   self._next_slot.get((idx, api_class), 0))
+
+    def _interval(self, token, api_class):
+        if not self.pacing:
+            return 0
+        limit = token.limit[api_class]
+        if not limit['remaining'] or not limit['reset_time']:
+            return 0
+        return max(limit['reset_time'] - time.time(), 0) \
+            / float(limit['remaining'])
+
+    def _reserved_until(self, token, api_class, priority):
+        """ Reset time of the token if the rest of its quota is reserved
+        for classes above `priority`, 0 otherwise """
+        share = self.reserve.get(priority)
+        limit = token.limit[api_class]
+        if not share or limit['remaining'] is None or not limit['limit'] \
+                or (limit['reset_time'] or 0) <= time.time():
+            return 0
+        if limit['remaining'] > share * limit['limit']:
+            return 0
+        return limit['reset_time']
+
+    def _schedule(self, idx, api_class):
+        """ (Re)place token into the right heap. Must hold the lock """
+        key = (idx, api_class)
+        version = self._versions[key] = self._versions.get(key, 0) + 1
+        token = self.tokens[idx]
+        if token.in_flight >= self.concurrency:
+            return  # will be rescheduled on release
+
+        pool = self._pools[api_class]
+        ready_at = self._ready_at(idx, api_class)
+        if ready_at > time.time():
+            heapq.heappush(pool['waiting'],
+                           (ready_at, next(self._seq), version, idx))
+        else:
+            heapq.heappush(pool['ready'], self._priority(token, api_class) +
+                           (next(self._seq), version, idx))
+
+        # outdated entries of a rarely used pool (e.g. search) are not popped
+        # often enough, so clean them up once in a while
+        for name, heap in pool.items():
+            if len(heap) > 4 * len(self.tokens) + 16:
+                pool[name] = [entry for entry in heap if entry[-2] ==
+                              self._versions[(entry[-1], api_class)]]
+                heapq.heapify(pool[name])
+
+    def _pop(self, api_class, priority='normal'):
+        """ Get the best ready token index or None. Must hold the lock """
+        pool = self._pools[api_class]
+        now = time.time()
+        while pool['waiting'] and pool['waiting'][0][0] <= now:
+            _, _, version, idx = heapq.heappop(pool['waiting'])
+            if version == self._versions[(idx, api_class)]:
+                self._schedule(idx, api_class)
+
+        while pool['ready']:
+            entry = pool['ready'][0]
+            version, idx = entry[-2:]
+            if version != self._versions[(idx, api_class)]:
+                heapq.heappop(pool['ready'])
+                continue
+            token = self.tokens[idx]
+            # limits might have changed since the entry was pushed
+            if self._ready_at(idx, api_class) > now \
+                    or self._priority(token, api_class) != entry[:2]:
+                heapq.heappop(pool['ready'])
+                self._schedule(idx, api_class)
+                continue
+            # the rest of tokens have even less quota left
+            if self._reserved_until(token, api_class, priority):
+                return None
+            heapq.heappop(pool['ready'])
+            return idx
+        return None
+
+    def acquire(self, api_class, priority='normal'):
+        # type: (str, str) -> GitHubAPIToken
+        """ Block until a token is available for the given API class """
+        rank = PRIORITIES.index(priority)
+        start = time.time()
+        with self._cv:
+            self._waiters[(api_class, priority)] += 1
+            try:
+                while True:
+                    # higher classes go first
+                    if any(self._waiters[(api_class, p)]
+                           for p in PRIORITIES[:rank]):
+                        self._cv.wait()
+                        continue
+
+                    idx = self._pop(api_class, priority)
+                    if idx is not None:
+                        self.wait_seconds[api_class] += time.time() - start
+                        token = self.tokens[idx]
+                        token.in_flight += 1
+                        self._next_slot[(idx, api_class)] = \
+                            time.time() + self._interval(token, api_class)
+                        for cls in API_CLASSES:
+                            self._schedule(idx, cls)
+                        return token
+
+                    pool = self._pools[api_class]
+                    wake_at = [pool['waiting'][0][0]] \
+                        if pool['waiting'] else []
+                    if pool['ready']:  # the best token is reserved
+                        wake_at.append(self._reserved_until(
+                            self.tokens[pool['ready'][0][-1]], api_class,
+                            priority))
+                    if not wake_at:  # all tokens are busy, wait for release
+                        self._cv.wait()
+                        continue
+
+                    sleep = min(wake_at) - time.time()
+                    if sleep > 60:
+                        logger.info(
+                            "%s: out of keys for %s requests, resuming in "
+                            "%d minutes, %d seconds",
+                            datetime.now().strftime("%H:%M"), priority,
+                            *divmod(int(sleep) + 1, 60))
+                    # releases the lock, so other threads can return tokens
+                    self._cv.wait(max(sleep, 0.01))
+            finally:
+                self._waiters[(api_class, priority)] -= 1
+                # lower classes might have been waiting for this one
+                self._cv.notify_all()
+
+    def release(self, token):
+        # type: (GitHubAPIToken) -> None
+        with self._cv:
+            token.in_flight -= 1
+            idx = self.tokens.index(token)
+            for api_class in API_CLASSES:
+                self._schedule(idx, api_class)
+            self._cv.notify_all()
@@ -0,0 +1,1346 @@
+from __future__ import unicode_literals, print_function
+
+import datetime
+import gzip
+import itertools
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import pandas as pd
+import requests
+
+from scraper import cache
+from scraper import gharchive
+from scraper import github
+from scraper import metrics
+from scraper import replay
+from scraper import utils
+
+
+def response(status=200, payload=None, headers=None, url=""):
+    """ Build a requests.Response as if it came from GitHub """
+    r = requests.Response()
+    r.status_code = status
+    r.url = url
+    r._content = json.dumps(payload).encode('utf8')
+    r.headers.update(headers or {})
+    return r
+
+
+class FakeSession(object):
+    """ Stand-in for requests.Session serving canned responses by URL.
+    `routes` is a callable taking (method, url, params, headers, data) and
+    returning a requests.Response.
+    """
+    def __init__(self, routes, delay=0):
+        self.routes = routes
+        self.delay = delay
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def request(self, method, url, params=None, data=None, headers=None,
+                timeout=None, **kwargs):
+        with self._lock:
+            self.calls.append((method, url, dict(params or {})))
+        if self.delay:
+            time.sleep(self.delay)
+        return self.routes(method, url, dict(params or {}), headers or {},
+                           data)
+
+
+def fake_api(routes, n_tokens=2, concurrency=2, delay=0, api_class=None,
+             **kwargs):
+    kwargs.setdefault('etag_cache', None)
+    kwargs.setdefault('profile_cache', None)
+    kwargs.setdefault('response_cache', None)
+    kwargs.setdefault('ledger', None)
+    kwargs.setdefault('pacing', False)
+    kwargs.setdefault('quota_reserve', None)
+    kwargs.setdefault('checkpoints', None)
+    kwargs.setdefault('redirects', None)
+    kwargs.setdefault('negative_cache', None)
+    api = (api_class or github.GitHubAPI)(
+        ['token%d' % i for i in range(n_tokens)],
+        concurrency=concurrency, **kwargs)
+    for token in api.tokens:
+        token.session = FakeSession(routes, delay)
+    return api
+
+
+def rate_headers(remaining=4999, reset=None):
+    return {
+        'X-RateLimit-Remaining': str(remaining),
+        'X-RateLimit-Limit': '5000',
+        'X-RateLimit-Reset': str(int(reset or time.time() + 3600)),
+    }
+
+
+class TestGitHubAPI(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_token_session(self):
+        token = github.GitHubAPIToken('abc')
+        self.assertIsInstance(token.session, requests.Session)
+
+    def test_concurrency_cap(self):
+        active = {'now': 0, 'max': 0}
+        lock = threading.Lock()
+
+        def routes(method, url, params, headers, data=None):
+            with lock:
+                active['now'] += 1
+                active['max'] = max(active['max'], active['now'])
+            time.sleep(0.05)
+            with lock:
+                active['now'] -= 1
+            return response(200, {'ok': True}, rate_headers())
+
+        api = fake_api(routes, n_tokens=2, concurrency=2)
+        # distinct URLs, identical requests would be coalesced
+        threads = [threading.Thread(target=api.request, args=('users/%d' % i,))
+                   for i in range(10)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+
+        self.assertLessEqual(active['max'], 4)
+        self.assertTrue(all(t.in_flight == 0 for t in api.tokens))
+        self.assertEqual(
+            10, sum(len(t.session.calls) for t in api.tokens))
+
+    def test_coalescing(self):
+        def routes(method, url, params, headers, data=None):
+            return response(200, {'login': url.rsplit('/', 1)[-1]},
+                            rate_headers())
+
+        api = fake_api(routes, n_tokens=2, delay=0.1)
+        results = []
+        threads = [threading.Thread(
+            target=lambda login: results.append(
+                api.request('users/' + login)), args=(login,))
+            for login in ('a', 'a', 'a', 'a', 'b')]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+
+        self.assertEqual(sorted(r['login'] for r in results),
+                         ['a', 'a', 'a', 'a', 'b'])
+        self.assertEqual(
+            2, sum(len(t.session.calls) for t in api.tokens))
+        self.assertFalse(api._pending)
+
+    def test_parallel_pagination(self):
+        last = 7
+
+        def routes(method, url, params, headers, data=None):
+            page = params['page']
+            links = ['<%s?page=%d>; rel="next"' % (url, page + 1),
+                     '<%s?page=%d>; rel="last"' % (url, last)]
+            headers = rate_headers()
+            if page < last:
+                headers['Link'] = ", ".join(links)
+            return response(200, [page * 100 + i for i in range(3)], headers)
+
+        api = fake_api(routes, n_tokens=2, concurrency=2, delay=0.01)
+        res = api.request('repos/a/b/commits', paginate=True, parallel=True)
+        self.assertEqual(
+            res, [p * 100 + i for p in range(1, last + 1) for i in range(3)])
+        pages = sorted(params['page'] for t in api.tokens
+                       for _, _, params in t.session.calls)
+        self.assertEqual(pages, list(range(1, last + 1)))
+
+        # sequential mode should return the same
+        self.assertEqual(res, api.request('repos/a/b/commits', paginate=True))
+
+    def test_parallel_pagination_missing(self):
+        def routes(method, url, params, headers, data=None):
+            if params['page'] > 2:  # blocked while being crawled
+                return response(451, {'message': 'Repository access blocked'},
+                                rate_headers())
+            headers = rate_headers()
+            headers['Link'] = '<%s?page=%d>; rel="next", ' \
+                              '<%s?page=5>; rel="last"' % (
+                                  url, params['page'] + 1, url)
+            return response(200, [params['page']], headers)
+
+        api = fake_api(routes, n_tokens=1)
+        self.assertEqual(api.request('repos/a/b/commits', paginate=True,
+                                     parallel=True), [1, 2])
+        self.assertEqual(api.request('repos/a/b/commits', paginate=True),
+                         [1, 2])
+
+    def test_streaming_pagination(self):
+        def routes(method, url, params, headers, data=None):
+            page = params['page']
+            headers = rate_headers()
+            if page < 3:
+                headers['Link'] = '<%s?page=%d>; rel="next"' % (url, page + 1)
+            return response(200, [{'page': page, 'i': i} for i in range(2)],
+                            headers)
+
+        api = fake_api(routes, n_tokens=1)
+        spill = os.path.join(self.tmpdir, 'spill.jsonl')
+        pages = api.iter_pages('repos/a/b/issues', spill=spill)
+        self.assertEqual(next(pages),
+                         [{'page': 1, 'i': 0}, {'page': 1, 'i': 1}])
+        # the next page is not requested until it is needed
+        self.assertEqual(len(api.tokens[0].session.calls), 1)
+        self.assertEqual(len(list(pages)), 2)
+
+        with open(spill) as fh:
+            items = [json.loads(line) for line in fh]
+        self.assertEqual([item['page'] for item in items], [1, 1, 2, 2, 3, 3])
+
+    def test_checkpoint(self):
+        calls = []
+
+        def routes(method, url, params, headers, data=None):
+            page = params['page']
+            calls.append(page)
+            headers = rate_headers()
+            if page < 4:
+                headers['Link'] = '<%s?page=%d>; rel="next"' % (url, page + 1)
+            return response(200, [page * 10 + i for i in range(2)], headers)
+
+        path = os.path.join(self.tmpdir, 'checkpoints.sqlite')
+        spill = os.path.join(self.tmpdir, 'spill.jsonl')
+        api = fake_api(routes, n_tokens=1, checkpoints=path)
+        pages = api.iter_pages('repos/a/b/issues', spill=spill,
+                               checkpoint=True, state='all')
+        self.assertEqual(next(pages), [10, 11])
+        self.assertEqual(next(pages), [20, 21])
+        next(pages)  # the consumer dies before it is done with page 3
+        del pages
+
+        # page 3 is requested again, pages 1-2 are read from the spill file
+        api = fake_api(routes, n_tokens=1, checkpoints=path)
+        del calls[:]
+        items = list(itertools.chain.from_iterable(api.iter_pages(
+            'repos/a/b/issues', spill=spill, checkpoint=True, state='all')))
+        self.assertEqual(items, [10, 11, 20, 21, 30, 31, 40, 41])
+        self.assertEqual(calls, [3, 4])
+        with open(spill) as fh:
+            self.assertEqual([json.loads(line) for line in fh], items)
+        # completed crawls start over
+        self.assertIsNone(api.checkpoints.get(
+            'repos/a/b/issues?state=all'))
+
+    def test_resumed_issues(self):
+        numbers = list(range(250, 0, -1))  # newest first
+
+        def routes(method, url, params, headers, data=None):
+            page = params['page']
+            headers = rate_headers()
+            if page * 100 < len(numbers):
+                headers['Link'] = '<%s?page=%d>; rel="next"' % (url, page + 1)
+            return response(200, [{
+                'number': number, 'title': '', 'state': 'open',
+                'user': {'login': 'user'}, 'created_at': '2018-01-01',
+                'updated_at': '2018-01-01', 'closed_at': None}
+                for number in numbers[(page - 1) * 100:page * 100]], headers)
+
+        url = 'github.com/a/resumed'
+        fname = utils._raw_cache.get_cache_fname('issues', url)
+        spill = utils._raw_cache.get_cache_fname('issues', url,
+                                                 extension='jsonl')
+        api = fake_api(routes, n_tokens=1, checkpoints=os.path.join(
+            self.tmpdir, 'checkpoints.sqlite'))
+        try:
+            # the crawl dies after the first page
+            issues = api.repo_issues('a/resumed', spill=spill,
+                                     checkpoint=True)
+            self.assertEqual(len(list(itertools.islice(issues, 101))), 101)
+            issues.close()
+            # new issues shift the second page, so that it starts with five
+            # issues of the first one
+            numbers[:0] = range(255, 250, -1)
+            df = utils.issues(url)
+            self.assertFalse(df.index.duplicated().any())
+            self.assertEqual(sorted(df.index), list(range(1, 251)))
+        finally:
+            for path in (fname, spill):
+                if os.path.isfile(path):
+                    os.remove(path)
+
+    def test_commits_stop_at(self):
+        def commit(n):
+            # linear history, the parent is the next commit on the list
+            return {'sha': 'c%d' % n, 'author': None,
+                    'parents': [{'sha': 'c%d' % (n + 1)}] if n < 14 else [],
+                    'commit': {'author': {}, 'message': '',
+                               'committer': {'date': '2018-01-01'}}}
+
+        def routes(method, url, params, headers, data=None):
+            page = params['page']
+            headers = rate_headers()
+            if page < 5:
+                headers['Link'] = '<%s?page=%d>; rel="next"' % (url, page + 1)
+            return response(200, [commit((page - 1) * 3 + i)
+                                  for i in range(3)], headers)
+
+        api = fake_api(routes, n_tokens=1, checkpoints=os.path.join(
+            self.tmpdir, 'checkpoints.sqlite'))
+        shas = [c['sha'] for c in api.repo_commits(
+            'a/b', stop_at={'c%d' % n for n in range(4, 15)}, pulls=False,
+            spill=os.path.join(self.tmpdir, 'spill.jsonl'), checkpoint=True)]
+        self.assertEqual(shas, ['c0', 'c1', 'c2', 'c3'])
+        self.assertEqual(len(api.tokens[0].session.calls), 2)
+        # stopping at a known commit completes the crawl
+        self.assertEqual(api.checkpoints.execute(
+            "SELECT * FROM checkpoints"), [])
+
+    def test_sync_commits(self):
+        state = {'commits': ['c2', 'c1'], 'merged_at': None}
+
+        def routes(method, url, params, headers, data=None):
+            if url.endswith('/commits'):
+                return response(200, [{
+                    'sha': sha, 'author': None, 'parents': [],
+                    'commit': {'author': {'date': '2018-01-0' + sha[1]},
+                               'message': '',
+                               'committer': {'date': '2018-01-0' + sha[1]}}}
+                    for sha in state['commits']], rate_headers())
+            updated_at = '2018-02-02' if state['merged_at'] else '2018-02-01'
+            if params.get('since', '') >= updated_at:
+                return response(200, [], rate_headers())
+            return response(200, [{
+                'number': 5, 'title': '', 'state': 'open',
+                'user': {'login': 'user'}, 'created_at': '2018-01-01',
+                'updated_at': updated_at, 'closed_at': None,
+                'pull_request': {'merged_at': state['merged_at']}}],
+                rate_headers())
+
+        api = fake_api(routes, n_tokens=1)
+        self.assertIs(utils.PROVIDERS['github.com'], api)
+        path = os.path.join(self.tmpdir, 'commits.csv')
+        utils.chunked_frame(
+            api.repo_commits('a/b'), utils.COMMIT_COLUMNS + utils.PULL_COLUMNS
+        ).set_index('sha', drop=True).to_csv(path)
+
+        # a new commit is pushed and the pull request is merged
+        state['commits'].insert(0, 'c3')
+        state['merged_at'] = '2018-02-02'
+        df = utils._sync_commits(pd.read_csv(path), 'github.com/a/b')
+        self.assertEqual(sorted(df.index.dropna()), ['c1', 'c2', 'c3'])
+        pulls = df[df.index.isnull()]
+        self.assertEqual(list(pulls['id']), [5])
+        self.assertEqual(list(pulls['merged_at']), ['2018-02-02'])
+        calls = api.tokens[0].session.calls
+        self.assertEqual(calls[-1][2].get('since'), '2018-02-01')
+
+    def test_sync_late_merge(self):
+        # k1 <- k2 is cached, then a branch k1 <- b1 is merged into k2 by m.
+        # b1 is older than k2, so it is listed after it
+        state = {'commits': [('k2', '03', ['k1']), ('k1', '01', [])]}
+
+        def routes(method, url, params, headers, data=None):
+            if not url.endswith('/commits'):
+                return response(200, [], rate_headers())
+            return response(200, [{
+                'sha': sha, 'author': None,
+                'parents': [{'sha': p} for p in parents],
+                'commit': {'author': {'date': '2018-01-' + day},
+                           'message': '',
+                           'committer': {'date': '2018-01-' + day}}}
+                for sha, day, parents in state['commits']
+                if params.get('since', '') <= '2018-01-' + day],
+                rate_headers())
+
+        api = fake_api(routes, n_tokens=1)
+        path = os.path.join(self.tmpdir, 'commits.csv')
+        utils.chunked_frame(
+            api.repo_commits('a/b'), utils.COMMIT_COLUMNS + utils.PULL_COLUMNS
+        ).set_index('sha', drop=True).to_csv(path)
+
+        state['commits'] = [('m', '04', ['k2', 'b1']), ('k2', '03', ['k1']),
+                            ('b1', '02', ['k1']), ('k1', '01', [])]
+        df = utils._sync_commits(pd.read_csv(path), 'github.com/a/b')
+        self.assertEqual(sorted(df.index.dropna()), ['b1', 'k1', 'k2', 'm'])
+
+    def test_issues_pulls(self):
+        def item(number, pull=False):
+            res = {'number': number, 'title': '', 'state': 'closed',
+                   'user': {'login': 'user'}, 'created_at': '2018-01-01',
+                   'updated_at': '2018-01-02', 'closed_at': '2018-01-02'}
+            if pull:
+                res['pull_request'] = {'merged_at': None}
+            return res
+
+        def routes(method, url, params, headers, data=None):
+            if url.endswith('/issues'):
+                return response(200, [item(1), item(2, True), item(3, True)],
+                                rate_headers())
+            if url.endswith('/commits'):
+                return response(200, [], rate_headers())
+            return response(200, dict(
+                item(3), merged_at='2018-01-02', base={'label': 'a:master'},
+                head={'label': 'c:branch', 'repo': {'full_name': 'c/b'}}),
+                rate_headers())
+
+        api = fake_api(routes, n_tokens=1)
+        res = list(api.repo_issues_pulls(
+            'a/b', details=lambda pr: pr['id'] == 3))
+        self.assertEqual([kind for kind, _ in res], ['issue', 'pull', 'pull'])
+        self.assertIsNone(res[1][1]['head'])
+        self.assertEqual(res[2][1]['head'], 'c/b')
+        self.assertEqual(res[2][1]['merged_at'], '2018-01-02')
+        urls = [url for _, url, _ in api.tokens[0].session.calls]
+        self.assertEqual([url.rsplit('/', 2)[-2:] for url in urls],
+                         [['b', 'issues'], ['pulls', '3']])
+
+        # pull requests of repo_commits come from the issues list too
+        self.assertEqual([pr['id'] for pr in api.repo_commits(
+            'a/b', stop_at={'x'}) if 'id' in pr], [2, 3])
+        self.assertEqual([i['number'] for i in api.repo_issues('a/b')], [1])
+
+    def test_token_priority(self):
+        def routes(method, url, params, headers, data=None):
+            return response(200, {}, rate_headers())
+
+        api = fake_api(routes, n_tokens=3, concurrency=1)
+        for token, remaining in zip(api.tokens, (10, 3000, 0)):
+            token.limit['core'] = {'remaining': remaining, 'limit': 5000,
+                                   'reset_time': time.time() + 3600}
+        # the token with the most remaining quota goes first;
+        # the exhausted one is not used at all
+        self.assertIs(api._acquire('users/a'), api.tokens[1])
+        self.assertIs(api._acquire('users/a'), api.tokens[0])
+        # search pool is independent
+        self.assertIs(api._acquire('search/code'), api.tokens[2])
+
+    def test_quota_reserve(self):
+        def routes(method, url, params, headers, data=None):
+            return response(200, {}, rate_headers())
+
+        api = fake_api(routes, n_tokens=1, concurrency=2,
+                       quota_reserve={'bulk': 0.2})
+        token = api.tokens[0]
+        token.limit['core'] = {'remaining': 500, 'limit': 5000,
+                               'reset_time': time.time() + 0.3}
+        # 10% left is reserved for higher classes until the reset
+        self.assertIs(api._acquire('users/a'), token)
+        api._release(token)
+        start = time.time()
+        with github.priority('bulk'):
+            self.assertIs(api._acquire('users/a'), token)
+        self.assertGreater(time.time() - start, 0.2)
+        api._release(token)
+
+        # lower classes wait while higher ones are queued
+        token.limit['core']['reset_time'] = time.time() + 3600
+        token.limit['core']['remaining'] = 4000
+        order = []
+
+        def worker(name):
+            with github.priority(name):
+                order.append((name, api._acquire('users/a')))
+
+        api._acquire('users/a')
+        api._acquire('users/a')  # no free slots left
+        threads = [threading.Thread(target=worker, args=(name,))
+                   for name in ('bulk', 'interactive')]
+        for t in threads:
+            t.start()
+            time.sleep(0.05)
+        api._release(token)
+        threads[1].join(1)
+        self.assertEqual([name for name, _ in order], ['interactive'])
+        api._release(token)
+        threads[0].join(1)
+        self.assertEqual([name for name, _ in order],
+                         ['interactive', 'bulk'])
+
+    def test_interactive_lookups(self):
+        reset = int(time.time()) + 2  # GitHub reports whole seconds
+
+        def routes(method, url, params, headers, data=None):
+            return response(200, {'fork': False},
+                            rate_headers(remaining=100, reset=reset))
+
+        api = fake_api(routes, n_tokens=1,
+                       quota_reserve={'normal': 0.05, 'bulk': 0.2})
+        api.tokens[0].limit['core'] = {'remaining': 100, 'limit': 5000,
+                                       'reset_time': reset}
+        # small lookups use the quota kept for interactive requests...
+        start = time.time()
+        self.assertFalse(api.isFork('a/b'))
+        self.assertLess(time.time() - start, 0.5)
+        # ...while normal ones wait for the reset
+        api.request('repos/a/c')
+        self.assertGreater(time.time() - start, 0.5)
+
+    def test_pacing(self):
+        def routes(method, url, params, headers, data=None):
+            # 10 requests left for the next 1-2 seconds
+            return response(200, {}, rate_headers(10, time.time() + 2))
+
+        api = fake_api(routes, n_tokens=1, concurrency=4, pacing=True)
+        api.request('users/a')
+        start = time.time()
+        for _ in range(3):
+            api.request('users/a')
+        # 0.1..0.2s between requests; the first one is not paced because
+        # limits were unknown when the previous request was made
+        self.assertGreater(time.time() - start, 0.15)
+
+    def test_lazy_stores(self):
+        def routes(method, url, params, headers, data=None):
+            return response(200, {'login': 'a'}, rate_headers())
+
+        stores = ('etag_cache', 'response_cache', 'profile_cache', 'ledger',
+                  'checkpoints', 'redirects', 'negative_cache')
+        api = fake_api(routes, n_tokens=1, **{
+            store: os.path.join(self.tmpdir, store + '.sqlite')
+            for store in stores})
+        # e.g. importing scraper must not create or purge any store
+        self.assertEqual(os.listdir(self.tmpdir), [])
+        api.request('users/a')
+        self.assertIn('ledger.sqlite', os.listdir(self.tmpdir))
+
+    def test_ledger(self):
+        def routes(method, url, params, headers, data=None):
+            return response(200, {}, rate_headers(remaining=4000))
+
+        path = os.path.join(self.tmpdir, 'ledger.sqlite')
+        api = fake_api(routes, n_tokens=2, ledger=path)
+        api.request('users/a')
+        # another process drains the first token and quarantines the second
+        ledger = cache.RateLimitLedger(path)
+        for token in api.tokens:
+            self.assertTrue(ledger.reserve(token, 'core'))
+        ledger.execute("UPDATE ledger SET remaining=1, reset_time=? "
+                       "WHERE key=?", int(time.time() + 3600),
+                       ledger.key(api.tokens[0]))
+        ledger.execute("UPDATE ledger SET backoff_until=? WHERE key=?",
+                       time.time() + 0.3, ledger.key(api.tokens[1]))
+
+        start = time.time()
+        api.request('users/b')
+        self.assertGreater(time.time() - start, 0.25)
+        self.assertEqual(api.tokens[0].limit['core']['remaining'], 0)
+        self.assertEqual(len(api.tokens[0].session.calls) +
+                         len(api.tokens[1].session.calls), 2)
+        # limits reported by GitHub are shared with the other process
+        self.assertEqual(ledger.execute(
+            "SELECT remaining FROM ledger WHERE key=? AND api_class='core'",
+            ledger.key(api.tokens[1])), [(4000,)])
+
+    def test_ledger_release(self):
+        calls = [0]
+        # reservations only carry over within the same quota window
+        reset = time.time() + 3600
+
+        def routes(method, url, params, headers, data=None):
+            calls[0] += 1
+            if calls[0] % 3 == 1:
+                raise requests.ConnectionError("connection reset")
+            if calls[0] % 3 == 2:  # e.g. from a proxy
+                return response(502, {'message': 'Bad Gateway'})
+            return response(200, {'login': 'user'}, rate_headers(4000, reset))
+
+        path = os.path.join(self.tmpdir, 'ledger.sqlite')
+        api = fake_api(routes, n_tokens=1, ledger=path)
+        api.tokens[0].backoff = lambda r: 0  # retry right away
+        for i in range(10):
+            api.request('users/%d' % i)
+        self.assertEqual(calls[0], 30)
+        ledger = cache.RateLimitLedger(path)
+        query = "SELECT reserved FROM ledger WHERE api_class='core'"
+        self.assertEqual(ledger.execute(query), [(0,)])
+
+        # requests bypassing GitHubAPI don't release others' reservations
+        self.assertTrue(ledger.reserve(api.tokens[0], 'core'))
+        calls[0] = 2  # the next request succeeds
+        self.assertEqual(api.tokens[0].user, 'user')
+        self.assertEqual(ledger.execute(query), [(1,)])
+
+    def test_redirects(self):
+        def routes(method, url, params, headers, data=None):
+            path = url[len(github.GitHubAPIToken.api_url):]
+            if path.startswith('repos/old/name'):  # redirected by requests
+                r = response(200, {'full_name': 'new/name'}
+                             if path == 'repos/old/name' else [],
+                             rate_headers(), url=github.GitHubAPIToken.api_url
+                             + path.replace('repos/old/name',
+                                            'repositories/42'))
+                r.history = [response(301)]
+                return r
+            self.assertTrue(path.startswith('repositories/42'))
+            return response(200, {'full_name': 'new/name'}
+                            if path == 'repositories/42' else [],
+                            rate_headers(), url=url)
+
+        path = os.path.join(self.tmpdir, 'redirects.sqlite')
+        api = fake_api(routes, n_tokens=1, redirects=path)
+        api.request('repos/old/name/issues')
+        self.assertEqual(api.redirects.get('Old/Name'),
+                         ('repositories/42', None))
+        # the new name is learned on demand
+        self.assertEqual(api.canonical_name('old/name'), 'new/name')
+        self.assertEqual(api.canonical_name('other/name'), 'other/name')
+        # later requests go to the new location straight away
+        calls = api.tokens[0].session.calls
+        del calls[:]
+        api.request('repos/old/name/commits')
+        self.assertEqual([url for _, url, _ in calls], [
+            github.GitHubAPIToken.api_url + 'repositories/42/commits'])
+        self.assertEqual(api.redirects.names(), {'old/name': 'new/name'})
+
+    def test_transferred_issue(self):
+        def routes(method, url, params, headers, data=None):
+            r = response(200, {'number': 12}, rate_headers(),
+                         url=github.GitHubAPIToken.api_url +
+                         'repositories/99/issues/12')
+            r.history = [response(301)]
+            return r
+
+        path = os.path.join(self.tmpdir, 'redirects.sqlite')
+        api = fake_api(routes, n_tokens=1, redirects=path)
+        self.assertEqual(api.request('repos/a/b/issues/5'), {'number': 12})
+        # the issue has moved, not the repository
+        self.assertIsNone(api.redirects.get('a/b'))
+        self.assertEqual(api.canonical_name('a/b'), 'a/b')
+
+    def test_negative_cache(self):
+        def routes(method, url, params, headers, data=None):
+            if 'blocked' in url:
+                return response(451, {'message': 'Repository access blocked'},
+                                rate_headers())
+            if 'empty' in url:
+                return response(409, {'message': 'Git Repository is empty.'},
+                                rate_headers())
+            return response(404, {'message': 'Not Found'}, rate_headers())
+
+        path = os.path.join(self.tmpdir, 'missing.sqlite')
+        api = fake_api(routes, n_tokens=1, negative_cache=path)
+        self.assertEqual(api.request('repos/a/deleted'), {})
+        self.assertEqual(api.request('repos/a/blocked'), 'notExist')
+        self.assertEqual(api.request('repos/a/empty/commits'), {})
+
+        # answers are reused, even by another process
+        api = fake_api(routes, n_tokens=1, negative_cache=path)
+        self.assertEqual(api.request('repos/a/deleted'), {})
+        self.assertEqual(api.request('repos/a/blocked'), 'notExist')
+        self.assertEqual(api.request('repos/a/empty/commits'), {})
+        # nothing exists in a missing repository
+        self.assertEqual(api.request('repos/a/deleted/issues'), {})
+        calls = api.tokens[0].session.calls
+        self.assertEqual(calls, [])
+        api.request('repos/a/empty/issues')
+        self.assertEqual(len(calls), 1)
+
+        # until they expire, then they are purged
+        api = fake_api(routes, n_tokens=1, negative_cache=path,
+                       negative_ttl=0)
+        self.assertIsNone(api.negative.get('repos/a/blocked', None, 3600))
+        api.request('repos/a/deleted')
+        self.assertEqual(len(api.tokens[0].session.calls), 1)
+
+    def test_etag_revalidation(self):
+        def routes(method, url, params, headers, data=None):
+            if headers.get('If-None-Match') == '"abc"':
+                return response(304, None, rate_headers(remaining=4000))
+            return response(200, {'login': 'user'},
+                            dict(rate_headers(remaining=4000), ETag='"abc"'))
+
+        api = fake_api(routes, n_tokens=1,
+                       etag_cache=os.path.join(self.tmpdir, 'etags.sqlite'))
+        etags = api.tokens[0].etags
+        self.assertEqual(api.request('users/user'), {'login': 'user'})
+        (downloaded,), = etags.execute("SELECT updated FROM etags")
+        self.assertEqual(api.request('users/user'), {'login': 'user'})
+        self.assertEqual(len(api.tokens[0].session.calls), 2)
+        # revalidated validators are kept as long as if just downloaded
+        (revalidated,), = etags.execute("SELECT updated FROM etags")
+        self.assertGreater(revalidated, downloaded)
+
+    def test_etag_response_cache(self):
+        validators = []
+
+        def routes(method, url, params, headers, data=None):
+            validators.append(headers.get('If-None-Match'))
+            if headers.get('If-None-Match') == '"abc"':
+                return response(304, None, rate_headers(remaining=4000))
+            return response(200, {'login': 'user'},
+                            dict(rate_headers(remaining=4000), ETag='"abc"'))
+
+        def make_api(**kwargs):
+            return fake_api(routes, n_tokens=1, etag_cache=os.path.join(
+                self.tmpdir, 'etags.sqlite'), response_cache=os.path.join(
+                self.tmpdir, 'responses.sqlite'), **kwargs)
+
+        api = make_api()
+        self.assertEqual(api.request('users/user'), {'login': 'user'})
+        # the body is only kept in the response cache
+        etags = api.tokens[0].etags
+        self.assertEqual(etags.execute("SELECT body FROM etags"), [(None,)])
+        # expired responses are revalidated
+        api.response_ttl = 0
+        self.assertEqual(api.request('users/user'), {'login': 'user'})
+        self.assertEqual(validators, [None, '"abc"'])
+
+        # old responses and ETags are purged once the stores are opened
+        api = make_api(response_max_age=0)
+        self.assertEqual(api.responses.execute("SELECT * FROM responses"), [])
+        self.assertEqual(api.tokens[0].etags.execute("SELECT * FROM etags"),
+                         [])
+
+    def test_response_cache(self):
+        def routes(method, url, params, headers, data=None):
+            page = params['page']
+            headers = rate_headers()
+            if page < 3:
+                headers['Link'] = '<%s?page=%d>; rel="next"' % (url, page + 1)
+            return response(200, [page], headers)
+
+        api = fake_api(routes, n_tokens=1, response_cache=os.path.join(
+            self.tmpdir, 'responses.sqlite'))
+        calls = api.tokens[0].session.calls
+        self.assertEqual(api.request('repos/a/b/issues', paginate=True),
+                         [1, 2, 3])
+        self.assertEqual(len(calls), 3)
+        # pages and their links come from the cache
+        self.assertEqual(api.request('repos/a/b/issues', paginate=True),
+                         [1, 2, 3])
+        self.assertEqual(len(calls), 3)
+        # different parameters make a different request
+        api.request('repos/a/b/issues', paginate=True, state='all')
+        self.assertEqual(len(calls), 6)
+
+        api.response_ttl = 0
+        api.request('repos/a/b/issues', paginate=True)
+        self.assertEqual(len(calls), 9)
+
+    def test_response_cache_snapshot(self):
+        state = {'items': [3, 2, 1]}  # newest first, one per page
+
+        def routes(method, url, params, headers, data=None):
+            page = params['page']
+            headers = rate_headers()
+            if page < len(state['items']):
+                headers['Link'] = '<%s?page=%d>; rel="next"' % (url, page + 1)
+            return response(200, state['items'][page - 1:page], headers)
+
+        api = fake_api(routes, n_tokens=1, response_cache=os.path.join(
+            self.tmpdir, 'responses.sqlite'))
+        self.assertEqual(api.request('repos/a/b/issues', paginate=True),
+                         [3, 2, 1])
+        # the first page expires before the rest, then a new item shifts
+        # all of them by a page
+        api.responses.execute(
+            "UPDATE responses SET updated=updated-? WHERE key LIKE ?",
+            api.response_ttl, '%page=1&%')
+        state['items'].insert(0, 4)
+        self.assertEqual(api.request('repos/a/b/issues', paginate=True),
+                         [4, 3, 2, 1])
+        # later pages are good as long as the first one is
+        calls = api.tokens[0].session.calls
+        self.assertEqual(api.request('repos/a/b/issues', paginate=True),
+                         [4, 3, 2, 1])
+        self.assertEqual(len(calls), 7)
+
+    def test_profile_cache(self):
+        def routes(method, url, params, headers, data=None):
+            login = url.rsplit('/', 1)[-1]
+            if login == 'ghost':
+                return response(404, {'message': 'Not Found'}, rate_headers())
+            if login == 'blocked':
+                return response(451, {'message': 'Repository access blocked'},
+                                rate_headers())
+            return response(200, {'login': login, 'email': login + '@a.b',
+                                  'name': None, 'type': 'User'},
+                            rate_headers())
+
+        api = fake_api(routes, n_tokens=1, profile_cache=os.path.join(
+            self.tmpdir, 'profiles.sqlite'))
+        calls = api.tokens[0].session.calls
+        self.assertEqual(api.warm_profiles(
+            ['user1', 'user2', 'ghost', 'blocked']), 4)
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(api.warm_profiles(['user1', 'User2', 'user3']), 1)
+        self.assertEqual(len(calls), 5)
+
+        self.assertEqual(api.userEmail('user1'), 'user1@a.b')
+        self.assertEqual(api.userInfo('user2'), 'user2@a.b,NULL,User')
+        self.assertEqual(api.user_info('ghost'), {})
+        # only dicts are cached
+        self.assertEqual(api.profiles.get('blocked', api.profile_ttl), {})
+        self.assertEqual(len(calls), 5)
+
+        api.profile_ttl = 0  # everything is expired
+        self.assertEqual(api.userEmail('user1'), 'user1@a.b')
+        self.assertEqual(len(calls), 6)
+
+    def test_metrics(self):
+        failures = [response(502, {'message': 'Server Error'})]
+
+        def routes(method, url, params, headers, data=None):
+            if failures:
+                return failures.pop()
+            return response(200, {}, rate_headers(remaining=4000))
+
+        api = fake_api(routes, n_tokens=1)
+        api.request('users/a')
+        api.request('users/b')
+        stats = metrics.snapshot(api)['tokens'][0]
+        self.assertEqual(stats['statuses'], {'502': 1, '200': 2})
+        self.assertEqual(sum(stats['latency_counts']), 3)
+        self.assertGreater(stats['backoff_seconds'], 0)
+        self.assertEqual(stats['limits']['core']['remaining'], 4000)
+
+        path = os.path.join(self.tmpdir, 'metrics.prom')
+        metrics.write(api, path)
+        with open(path) as fh:
+            text = fh.read()
+        self.assertIn('ghd_github_requests_total{token="...ken0",'
+                      'status="502"} 1', text)
+        self.assertIn('ghd_github_request_seconds_count{token="...ken0"} 3',
+                      text)
+        self.assertIn('ghd_github_rate_limit_remaining{token="...ken0",'
+                      'api_class="core"} 4000', text)
+
+        path = os.path.join(self.tmpdir, 'metrics.json')
+        metrics.write(api, path)
+        with open(path) as fh:
+            self.assertEqual(json.load(fh)['tokens'][0]['requests'], 3)
+
+        # concurrent writers don't share a temporary file
+        threads = [threading.Thread(target=metrics.write, args=(api, path))
+                   for _ in range(10)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ['metrics.json', 'metrics.prom'])
+
+        # export failures don't stop the exporter
+        exporter = metrics.Exporter(api, os.path.join(
+            self.tmpdir, 'missing', 'metrics.json'), interval=0.01)
+        metrics.logger.disabled = True  # failures are expected
+        try:
+            exporter.start()
+            time.sleep(0.05)
+            self.assertTrue(exporter.is_alive())
+        finally:
+            exporter.stop()
+            exporter.join()
+            metrics.logger.disabled = False
+
+    def test_timeline(self):
+        events = [
+            {'event': 'commented', 'created_at': '2018-01-01', 'body': 'hi',
+             'author_association': 'OWNER',
+             'user': {'login': 'user', 'type': 'User'}},
+            {'event': 'labeled', 'created_at': '2018-01-02', 'actor': None,
+             'label': {'name': 'bug'}},
+            {'event': 'cross-referenced', 'created_at': '2018-01-03',
+             'actor': {'login': 'bot', 'type': 'Bot'},
+             'source': {'issue': {'number': 2, 'state': 'open',
+                                  'assignees': [], 'pull_request': {},
+                                  'repository': {'full_name': 'c/d'}}}},
+            {'event': 'locked', 'created_at': '2018-01-04'},
+        ]
+
+        def routes(method, url, params, headers, data=None):
+            return response(200, events, rate_headers())
+
+        api = fake_api(routes, n_tokens=1)
+        df = api.issue_pr_timeline('a/b', 1)
+        self.assertEqual(tuple(df.columns), github.TIMELINE_COLUMNS)
+        self.assertEqual(str(df['event'].dtype), 'category')
+        self.assertEqual(list(df['type']),
+                         ['comment', 'label', 'pull_request', ''])
+        self.assertEqual(df['author'][0], 'user')
+        self.assertTrue(pd.isnull(df['author'][1]))  # deleted user
+        self.assertEqual(df['label'][1], 'bug')
+        self.assertEqual(df['repo'][2], 'c/d')
+        self.assertEqual(df['created_at'][3], '2018-01-04')
+
+    def test_backoff(self):
+        failures = [
+            response(403, {'message': 'You have exceeded a secondary rate '
+                                      'limit'}, {'Retry-After': '30'}),
+            response(502, {'message': 'Server Error'})
+        ]
+
+        def routes(method, url, params, headers, data=None):
+            if failures:
+                return failures.pop(0)
+            return response(200, {'login': 'user'}, rate_headers())
+
+        api = fake_api(routes, n_tokens=3)
+        start = time.time()
+        self.assertEqual(api.request('users/user'), {'login': 'user'})
+        # healthy token picked up the request without waiting
+        self.assertLess(time.time() - start, 1)
+        backoffs = sorted(token.backoff_until - start for token in api.tokens)
+        self.assertLessEqual(backoffs[0], 0)
+        self.assertLessEqual(backoffs[1], 2 * github.BACKOFF_BASE + 1)
+        self.assertGreaterEqual(backoffs[2], 29)
+        self.assertEqual(sum(token.failures for token in api.tokens), 2)
+
+    def test_repos_stats(self):
+        attempts = {'a/ready': 0, 'a/slow': 0, 'a/never': 0}
+
+        def routes(method, url, params, headers, data=None):
+            repo = url.split('/repos/', 1)[1].rsplit('/stats/', 1)[0]
+            attempts[repo] += 1
+            if repo == 'a/never' or (repo == 'a/slow' and attempts[repo] < 3):
+                return response(202, {}, rate_headers())
+            return response(200, [{'total': 1}], rate_headers())
+
+        api = fake_api(routes, n_tokens=1)
+        delay = github.STATS_RETRY_DELAY
+        github.STATS_RETRY_DELAY = 0.01
+        try:
+            res = list(api.repos_stats(sorted(attempts), 'contributors'))
+        finally:
+            github.STATS_RETRY_DELAY = delay
+        # ready statistics don't wait for the rest
+        self.assertEqual(res[0], ('a/ready', [{'total': 1}]))
+        self.assertEqual(sorted(res[1:]), [('a/never', None),
+                                           ('a/slow', [{'total': 1}])])
+        self.assertEqual(attempts, {'a/ready': 1, 'a/slow': 3,
+                                    'a/never': github.STATS_ATTEMPTS})
+
+    def test_warm_contributor_stats(self):
+        def routes(method, url, params, headers, data=None):
+            if '/a/never/' in url:
+                return response(202, {}, rate_headers())
+            if url.endswith('/contributors'):
+                return response(200, [{'author': {'login': 'user'}, 'weeks': [
+                    {'w': 1514764800, 'c': 1}]}], rate_headers())
+            return response(200, [{'week': 1514764800, 'total': 1}],
+                            rate_headers())
+
+        fake_api(routes, n_tokens=1)
+        urls = ['github.com/a/ready', 'github.com/a/never']
+        fnames = [utils._raw_cache.get_cache_fname('contributor_stats', url)
+                  for url in urls]
+        fast_path, delay = utils.COMMIT_STATS_FAST_PATH, \
+            github.STATS_RETRY_DELAY
+        utils.COMMIT_STATS_FAST_PATH = True
+        github.STATS_RETRY_DELAY = 0.01
+        try:
+            utils.warm_contributor_stats(urls)
+            self.assertTrue(os.path.isfile(fnames[0]))
+            # statistics still computing are not cached as empty
+            self.assertFalse(os.path.isfile(fnames[1]))
+            with self.assertRaises(github.StatsNotReady):
+                utils.contributor_stats(urls[1])
+            self.assertFalse(os.path.isfile(fnames[1]))
+        finally:
+            utils.COMMIT_STATS_FAST_PATH = fast_path
+            github.STATS_RETRY_DELAY = delay
+            for fname in fnames:
+                if os.path.isfile(fname):
+                    os.remove(fname)
+
+    def test_search(self):
+        # 2500 repos, one created every hour
+        epoch = datetime.datetime(2018, 1, 1)
+        created = [epoch + datetime.timedelta(hours=i) for i in range(2500)]
+
+        def routes(method, url, params, headers, data=None):
+            self.assertTrue(url.endswith('search/repositories'))
+            self.assertLessEqual(params['page'], 10)
+            start, end = [datetime.datetime.strptime(
+                date, "%Y-%m-%dT%H:%M:%SZ") for date in re.search(
+                    r'created:(\S+)\.\.(\S+)', params['q']).groups()]
+            ids = [i for i, date in enumerate(created) if start <= date <= end]
+            offset = (params['page'] - 1) * params['per_page']
+            return response(200, {
+                'total_count': len(ids), 'incomplete_results': False,
+                'items': [{'id': i} for i in
+                          ids[offset:offset + params['per_page']]]
+            }, rate_headers())
+
+        api = fake_api(routes, n_tokens=2)
+        results = list(api.search('repositories', 'fork', start=epoch,
+                                  end=created[-1]))
+        self.assertEqual(sorted(item['id'] for item in results),
+                         list(range(2500)))
+
+        # stopping early is fine
+        results = api.search('repositories', 'fork', start=epoch,
+                             end=created[-1])
+        self.assertEqual(len([item for _, item in zip(range(5), results)]),
+                         5)
+        results.close()
+
+
+class TestGitHubAPIv4(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_shared_pool(self):
+        def routes(method, url, params, headers, data=None):
+            return response(200, {'login': 'a'}, rate_headers())
+
+        api = fake_api(routes, n_tokens=1, metrics_file=os.path.join(
+            self.tmpdir, 'metrics.json'))
+        try:
+            api_v4 = github.GitHubAPIv4()
+            self.assertIsNot(api_v4, api)
+            self.assertIs(api_v4.tokens, api.tokens)
+            self.assertIs(api_v4.scheduler, api.scheduler)
+            self.assertIs(api_v4.exporter, api.exporter)
+            api_v4.request('users/a')
+            self.assertEqual(
+                metrics.snapshot(api)['tokens'][0]['requests'], 1)
+        finally:
+            api.exporter.stop()
+
+    def test_users_info(self):
+        def routes(method, url, params, headers, data=None):
+            variables = json.loads(data)['variables']
+            nodes = {}
+            for var, login in variables.items():
+                alias = 'n' + var[len('login'):]
+                nodes[alias] = None if login == 'ghost' else {
+                    '__typename': 'User', 'login': login, 'name': login,
+                    'email': '', 'createdAt': '2018-01-01',
+                    'repositories': {'totalCount': 1},
+                    'followers': {'totalCount': 2},
+                    'following': {'totalCount': 3}}
+            return response(200, {'data': nodes}, rate_headers())
+
+        api = fake_api(routes, n_tokens=1, api_class=github.GitHubAPIv4)
+        logins = ['user%d' % i for i in range(7)] + ['ghost']
+        res = api.users_info(logins, chunksize=3)
+        self.assertEqual(len(api.tokens[0].session.calls), 3)
+        self.assertEqual(set(res), set(logins))
+        self.assertIsNone(res['ghost'])
+        self.assertEqual(res['user1']['followers'], 2)
+        self.assertIsNone(res['user1']['email'])
+
+    def test_warm_profiles(self):
+        def routes(method, url, params, headers, data=None):
+            if method == 'get':  # REST API
+                login = url.rsplit('/', 1)[-1]
+                return response(200, {
+                    'login': login, 'type': 'Organization', 'name': None,
+                    'email': None, 'company': None, 'followers': 5,
+                    'following': 0}, rate_headers())
+            nodes = {}
+            for var, login in json.loads(data)['variables'].items():
+                typename = 'Organization' if login == 'org' else 'User'
+                # bots are not repository owners
+                nodes['n' + var[len('login'):]] = None if login == 'bot' \
+                    else {'__typename': typename, 'login': login,
+                          'name': login, 'email': '',
+                          'createdAt': '2018-01-01',
+                          'repositories': {'totalCount': 1},
+                          'followers': {'totalCount': 2},
+                          'following': {'totalCount': 3}}
+            return response(200, {'data': nodes}, rate_headers())
+
+        api = fake_api(routes, n_tokens=1, api_class=github.GitHubAPIv4,
+                       profile_cache=os.path.join(
+                           self.tmpdir, 'profiles.sqlite'))
+        calls = api.tokens[0].session.calls
+        self.assertEqual(api.warm_profiles(['user', 'org', 'bot']), 2)
+        self.assertEqual(len(calls), 1)
+
+        # partial profiles serve callers needing nothing more
+        self.assertEqual(api.userInfo('user'), 'NULL,user,User')
+        self.assertEqual(api.user_info('org', ('login', 'type'))['type'],
+                         'Organization')
+        self.assertEqual(len(calls), 1)
+        # the rest is requested over REST API
+        self.assertEqual(api.user_info('org', ('followers',))['followers'], 5)
+        self.assertIn('company', api.user_info('user'))
+        # null nodes are not taken for missing accounts
+        self.assertNotEqual(api.userInfo('bot'),
+                            'userNotExist,userNotExist,userNotExist')
+        self.assertEqual(len(calls), 4)
+
+    def test_failed_query(self):
+        failures = [2]  # number of queries to fail as a whole
+
+        def routes(method, url, params, headers, data=None):
+            if failures[0]:
+                failures[0] -= 1
+                return response(200, {'data': None, 'errors': [
+                    {'type': 'RATE_LIMITED', 'message': 'limit exceeded'}]},
+                    rate_headers())
+            variables = json.loads(data)['variables']
+            nodes = {}
+            errors = []
+            for var, name in variables.items():
+                if not var.startswith('name'):
+                    continue
+                alias = 'n' + var[len('name'):]
+                nodes[alias] = {'nameWithOwner': 'a/' + name, 'isFork': False,
+                                'pushedAt': '', 'createdAt': ''}
+                if name in ('deleted', 'forbidden'):
+                    nodes[alias] = None
+                    errors.append({'path': [alias], 'message': name,
+                                   'type': name == 'deleted' and 'NOT_FOUND'
+                                   or 'FORBIDDEN'})
+            return response(200, {'data': nodes, 'errors': errors},
+                            rate_headers())
+
+        api = fake_api(routes, n_tokens=1, api_class=github.GitHubAPIv4)
+        backoff = github.BACKOFF_BASE
+        github.BACKOFF_BASE = 0.01
+        try:
+            # failed queries are retried; only missing nodes are None
+            res = api.repos_info(['a/b', 'a/deleted'])
+            self.assertEqual(res['a/b']['full_name'], 'a/b')
+            self.assertIsNone(res['a/deleted'])
+            self.assertEqual(len(api.tokens[0].session.calls), 3)
+
+            failures[0] = github.GRAPHQL_ATTEMPTS
+            self.assertRaises(github.GraphQLError, api.repos_info, ['a/b'])
+            self.assertRaises(github.GraphQLError, api.repos_info,
+                              ['a/b', 'a/forbidden'])
+        finally:
+            github.BACKOFF_BASE = backoff
+
+    def test_prs_changed_files(self):
+        def file_node(i):
+            return {'path': 'f%d.py' % i, 'additions': 1, 'deletions': 2,
+                    'changeType': 'MODIFIED'}
+
+        def routes(method, url, params, headers, data=None):
+            if method == 'get':  # REST fallback for PR 3
+                return response(200, [{
+                    'filename': 'big.py', 'status': 'added', 'additions': 1,
+                    'deletions': 0, 'changes': 1, 'blob_url': '',
+                    'raw_url': '', 'contents_url': ''}], rate_headers())
+            variables = json.loads(data)['variables']
+            nodes = {}
+            for var, number in variables.items():
+                if not var.startswith('number'):
+                    continue
+                files = {'nodes': [file_node(i) for i in range(number)],
+                         'pageInfo': {'hasNextPage': number == 3}}
+                nodes['n' + var[len('number'):]] = None if number == 4 else {
+                    'pullRequest': {'headRefOid': 'abc', 'files': files}}
+            return response(200, {'data': nodes}, rate_headers())
+
+        api = fake_api(routes, n_tokens=1, api_class=github.GitHubAPIv4)
+        res = api.prs_changedFiles('a/b', [1, 2, 3, 4])
+        calls = api.tokens[0].session.calls
+        self.assertEqual([method for method, _, _ in calls], ['post', 'get'])
+        self.assertEqual(len(res[2]), 2)
+        self.assertEqual(res[2][1]['filename'], 'f1.py')
+        self.assertEqual(res[2][1]['status'], 'modified')
+        self.assertEqual(res[2][1]['changes'], 3)
+        self.assertEqual(res[3][0]['filename'], 'big.py')
+        self.assertEqual(res[4], [])
+
+    def test_crawl(self):
+        # number of issue pages per repository
+        repos = {'a/one': 3, 'a/two': 1, 'a/three': 2, 'a/empty': 0}
+        aliases = []
+
+        def routes(method, url, params, headers, data=None):
+            variables = json.loads(data)['variables']
+            nodes = {'rateLimit': {'cost': 1, 'remaining': 4999,
+                                   'resetAt': '2018-01-01T00:00:00Z'}}
+            aliases.append(len(variables) // 3)
+            for i in range(len(variables) // 3):
+                repo = "%s/%s" % (variables['owner%d' % i],
+                                  variables['name%d' % i])
+                page = int(variables['cursor%d' % i] or 0)
+                if not repos[repo]:
+                    nodes['n%d' % i] = None
+                    continue
+                nodes['n%d' % i] = {'issues': {
+                    'nodes': [{'author': {'login': repo}, 'closed': False,
+                               'closedAt': None, 'createdAt': '',
+                               'updatedAt': '', 'number': page,
+                               'title': ''}],
+                    'pageInfo': {'endCursor': str(page + 1),
+                                 'hasNextPage': page + 1 < repos[repo]}}}
+            return response(200, {'data': nodes}, rate_headers())
+
+        api = fake_api(routes, n_tokens=1, api_class=github.GitHubAPIv4)
+        res = list(api.crawl(sorted(repos), 'issues', repos_per_query=2))
+        self.assertEqual(sorted((repo, i['number']) for repo, i in res),
+                         [('a/one', 0), ('a/one', 1), ('a/one', 2),
+                          ('a/three', 0), ('a/three', 1), ('a/two', 0)])
+        self.assertTrue(all(n <= 2 for n in aliases))
+        self.assertEqual(api.graphql_cost, 1)
+
+    def test_crawl_checkpoint(self):
+        cursors = []
+
+        def routes(method, url, params, headers, data=None):
+            cursor = json.loads(data)['variables']['cursor0']
+            cursors.append(cursor)
+            page = int(cursor or 0)
+            return response(200, {'data': {
+                'rateLimit': {'cost': 1, 'remaining': 4999,
+                              'resetAt': '2018-01-01T00:00:00Z'},
+                'n0': {'issues': {
+                    'nodes': [{'author': None, 'closed': False,
+                               'closedAt': None, 'createdAt': '',
+                               'updatedAt': '', 'number': page,
+                               'title': ''}],
+                    'pageInfo': {'endCursor': str(page + 1),
+                                 'hasNextPage': page < 2}}}}},
+                rate_headers())
+
+        path = os.path.join(self.tmpdir, 'checkpoints.sqlite')
+        spill = os.path.join(self.tmpdir, 'spill.jsonl')
+        api = fake_api(routes, n_tokens=1, api_class=github.GitHubAPIv4,
+                       checkpoints=path)
+        issues = api.repo_issues('a/b', spill=spill, checkpoint=True)
+        self.assertEqual(next(issues)['number'], 0)
+        next(issues)
+        del issues
+
+        api = fake_api(routes, n_tokens=1, api_class=github.GitHubAPIv4,
+                       checkpoints=path)
+        # without the records fetched so far, a resumed crawl is incomplete
+        with self.assertRaises(ValueError):
+            next(api.repo_issues('a/b', checkpoint=True))
+        # records of the first page come from the spill file
+        self.assertEqual([i['number'] for i in api.repo_issues(
+            'a/b', spill=spill, checkpoint=True)], [0, 1, 2])
+        self.assertEqual(cursors, [None, '1', '1', '2'])
+        self.assertIsNone(api.checkpoints.get('graphql:issues:a/b'))
+
+
+class TestReplay(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_benchmark(self):
+        responses = replay.synthetic(['a/b'], commits=250, issues=9, events=3)
+        with replay.ReplayServer(responses, latency=0.001, fault_rate=0.1,
+                                 seed=1) as server:
+            api = replay.replay_api(server, tokens=2, concurrency=2)
+            df = replay.benchmark(api, server, ['a/b'], issues=4)
+            [token.session.close() for token in api.tokens]
+        self.assertEqual(list(df.index), list(replay.SCENARIOS))
+        # 250 commits + 3 pull requests, 6 issues, 4 timelines of 3 events
+        self.assertEqual(list(df['records']), [253, 6, 12])
+        # 3 pages of commits, 1 of issues for pull requests and 1 for
+        # issues (no response cache), 4 timelines
+        self.assertEqual(sum(df['requests'] - df['faults']), 9)
+        self.assertGreater(sum(df['faults']), 0)
+
+    def test_record(self):
+        path = os.path.join(self.tmpdir, 'recording.jsonl')
+        responses = replay.synthetic(['a/b'], commits=150, issues=1)
+        with replay.ReplayServer(responses) as server:
+            api = replay.replay_api(server, tokens=1)
+            # stores answering or rewriting requests are bypassed
+            negative = api.negative = cache.NegativeCache(
+                os.path.join(self.tmpdir, 'missing.sqlite'))
+            negative.put('repos/a/b/commits', {'page': 1, 'per_page': 100},
+                         404, {})
+            redirects = api.redirects = cache.RedirectMap(
+                os.path.join(self.tmpdir, 'redirects.sqlite'))
+            redirects.put('a/b', 'repositories/1')
+            with replay.record(api, path):
+                commits = list(api.repo_commits('a/b', pulls=False))
+            self.assertIs(api.negative, negative)
+            self.assertIs(api.redirects, redirects)
+            api.negative = api.redirects = None
+            recorded = replay.load(path)
+            self.assertEqual(set(recorded), {
+                'repos/a/b/commits?page=1&per_page=100',
+                'repos/a/b/commits?page=2&per_page=100'})
+            # recording replays the same
+            server.responses = recorded
+            self.assertEqual(
+                list(api.repo_commits('a/b', pulls=False)), commits)
+            [token.session.close() for token in api.tokens]
+        self.assertIn('Link', recorded[
+            'repos/a/b/commits?page=1&per_page=100'][1])
+
+
+class TestGHArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def archive(self, name, events):
+        path = os.path.join(self.tmpdir, name)
+        with gzip.open(path, 'wb') as fh:
+            for event in events:
+                fh.write((json.dumps(event) + "\n").encode('utf8'))
+        return path
+
+    def test_ingest(self):
+        actor = {'login': 'user'}
+
+        def event(type_, repo, created_at, **payload):
+            return {'type': type_, 'actor': actor, 'repo': {'name': repo},
+                    'created_at': created_at, 'payload': payload}
+
+        def issue(number, state, updated_at, **kwargs):
+            return dict(kwargs, number=number, title='', state=state,
+                        user=actor, created_at='2018-01-01T00:00:00Z',
+                        updated_at=updated_at, closed_at=None)
+
+        comment = {'user': actor, 'author_association': 'OWNER',
+                   'body': 'hi', 'created_at': '2018-01-01T01:00:00Z'}
+        first = self.archive('2018-01-01-0.json.gz', [
+            event('IssueCommentEvent', 'A/B', '2018-01-01T01:00:00Z',
+                  action='created', comment=comment,
+                  issue=issue(1, 'open', '2018-01-01T01:00:00Z')),
+            event('PushEvent', 'a/b', '2018-01-01T01:00:00Z'),
+            event('IssuesEvent', 'c/d', '2018-01-01T01:00:00Z',
+                  action='closed', issue=issue(5, 'closed', '2018-01-01')),
+        ])
+        second = self.archive('2018-01-01-1.json.gz', [
+            event('IssuesEvent', 'a/b', '2018-01-01T02:00:00Z',
+                  action='closed',
+                  issue=issue(1, 'closed', '2018-01-01T02:00:00Z')),
+            event('PullRequestEvent', 'a/b', '2018-01-01T03:00:00Z',
+                  action='closed', number=2, pull_request={
+                      'number': 2, 'merged': True,
+                      'merge_commit_sha': 'abc'}),
+            event('IssueCommentEvent', 'a/b', '2018-01-01T04:00:00Z',
+                  action='created',
+                  comment=dict(comment, created_at='2018-01-01T04:00:00Z'),
+                  issue=issue(2, 'closed', '2018-01-01T04:00:00Z',
+                              pull_request={})),
+        ])
+
+        issues, timeline = gharchive.ingest(
+            [second, first], repos=['a/b'], num_workers=2)
+        # the latest state wins; pull requests are not issues
+        self.assertEqual(list(issues.index), [('a/b', 1)])
+        self.assertTrue(issues.loc[('a/b', 1), 'closed'])
+        self.assertEqual(list(timeline.columns), ['repo_name', 'issue'] +
+                         list(github.TIMELINE_COLUMNS))
+        self.assertEqual(
+            [tuple(row) for row in timeline[
+                ['issue', 'event', 'type', 'author']].values],
+            [(1, 'commented', 'comment', 'user'),
+             (1, 'closed', 'close', 'user'),
+             (2, 'merged', 'merged', 'user'),
+             (2, 'closed', 'close', 'user'),
+             (2, 'commented', 'comment', 'user')])
+        self.assertEqual(timeline['commit_id'][2], 'abc')
+        self.assertTrue(pd.isnull(timeline['commit_id'][3]))
+
+
+if __name__ == "__main__":
+    unittest.main()
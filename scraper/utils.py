@@ -4,13 +4,21 @@ from __future__ import print_function
 import numpy as np
 import pandas as pd
 
+import collections
+import contextlib
 import logging
+import os
 import re
 
 from common import decorators
 from common import email_utils as email
 from scraper import github
 
+try:
+    import settings
+except ImportError:
+    settings = object()
+
 """ First contrib date without MIN_DATE restriction:
 > fcd = utils.first_contrib_dates("pypi").dropna()
 > df = pd.DataFrame(fcd.rename("fcd"))
@@ -35,10 +43,18 @@ Only 7 projects (1 commit each) have such commits, so they are safe to ignore
 """
 
 MIN_DATE = "1997"
+
+# get commit_user_stats() from GitHub statistics endpoints unless commits
+# of the repository are cached already, see contributor_stats().
+# Off by default since these count commits by week rather than by date
+COMMIT_STATS_FAST_PATH = getattr(
+    settings, "SCRAPER_COMMIT_STATS_FAST_PATH", False)
 # username to be used all unidentified users
 DEFAULT_USERNAME = "-"
 
 fs_cache = decorators.typed_fs_cache('scraper')
+# to locate files of 'raw' caches
+_raw_cache = fs_cache('raw')
 
 logger = logging.getLogger("ghd.scraper")
 
@@ -184,7 +200,111 @@ def zeropad(df, fill_value=0):
     return df.reindex(idx, fill_value=fill_value)
 
 
-@fs_cache('raw')
+def chunked_frame(rows, columns, chunksize=10000):
+    # type: (Iterable[dict], list, int) -> pd.DataFrame
+    """ Same as pd.DataFrame(rows, columns=columns), but doesn't keep more
+    than `chunksize` rows as dicts in memory. It is intended for streaming
+    generators like GitHubAPI.repo_commits, which might yield millions of
+    records for big repositories.
+
+    >>> df = chunked_frame(({'a': i, 'b': -i} for i in range(25)), ['a'], 10)
+    >>> len(df), list(df.columns), int(df['a'].sum())
+    (25, ['a'], 300)
+    """
+    chunks = []
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunksize:
+            chunks.append(pd.DataFrame(chunk, columns=columns))
+            chunk = []
+    chunks.append(pd.DataFrame(chunk, columns=columns))
+    return pd.concat(chunks, ignore_index=True)
+
+
+@contextlib.contextmanager
+def _spill(func_name, repo_url):
+    # type: (str, str) -> str
+    """ Spill file for a resumable crawl (see GitHubAPI.iter_pages), kept
+    along with 'raw' cache files. It is removed once the crawl completes,
+    but kept if it fails, so that the next attempt can resume.
+    """
+    path = _raw_cache.get_cache_fname(func_name, repo_url, extension='jsonl')
+    yield path
+    if os.path.isfile(path):
+        os.remove(path)
+
+
+COMMIT_COLUMNS = ['sha', 'author', 'author_name', 'author_email',
+                  'authored_date', 'committed_date', 'parents']
+# pull requests listed by commits() along with commits, in rows without sha
+PULL_COLUMNS = ['id', 'created_at', 'updated_at', 'closed_at', 'merged_at']
+ISSUE_COLUMNS = ['number', 'author', 'closed', 'created_at', 'updated_at',
+                 'closed_at']
+CONTRIBUTOR_STATS_COLUMNS = ['week', 'author', 'commits']
+
+
+def drop_duplicates(df):
+    # type: (pd.DataFrame) -> pd.DataFrame
+    """ Drop records repeating the index of an earlier one. Records without
+    index (NaN) are never dropped.
+
+    Lists are paginated newest first, so items added while a crawl was
+    interrupted shift the pages that follow; a resumed crawl (see
+    GitHubAPI.iter_pages) gets the items at page boundaries twice.
+    >>> df = pd.DataFrame({'v': [1, 2, 3]}, index=['a', 'b', 'a'])
+    >>> drop_duplicates(df)['v'].tolist()
+    [1, 2]
+    """
+    return df[~(df.index.duplicated(keep='first') & pd.notnull(df.index))]
+
+
+def upsert(stale, fresh):
+    # type: (pd.DataFrame, pd.DataFrame) -> pd.DataFrame
+    """ Update stale records with fresh ones, matching on index.
+    Fresh records come first and replace stale ones with the same index.
+    >>> stale = pd.DataFrame({'v': [1, 2]}, index=['a', 'b'])
+    >>> fresh = pd.DataFrame({'v': [3, 4]}, index=['c', 'b'])
+    >>> upsert(stale, fresh)['v'].to_dict() == {'a': 1, 'b': 4, 'c': 3}
+    True
+    >>> upsert(stale, fresh).index.tolist()
+    ['c', 'b', 'a']
+    """
+    return drop_duplicates(pd.concat([fresh, stale]))
+
+
+def _sync_commits(stale, repo_url):
+    # type: (pd.DataFrame, str) -> pd.DataFrame
+    """ Update expired commits() cache by fetching only new commits and
+    pull requests updated since the newest cached ones.
+
+    New commits are not filtered by date: branches merged since the last
+    update might have commits older than the newest cached one.
+    """
+    provider, project_url = get_provider(repo_url)
+    # caches made before pull request columns were kept have no ids,
+    # so their pull request rows are replaced by a full list
+    stale = stale.reindex(columns=COMMIT_COLUMNS + PULL_COLUMNS)
+    stale_commits = stale[stale['sha'].notnull()].set_index('sha', drop=True)
+    stale_pulls = stale[stale['sha'].isnull() & stale['id'].notnull()]
+    known = set(stale_commits.index)
+    pulls_since = stale_pulls['updated_at'].max()
+    with _spill('commits', repo_url) as spill:
+        fresh = chunked_frame(provider.repo_commits(
+            project_url, stop_at=known, spill=spill, checkpoint=True,
+            pulls_since=pulls_since if pd.notnull(pulls_since) else None),
+            columns=COMMIT_COLUMNS + PULL_COLUMNS)
+    fresh_commits = fresh[fresh['sha'].notnull()].set_index('sha', drop=True)
+    fresh_pulls = fresh[fresh['sha'].isnull()]
+    logger.info("%s: %d new commits, %d updated pull requests", repo_url,
+                len(fresh_commits), len(fresh_pulls))
+    pulls = upsert(stale_pulls.set_index('id', drop=True),
+                   fresh_pulls.set_index('id', drop=True)).reset_index()
+    return pd.concat([upsert(stale_commits, fresh_commits), pulls.set_index(
+        'sha', drop=True)[COMMIT_COLUMNS[1:] + PULL_COLUMNS]])
+
+
+@fs_cache('raw', update=_sync_commits)
 def commits(repo_url):
     # type: (str) -> pd.DataFrame
     """
@@ -202,11 +322,106 @@ def commits(repo_url):
     RepoDoesNotExist: GH API returned status 404
     """
     provider, project_url = get_provider(repo_url)
-    return pd.DataFrame(
-        provider.repo_commits(project_url),
-        columns=['sha', 'author', 'author_name', 'author_email',
-                 'authored_date', 'committed_date', 'parents']
-    ).set_index('sha', drop=True)
+    with _spill('commits', repo_url) as spill:
+        return drop_duplicates(chunked_frame(provider.repo_commits(
+            project_url, spill=spill, checkpoint=True),
+            columns=COMMIT_COLUMNS + PULL_COLUMNS).set_index('sha', drop=True))
+
+
+def _contributor_weeks(contributors, activity):
+    # type: (list, list) -> pd.DataFrame
+    """ Weekly commits by author out of stats/contributors response.
+    The result is empty unless these statistics account for all commits.
+    They don't if there are 100 contributors (GitHub doesn't report more)
+    or if weekly totals over the last year, stats/commit_activity, don't
+    match, e.g. because of commits not linked to GitHub accounts. The
+    current week is not checked, since the two are computed separately.
+
+    >>> c = [{'author': {'login': 'a'}, 'weeks': [
+    ...     {'w': 1514764800, 'c': 2}, {'w': 1515369600, 'c': 0}]}]
+    >>> df = _contributor_weeks(c, [{'week': 1514764800, 'total': 2},
+    ...                             {'week': 1515369600, 'total': 1}])
+    >>> df.values.tolist()
+    [['2018-01-01', 'a', 2]]
+    >>> len(_contributor_weeks(c, [{'week': 1514764800, 'total': 3},
+    ...                            {'week': 1515369600, 'total': 0}]))
+    0
+    """
+    df = pd.DataFrame(columns=CONTRIBUTOR_STATS_COLUMNS)
+    if not isinstance(contributors, list) or not contributors \
+            or not isinstance(activity, list) or len(contributors) >= 100:
+        return df
+    totals = collections.Counter()
+    rows = []
+    for contributor in contributors:
+        author = (contributor.get('author') or {}).get('login')
+        for week in contributor['weeks']:
+            totals[week['w']] += week['c']
+            if week['c']:
+                rows.append((week['w'], author or DEFAULT_USERNAME, week['c']))
+    if any(totals[week['week']] != week['total'] for week in activity[:-1]):
+        return df
+    df = pd.DataFrame(rows, columns=CONTRIBUTOR_STATS_COLUMNS)
+    df['week'] = pd.to_datetime(df['week'], unit='s').dt.strftime('%Y-%m-%d')
+    return df
+
+
+@_raw_cache
+def contributor_stats(repo_url):
+    # type: (str) -> pd.DataFrame
+    """ Weekly commits by author, taken from GitHub statistics in a couple
+    of requests rather than from the full commit history. Commits are
+    counted by week of authoring, on the default branch only. Empty if the
+    statistics are incomplete (see _contributor_weeks) or not available.
+
+    Raises github.StatsNotReady if GitHub is still computing them, so that
+    nothing is cached.
+    """
+    provider, project_url = get_provider(repo_url)
+    stats = {stat: res for stat in ('contributors', 'commit_activity')
+             for _, res in provider.repos_stats([project_url], stat)}
+    if None in stats.values():
+        raise github.StatsNotReady(
+            "%s: statistics are not ready" % repo_url)
+    return _contributor_weeks(
+        stats['contributors'], stats['commit_activity']).set_index('week')
+
+
+def warm_contributor_stats(repo_urls, chunksize=1000):
+    # type: (Iterable[str], int) -> None
+    """ Fill contributor_stats() cache for many repositories at once.
+    Statistics GitHub is still computing don't hold up the rest, they are
+    retried later (see GitHubAPI.repos_stats); those not ready even then
+    are not cached. Repositories with commits cached already are skipped,
+    as well as everything if the fast path is disabled.
+    """
+    if not COMMIT_STATS_FAST_PATH:
+        return
+    provider = PROVIDERS['github.com']
+    fnames = {}  # project_url: cache file
+    for repo_url in repo_urls:
+        provider_name, project_url = parse_url(repo_url)
+        fname = _raw_cache.get_cache_fname('contributor_stats', repo_url)
+        if provider_name == 'github.com' and _raw_cache.expired(fname) \
+                and not os.path.isfile(
+                    _raw_cache.get_cache_fname('commits', repo_url)):
+            fnames[project_url] = fname
+
+    project_urls = list(fnames)
+    for start in range(0, len(project_urls), chunksize):
+        chunk = project_urls[start:start + chunksize]
+        stats = collections.defaultdict(dict)
+        for stat in ('contributors', 'commit_activity'):
+            for project_url, res in provider.repos_stats(chunk, stat):
+                stats[project_url][stat] = res
+        for project_url in chunk:
+            if None in stats[project_url].values():
+                continue
+            _contributor_weeks(
+                stats[project_url].get('contributors'),
+                stats[project_url].get('commit_activity')
+            ).set_index('week').to_csv(
+                fnames[project_url], float_format="%g", encoding="utf-8")
 
 
 # @fs_cache('aggregate', 2)
@@ -216,6 +431,11 @@ def commit_user_stats(repo_name):
     :param repo_name: str, repo name (e.g. github.com/pandas-dev/pandas
     :return a dataframe indexed on (month, username) with a commits column
 
+    With SCRAPER_COMMIT_STATS_FAST_PATH enabled and unless commits of the
+    repository are cached, the counts come from contributor_stats(), which
+    is much cheaper. Weeks are then attributed to the month they start in,
+    so commits of weeks spanning two months are all counted in the first.
+
     # This repo contains one commit out of order 2005 while repo started in 2016
     >>> cus = commit_user_stats("github.com/django/django")
     >>> isinstance(cus, pd.Series)
@@ -233,6 +453,19 @@ def commit_user_stats(repo_name):
     >>> 1 <= len(commit_user_stats("github.com/user2589/schooligan")) < 10  # 1
     True
     """
+    # fast path, unless commits have been collected anyway
+    if COMMIT_STATS_FAST_PATH and not os.path.isfile(
+            _raw_cache.get_cache_fname('commits', repo_name)):
+        try:
+            weekly = contributor_stats(repo_name).reset_index()
+        except github.StatsNotReady:  # fall back to commits
+            weekly = pd.DataFrame(columns=CONTRIBUTOR_STATS_COLUMNS)
+        weekly = weekly[weekly['week'] >= MIN_DATE]
+        if len(weekly):
+            return weekly['commits'].groupby(
+                [weekly['week'].str[:7].rename('authored_date'),
+                 weekly['author']]).sum().rename('commits').astype(int)
+
     stats = commits(repo_name)
     # check for null and empty string is required because of file caching.
     # commits scraped immediately will have empty string, but after save/load
@@ -309,7 +542,22 @@ def contributions_quantile(repo_name, q):
                     "authored_date", q)["commits"].rename("q%g" % (q*100))
 
 
-@fs_cache('raw')
+def _sync_issues(stale, repo_url):
+    # type: (pd.DataFrame, str) -> pd.DataFrame
+    """ Update expired issues() cache with issues updated since """
+    provider, project_url = get_provider(repo_url)
+    stale = stale.set_index('number', drop=True)
+    since = stale['updated_at'].max()
+    with _spill('issues', repo_url) as spill:
+        fresh = chunked_frame(provider.repo_issues(
+            project_url, since=since if pd.notnull(since) else None,
+            spill=spill, checkpoint=True),
+            columns=ISSUE_COLUMNS).set_index('number', drop=True)
+    logger.info("%s: %d updated issues", repo_url, len(fresh))
+    return upsert(stale, fresh)
+
+
+@fs_cache('raw', update=_sync_issues)
 def issues(repo_url):
     # type: (str) -> pd.DataFrame
     """ Get a dataframe with issues
@@ -323,10 +571,10 @@ def issues(repo_url):
     0
     """
     provider, project_url = get_provider(repo_url)
-    return pd.DataFrame(
-        provider.repo_issues(project_url),
-        columns=['number', 'author', 'closed', 'created_at', 'updated_at',
-                 'closed_at']).set_index('number', drop=True)
+    with _spill('issues', repo_url) as spill:
+        return drop_duplicates(chunked_frame(provider.repo_issues(
+            project_url, spill=spill, checkpoint=True),
+            columns=ISSUE_COLUMNS).set_index('number', drop=True))
 
 
 # @fs_cache('aggregate')
@@ -7,6 +7,7 @@ from common import decorators as d
 import scraper
 
 api = scraper.GitHubAPI()
+api_v4 = scraper.github.GitHubAPIv4()
 
 fs_cache = d.fs_cache('shurui_prFiles')
 
@@ -34,10 +35,17 @@ def get_pr_timeline(repo, issue):
     print("get reference of pr %s from %s" % (repo, issue))
     return pd.DataFrame(api.issue_pr_timeline(repo, issue))
 
+# pr id: changed files, fetched in bulk by api_v4.prs_changedFiles
+changed_files = {}
+
+
 @fs_cache
 def get_pr_changedFiles(repo, issue):
     print("get reference of pr %s from %s" % (repo, issue))
-    return pd.DataFrame(api.pr_changedFiles(repo, issue))
+    files = changed_files.pop(issue, None)
+    if files is None:
+        files = api.pr_changedFiles(repo, issue)
+    return pd.DataFrame(files)
 
 
 @fs_cache
@@ -83,6 +91,12 @@ if __name__ == "__main__":
         print(repo)
 
         if len(pullrequests):
+            # prefetch files of pull requests missing from the cache
+            changed_files.update(api_v4.prs_changedFiles(repo, [
+                int(pr_id) for pr_id in pullrequests['id']
+                if RepresentsInt(pr_id) and fs_cache.expired(
+                    fs_cache.get_cache_fname('get_pr_changedFiles', repo,
+                                             int(pr_id)))]))
             for pullrequest_id in pullrequests['id']:
                 print(pullrequest_id)
                 if RepresentsInt(pullrequest_id):